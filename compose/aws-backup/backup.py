@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+"""
+Incremental backup of the hub volumes
+
+Files are stored by content (objects/<sha256>), so a file is only uploaded once, no matter
+how many backups it is part of. Every backup also stores a snapshot listing the path, size
+and hash of every file (snapshots/<host>/<date/time>.json), which is what restore uses to
+rebuild a directory.
+
+A local state file remembers which objects were shipped already, and the hashes of files
+that did not change since the last run, so unchanged files are neither hashed nor uploaded again.
+Objects the state does not know of are looked up with one listing of the store, and all new objects
+are uploaded together, so a backup starts the aws CLI the same few times however many files changed.
+
+Usage:
+    backup.py backup /data /logs
+    backup.py restore /restored [--snapshot <name>]
+    backup.py snapshots
+
+The store is AWS_S3_BUCKET_URL (through the aws CLI at AWS_CLI, /usr/local/bin/aws by default.
+AWS_S3_ENDPOINT_URL can point it to a local S3 stand-in), or a local directory given with --store
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+DEFAULT_STATE_DIR = "/state"
+
+# cron runs backups without a PATH, so the CLI is called by its full path
+DEFAULT_AWS_CLI = "/usr/local/bin/aws"
+
+# files that are still being written to, or replaced, by the hub
+SKIPPED_SUFFIXES = (".tmp",)
+
+
+class LocalStore(object):
+    """
+    Stores backups in a local directory
+    """
+
+    def __init__(self, root):
+        self.root = root if root.endswith("/") else root + "/"
+
+    def keys(self, prefix):
+        directory = self.root + prefix
+        keys = set()
+        for root, dirs, files in os.walk(directory):
+            keys.update(os.path.relpath(os.path.join(root, name), self.root)
+                        for name in files if not name.endswith(".tmp"))
+        return keys
+
+    def put(self, key, file_name):
+        path = self.root + key
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        shutil.copyfile(file_name, path + ".tmp")
+        os.rename(path + ".tmp", path)
+
+    def put_many(self, files):
+        """
+        :param files: dict of the files to store, by key
+        :return: keys that were stored (files removed in the meantime are not)
+        """
+        stored = []
+        for key, file_name in sorted(files.items()):
+            try:
+                self.put(key, file_name)
+            except (IOError, OSError):
+                continue
+            stored.append(key)
+        return stored
+
+    def get(self, key, file_name):
+        shutil.copyfile(self.root + key, file_name)
+
+    def list(self, prefix):
+        directory = os.path.dirname(self.root + prefix)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.path.relpath(os.path.join(directory, name), self.root)
+                      for name in os.listdir(directory) if not name.endswith(".tmp"))
+
+
+class S3Store(object):
+    """
+    Stores backups in S3, using the aws CLI. Every call starts the CLI, so a backup lists the objects
+    with one call and uploads all new objects with another (see keys and put_many)
+    """
+
+    def __init__(self, bucket_url, endpoint_url=None, aws_cli=DEFAULT_AWS_CLI):
+        self.bucket_url = bucket_url if bucket_url.endswith("/") else bucket_url + "/"
+        self.endpoint_url = endpoint_url
+        self.aws_cli = aws_cli
+        # listings name keys from the root of the bucket (s3://bucket/<path>/<key>)
+        self._path = self.bucket_url.split("/", 3)[3]
+
+    def _aws(self, *args):
+        command = [self.aws_cli, "s3"] + list(args)
+        if self.endpoint_url:
+            command += ["--endpoint-url", self.endpoint_url]
+        return subprocess.check_output(command)
+
+    def keys(self, prefix):
+        """
+        Return the keys of all objects under the passed prefix, with a single listing
+        """
+        try:
+            output = self._aws("ls", "--recursive", self.bucket_url + prefix)
+        except (subprocess.CalledProcessError, OSError):
+            return set()
+        keys = set()
+        for line in output.splitlines():
+            # date, time, size, key
+            fields = line.split(None, 3)
+            if len(fields) == 4 and fields[3].startswith(self._path):
+                keys.add(fields[3][len(self._path):])
+        return keys
+
+    def put(self, key, file_name):
+        self._aws("cp", "--only-show-errors", file_name, self.bucket_url + key)
+
+    def put_many(self, files):
+        """
+        Uploads the passed files with a single call, from a staging directory of symbolic links
+        :param files: dict of the files to store, by key
+        :return: keys that were stored (files removed in the meantime are not)
+        """
+        staging = tempfile.mkdtemp(prefix="backup_")
+        try:
+            stored = []
+            for key, file_name in sorted(files.items()):
+                if not os.path.isfile(file_name):
+                    continue
+                path = os.path.join(staging, key)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                os.symlink(os.path.abspath(file_name), path)
+                stored.append(key)
+            if stored:
+                self._aws("cp", "--recursive", "--only-show-errors", staging, self.bucket_url)
+            return stored
+        finally:
+            shutil.rmtree(staging)
+
+    def get(self, key, file_name):
+        self._aws("cp", "--only-show-errors", self.bucket_url + key, file_name)
+
+    def list(self, prefix):
+        try:
+            output = self._aws("ls", self.bucket_url + prefix)
+        except (subprocess.CalledProcessError, OSError):
+            return []
+        directory = prefix.rsplit("/", 1)[0] + "/" if "/" in prefix else ""
+        return sorted(directory + line.split()[-1] for line in output.splitlines() if line.strip())
+
+
+def sha256_file(file_name):
+    h = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def object_key(sha):
+    return "objects/{}/{}".format(sha[:2], sha)
+
+
+class State(object):
+    """
+    Local record of the shipped objects, and of the hashes of files seen before
+    """
+
+    def __init__(self, state_dir):
+        self.file_name = os.path.join(state_dir, "backup_state.json")
+        self.objects = set()
+        self.files = {}
+        if os.path.exists(self.file_name):
+            with open(self.file_name, "r") as f:
+                state = json.load(f)
+            self.objects = set(state['objects'])
+            self.files = state['files']
+
+    def cached_hash(self, path, stat):
+        cached = self.files.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+            return cached[2]
+        return None
+
+    def save(self):
+        directory = os.path.dirname(self.file_name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.file_name + ".tmp", "w") as f:
+            json.dump({'objects': sorted(self.objects), 'files': self.files}, f)
+        os.rename(self.file_name + ".tmp", self.file_name)
+
+
+def snapshot_key(host, name):
+    return "snapshots/{}/{}.json".format(host, name)
+
+
+def backup(store, state, sources, host, name):
+    """
+    Uploads the files of the passed directories that were not shipped before, and a snapshot of them
+    :param host: host the snapshot belongs to
+    :param name: name of the snapshot (its date/time)
+    :return: snapshot
+    """
+    snapshot = {'host': host, 'name': name, 'created_ts': time.time(), 'files': {}}
+    files_seen = {}
+    new_objects = {}  # files of objects that were not shipped before, by hash
+
+    for source in sources:
+        source = os.path.abspath(source)
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                if file_name.endswith(SKIPPED_SUFFIXES) or not os.path.isfile(path):
+                    continue
+                try:
+                    stat = os.stat(path)
+                    sha = state.cached_hash(path, stat) or sha256_file(path)
+                except (IOError, OSError):
+                    # removed while backing up (e.g. a pending file was uploaded)
+                    continue
+                files_seen[path] = [stat.st_size, stat.st_mtime, sha]
+                if sha not in state.objects:
+                    new_objects.setdefault(sha, path)
+
+                relative = os.path.join(os.path.basename(source), os.path.relpath(path, source))
+                snapshot['files'][relative] = {'sha256': sha, 'size': stat.st_size}
+
+    # objects the state does not know of may have been shipped by a run that did not save it
+    uploaded = []
+    if new_objects:
+        shipped = store.keys("objects/")
+        uploaded = store.put_many({object_key(sha): path for sha, path in new_objects.items()
+                                   if object_key(sha) not in shipped})
+        stored = shipped | set(uploaded)
+        for sha, path in new_objects.items():
+            if object_key(sha) in stored:
+                state.objects.add(sha)
+            else:
+                # removed before it was uploaded
+                snapshot['files'] = {relative: entry for relative, entry in snapshot['files'].items()
+                                     if entry['sha256'] != sha}
+    uploaded_bytes = sum(files_seen[path][0] for sha, path in new_objects.items() if object_key(sha) in uploaded)
+
+    state.files = files_seen
+
+    tmp = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    try:
+        json.dump(snapshot, tmp, sort_keys=True)
+        tmp.close()
+        store.put(snapshot_key(host, name), tmp.name)
+    finally:
+        os.remove(tmp.name)
+    state.save()
+
+    print("backup {}/{}: {} files, {} new objects uploaded ({} bytes)".format(
+        host, name, len(snapshot['files']), len(uploaded), uploaded_bytes))
+    return snapshot
+
+
+def list_snapshots(store, host):
+    """
+    Return the names of the snapshots of the passed host, oldest first
+    """
+    return [os.path.basename(key)[:-len(".json")] for key in store.list("snapshots/{}/".format(host))
+            if key.endswith(".json")]
+
+
+def restore(store, destination, host, snapshot_name):
+    """
+    Rebuilds the files of the passed snapshot in the destination directory
+    :return: snapshot
+    """
+    tmp = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+    tmp.close()
+    try:
+        store.get(snapshot_key(host, snapshot_name), tmp.name)
+        with open(tmp.name, "r") as f:
+            snapshot = json.load(f)
+    finally:
+        os.remove(tmp.name)
+
+    for relative, entry in sorted(snapshot['files'].items()):
+        path = os.path.join(destination, relative)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if os.path.exists(path) and os.path.getsize(path) == entry['size'] \
+                and sha256_file(path) == entry['sha256']:
+            continue
+        store.get(object_key(entry['sha256']), path + ".tmp")
+        if sha256_file(path + ".tmp") != entry['sha256']:
+            os.remove(path + ".tmp")
+            raise ValueError("Corrupted object for {}".format(relative))
+        os.rename(path + ".tmp", path)
+
+    print("restored {}/{}: {} files".format(host, snapshot_name, len(snapshot['files'])))
+    return snapshot
+
+
+def create_store(args):
+    if args.store:
+        return LocalStore(args.store)
+    bucket_url = os.environ.get("AWS_S3_BUCKET_URL")
+    if not bucket_url:
+        print("AWS_S3_BUCKET_URL is not set")
+        sys.exit(1)
+    aws_cli = os.environ.get("AWS_CLI", DEFAULT_AWS_CLI)
+    if not os.path.isfile(aws_cli):
+        print("aws CLI not found at {} (set AWS_CLI)".format(aws_cli))
+        sys.exit(1)
+    return S3Store(bucket_url, os.environ.get("AWS_S3_ENDPOINT_URL"), aws_cli)
+
+
+if __name__ == "__main__":
+    host = os.environ.get("HOSTNAME") or socket.gethostname()
+
+    parser = argparse.ArgumentParser(description="Incremental backup of the hub volumes")
+    parser.add_argument('--store', help="local directory to store backups in, instead of S3")
+    parser.add_argument('--host', default=host, help="host whose snapshots are restored or listed")
+    parser.add_argument('--state_dir', default=os.environ.get("BACKUP_STATE_DIR", DEFAULT_STATE_DIR)
+                        , help="directory of the local backup state")
+    subparsers = parser.add_subparsers(dest='command')
+    backup_parser = subparsers.add_parser('backup', help='back up new and changed files')
+    backup_parser.add_argument('sources', nargs='+', help='directories to back up')
+    restore_parser = subparsers.add_parser('restore', help='rebuild the files of a snapshot')
+    restore_parser.add_argument('destination', help='directory to restore to')
+    restore_parser.add_argument('--snapshot', help='snapshot to restore (latest by default)')
+    subparsers.add_parser('snapshots', help='list the snapshots of the host')
+    args = parser.parse_args()
+
+    store = create_store(args)
+
+    if args.command == "backup":
+        backup(store, State(args.state_dir), args.sources, args.host, time.strftime("%Y%m%d%H%M%S"))
+
+    elif args.command == "restore":
+        snapshot_name = args.snapshot
+        if snapshot_name is None:
+            snapshots = list_snapshots(store, args.host)
+            if not snapshots:
+                print("No snapshots found for {}".format(args.host))
+                sys.exit(1)
+            snapshot_name = snapshots[-1]
+        restore(store, args.destination, args.host, snapshot_name)
+
+    elif args.command == "snapshots":
+        for snapshot_name in list_snapshots(store, args.host):
+            print(snapshot_name)
@@ -1,5 +1,10 @@
 #!/bin/sh
 cd /
+if [ "$BACKUP_MODE" = "incremental" ]; then
+    echo "uploading new and changed files"
+    python /backup.py backup /data /logs
+    exit $?
+fi
 echo "compressing /data"
 tar -zcf tmp/$HOSTNAME-`date "+%Y%m%d%H%M%S"`_data.tar.gz data
 echo "compressing /logs"
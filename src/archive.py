@@ -0,0 +1,370 @@
+from __future__ import absolute_import, division, print_function
+
+import glob
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+import serializers
+
+SEGMENT_SUFFIX = ".txt.gz"
+MANIFEST_SUFFIX = ".manifest.json"
+TMP_SUFFIX = ".tmp"
+
+COMPRESSION_LEVEL = 6
+COPY_SIZE = 64 * 1024
+
+# badge and timestamp of a record, as written by json.dumps (see _describe)
+_BADGE_RE = re.compile(r'"badge_address": "([^"]*)"')
+_TIMESTAMP_RE = re.compile(r'"timestamp": (-?[0-9][0-9.eE+-]*)')
+
+# file names hold the date/time they were created at (e.g. pending_20170712103000_audio.txt)
+_DATE_RE = re.compile(r"(\d{4})(\d{2})(\d{2})(\d{2})\d{4}")
+
+
+def _describe(line):
+    """
+    Return the badge address and the timestamp of a record, without decoding the whole line
+    :param line: JSON line
+    :return: (badge address, timestamp), None for what the record does not have
+    """
+    badge = _BADGE_RE.search(line)
+    ts = _TIMESTAMP_RE.search(line)
+    if badge is None or ts is None:
+        # not written by json.dumps with the default separators
+        try:
+            data = json.loads(line)['data']
+            return data.get('badge_address'), data.get('timestamp')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None, None
+    try:
+        return badge.group(1), float(ts.group(1))
+    except ValueError:
+        return badge.group(1), None
+
+
+class _CopyingReader(object):
+    """
+    Reads a file and copies every byte read into another file, once and in order (also when the
+    reader seeks back). Lets a serializer read the records of a file while it is being compressed
+    """
+
+    def __init__(self, f, out):
+        self.f = f
+        self.out = out
+        self._copied = 0  # bytes of f copied into out
+
+    def _copy(self, position, data):
+        end = position + len(data)
+        if end > self._copied:
+            self.out.write(data[self._copied - position:])
+            self._copied = end
+
+    def _copy_up_to(self, position):
+        if position > self._copied:
+            self.f.seek(self._copied)
+            self._copy(self._copied, self.f.read(position - self._copied))
+
+    def read(self, size=-1):
+        position = self.f.tell()
+        self._copy_up_to(position)
+        data = self.f.read(size)
+        self._copy(position, data)
+        return data
+
+    def readline(self):
+        position = self.f.tell()
+        self._copy_up_to(position)
+        line = self.f.readline()
+        self._copy(position, line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def seek(self, position, whence=0):
+        if whence == 0:
+            # nothing is skipped
+            self._copy_up_to(position)
+        self.f.seek(position, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def finish(self):
+        """
+        Copies what was not read
+        """
+        self.f.seek(self._copied)
+        for data in iter(lambda: self.f.read(COPY_SIZE), b""):
+            self._copy(self._copied, data)
+
+
+class Archive(object):
+    """
+    Archive of uploaded data, made of one segment per data type and hour, stored in a directory per
+    day (<archive dir>/YYYY-MM-DD/YYYYMMDDHH_<data type>.txt.gz). Every uploaded file is gzip compressed
+    when it is sealed, and appended to the segment of the hour it was created in as a gzip member of
+    its own. Each segment is described by a manifest next to it:
+
+    {"segment": "2017-07-12/2017071210_audio.txt.gz", "data_type": "audio", "badges": ["E8:E3:D9:72:A1:13", ...],
+     "start_ts": 1499855400.0, "end_ts": 1499859000.0, "chunks": 1200, "raw_bytes": 1520000,
+     "compressed_bytes": 260000, "sealed_ts": 1499859010.2,
+     "parts": [{"source": "uploading_20170712103000_audio.txt", "format": "json", "offset": 0,
+                "start_ts": 1499855400.0, "end_ts": 1499859000.0, "chunks": 1200, "raw_bytes": 1520000,
+                "compressed_bytes": 260000, "crc32": 3735928559}, ...]}
+
+    The manifest is updated after every append. Only the first compressed_bytes of a segment are complete,
+    so readers (and backups) can skip anything else. The manifests are read once, the archive keeps an
+    index of them and its size, which sealing and removing segments keep up to date
+    """
+
+    def __init__(self, archive_dir, max_bytes=0, compression_level=COMPRESSION_LEVEL, logger=None):
+        """
+        :param archive_dir: directory of the archive
+        :param max_bytes: the oldest segments are removed once the archive grows over this
+            many (compressed) bytes. 0 keeps everything
+        :param compression_level: gzip compression level of segments
+        :param logger:
+        """
+        self.archive_dir = archive_dir if archive_dir.endswith("/") else archive_dir + "/"
+        self.max_bytes = max_bytes
+        self.compression_level = compression_level
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._index = None  # manifests by segment, read on first use
+        self._size = 0
+
+    def rebuild(self):
+        """
+        Reads the manifests of all segments from disk, and removes the temporary files of seals that did
+        not complete. Must not be called while files are sealed
+        """
+        with self._lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        self._index = {}
+        self._size = 0
+        for manifest_file_name in glob.glob("{}*/*{}".format(self.archive_dir, MANIFEST_SUFFIX)):
+            manifest = self._read_manifest(manifest_file_name)
+            if manifest is not None:
+                self._index[manifest['segment']] = manifest
+                self._size += manifest['compressed_bytes']
+        for tmp_file_name in glob.glob("{}*/*{}".format(self.archive_dir, TMP_SUFFIX)):
+            os.remove(tmp_file_name)
+
+    def _manifests(self):
+        """
+        Return the index of the manifests. Callers must hold _lock
+        """
+        if self._index is None:
+            self._rebuild()
+        return self._index
+
+    def _segment_name(self, file_name, data_type):
+        """
+        Return the name (without suffix) of the segment of the passed file: the segment of its data type,
+        for the hour the file was created in
+        """
+        match = _DATE_RE.search(os.path.basename(file_name))
+        if match:
+            year, month, day, hour = match.groups()
+        else:
+            year, month, day, hour = time.strftime("%Y %m %d %H").split()
+        return "{0}{1}-{2}-{3}/{1}{2}{3}{4}_{5}".format(self.archive_dir, year, month, day, hour, data_type)
+
+    def _read_manifest(self, manifest_file_name):
+        try:
+            with open(manifest_file_name, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def seal(self, file_name, data_type):
+        """
+        Compresses the passed file, appends it to the segment of its hour, updates the manifest of the
+        segment and removes the file. The file is read once: it is compressed while its records are
+        counted. Sealing a file again after a crash does not append it again
+        :param file_name: pending file, as written by the hub
+        :param data_type: audio or proximity
+        :return: manifest of the segment
+        """
+        name = self._segment_name(file_name, data_type)
+        partition = os.path.dirname(name)
+        with self._lock:
+            # the index is read before anything is compressed, see _rebuild
+            self._manifests()
+            if not os.path.isdir(partition):
+                os.makedirs(partition)
+
+        # compressed outside of the lock, so several files can be sealed at once
+        tmp_file_name = "{}/{}{}".format(partition, os.path.basename(file_name), TMP_SUFFIX)
+        try:
+            part, badges = self._compress(file_name, tmp_file_name)
+            with self._lock:
+                manifest = self._append(name, data_type, tmp_file_name, part, badges)
+        finally:
+            if os.path.exists(tmp_file_name):
+                os.remove(tmp_file_name)
+        os.remove(file_name)
+
+        if self.logger:
+            self.logger.debug("Archived {} into {} ({} -> {} bytes)".format(
+                file_name, manifest['segment'], part['raw_bytes'], part['compressed_bytes']))
+        return manifest
+
+    def _compress(self, file_name, tmp_file_name):
+        """
+        Compresses the passed file into a gzip member
+        :return: (part, badges), the description of the member (without its offset) and the badges of its records
+        """
+        badges = set()
+        start_ts = None
+        end_ts = None
+        chunks = 0
+
+        with open(file_name, "rb") as fin, open(tmp_file_name, "wb") as fout:
+            gz = gzip.GzipFile(os.path.basename(file_name), "wb", self.compression_level, fout)
+            reader = _CopyingReader(fin, gz)
+            serializer = serializers.detect(reader)
+            for line, end in serializer.records(reader):
+                chunks += 1
+                badge, ts = _describe(line)
+                if badge is not None:
+                    badges.add(badge)
+                if ts is not None:
+                    start_ts = ts if start_ts is None else min(start_ts, ts)
+                    end_ts = ts if end_ts is None else max(end_ts, ts)
+            reader.finish()
+            raw_bytes = os.fstat(fin.fileno()).st_size
+            crc32 = gz.crc & 0xffffffff
+            gz.close()
+
+        part = {
+            'source': os.path.basename(file_name),
+            'format': serializer.name,
+            'start_ts': start_ts,
+            'end_ts': end_ts,
+            'chunks': chunks,
+            'raw_bytes': raw_bytes,
+            'crc32': crc32,
+            'compressed_bytes': os.path.getsize(tmp_file_name),
+        }
+        return part, badges
+
+    def _append(self, name, data_type, tmp_file_name, part, badges):
+        """
+        Appends a compressed file to the passed segment and updates its manifest. Callers must hold _lock
+        :return: manifest of the segment
+        """
+        segment = os.path.relpath(name + SEGMENT_SUFFIX, self.archive_dir)
+        manifest = self._manifests().get(segment)
+        if manifest is None:
+            manifest = {'segment': segment, 'data_type': data_type, 'badges': [], 'start_ts': None, 'end_ts': None,
+                        'chunks': 0, 'raw_bytes': 0, 'compressed_bytes': 0, 'parts': []}
+        elif any(p['source'] == part['source'] and p['raw_bytes'] == part['raw_bytes'] and
+                 p['crc32'] == part['crc32'] for p in manifest['parts']):
+            # sealed before a crash, which happened before the file was removed
+            return manifest
+
+        with open(name + SEGMENT_SUFFIX, "ab") as f:
+            # drop what an append that did not complete left behind
+            f.truncate(manifest['compressed_bytes'])
+            with open(tmp_file_name, "rb") as fin:
+                shutil.copyfileobj(fin, f, COPY_SIZE)
+            f.flush()
+            os.fsync(f.fileno())
+
+        part = dict(part, offset=manifest['compressed_bytes'])
+        timestamps = [ts for ts in (manifest['start_ts'], manifest['end_ts'], part['start_ts'], part['end_ts'])
+                      if ts is not None]
+        manifest = dict(manifest,
+                        badges=sorted(set(manifest['badges']) | badges),
+                        start_ts=min(timestamps) if timestamps else None,
+                        end_ts=max(timestamps) if timestamps else None,
+                        chunks=manifest['chunks'] + part['chunks'],
+                        raw_bytes=manifest['raw_bytes'] + part['raw_bytes'],
+                        compressed_bytes=manifest['compressed_bytes'] + part['compressed_bytes'],
+                        sealed_ts=round(time.time(), 3),
+                        parts=manifest['parts'] + [part])
+
+        # the part is complete once the manifest lists it
+        with open(name + MANIFEST_SUFFIX + TMP_SUFFIX, "w") as f:
+            json.dump(manifest, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(name + MANIFEST_SUFFIX + TMP_SUFFIX, name + MANIFEST_SUFFIX)
+
+        self._index[segment] = manifest
+        self._size += part['compressed_bytes']
+        return manifest
+
+    def segments(self, sealed_after=None):
+        """
+        Return the manifests of the segments, oldest first
+        :param sealed_after: only return segments a file was appended to after this time
+        """
+        with self._lock:
+            manifests = self._manifests().values()
+        if sealed_after is not None:
+            manifests = [m for m in manifests if m['sealed_ts'] > sealed_after]
+        return sorted(manifests, key=lambda m: m['segment'])
+
+    def read_segment(self, manifest):
+        """
+        Return the records of the passed segment, as JSON lines (whatever the format of its parts)
+        """
+        with open(self.archive_dir + manifest['segment'], "rb") as f:
+            for part in manifest['parts']:
+                f.seek(part['offset'])
+                with gzip.GzipFile(fileobj=io.BytesIO(f.read(part['compressed_bytes']))) as gz:
+                    for line, end in serializers.detect(gz).records(gz):
+                        yield line
+
+    def size(self):
+        """
+        Return the number of (compressed) bytes in the archive
+        """
+        with self._lock:
+            self._manifests()
+            return self._size
+
+    def remove_segment(self, manifest):
+        """
+        Removes the passed segment, and its directory once it is empty
+        """
+        name = self.archive_dir + manifest['segment'][:-len(SEGMENT_SUFFIX)]
+        with self._lock:
+            os.remove(name + MANIFEST_SUFFIX)
+            os.remove(name + SEGMENT_SUFFIX)
+            partition = os.path.dirname(name)
+            if not os.listdir(partition):
+                shutil.rmtree(partition)
+            removed = self._manifests().pop(manifest['segment'], None)
+            if removed is not None:
+                self._size -= removed['compressed_bytes']
+
+    def enforce_retention(self):
+        """
+        Removes the oldest segments until the archive fits into max_bytes
+        :return: number of removed segments
+        """
+        if not self.max_bytes or self.size() <= self.max_bytes:
+            return 0
+
+        removed = 0
+        for manifest in self.segments():
+            if self.size() <= self.max_bytes:
+                break
+            self.remove_segment(manifest)
+            removed += 1
+
+        if removed and self.logger:
+            self.logger.info("Removed {} archive segments, {} bytes left in archive".format(removed, self.size()))
+        return removed
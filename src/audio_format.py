@@ -0,0 +1,246 @@
+"""
+Binary format of pending audio data
+
+A segment starts with a file header (magic, version), followed by records. Every record
+starts with a record type byte:
+* M (metadata): badge index, then the JSON of the badge metadata (badge_address, member, member_id).
+  Written once per badge and segment, before the first chunk of that badge
+* A (audio chunk): badge index, timestamp, log_timestamp, voltage, log_index, sample_period,
+  num_samples and the samples as raw uint8
+* J (JSON): length, then a JSON-lines record that does not fit the audio chunk layout, so
+  conversions are always lossless
+
+All numbers are little-endian. Floats are stored as doubles, so values are kept exactly
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import struct
+
+MAGIC = b"OBAU"
+VERSION = 1
+
+RECORD_METADATA = b"M"
+RECORD_AUDIO = b"A"
+RECORD_JSON = b"J"
+
+AUDIO_TYPE = "audio received"
+METADATA_KEYS = ('badge_address', 'member', 'member_id')
+CHUNK_KEYS = ('voltage', 'timestamp', 'sample_period', 'num_samples', 'samples') + METADATA_KEYS
+
+_FILE_HEADER = struct.Struct("<4sB3x")
+_RECORD_TYPE = struct.Struct("<c")
+_METADATA = struct.Struct("<HI")
+# badge index, timestamp, log_timestamp, voltage, log_index, sample_period, num_samples, len(samples)
+_CHUNK = struct.Struct("<HdddiHHH")
+_JSON = struct.Struct("<I")
+
+
+class FormatError(Exception):
+    """
+    Raised when a segment is not in the expected format, or is corrupt (e.g. truncated)
+    """
+    pass
+
+
+def file_header():
+    """
+    Return the header every binary segment starts with
+    """
+    return _FILE_HEADER.pack(MAGIC, VERSION)
+
+
+def is_binary(header):
+    """
+    Return True if the passed first bytes of a segment are a binary audio header
+    """
+    return header[:len(MAGIC)] == MAGIC
+
+
+def _is_chunk(log_line):
+    """
+    Return True if the passed log line can be stored as an audio chunk record, without losing anything
+    """
+    data = log_line.get('data')
+    if set(log_line) != set(('type', 'log_timestamp', 'log_index', 'data')) \
+            or log_line['type'] != AUDIO_TYPE or not isinstance(data, dict) or set(data) != set(CHUNK_KEYS):
+        return False
+    if not all(isinstance(v, float) for v in (log_line['log_timestamp'], data['timestamp'], data['voltage'])):
+        return False
+    if not all(isinstance(v, int) and not isinstance(v, bool)
+               for v in (log_line['log_index'], data['sample_period'], data['num_samples'])):
+        return False
+    return isinstance(data['samples'], list)
+
+
+class Encoder(object):
+    """
+    Encodes the log lines of one segment. Badge metadata is only written once per segment
+    """
+
+    def __init__(self):
+        self._badges = {}  # metadata -> badge index
+
+    def encode(self, log_line):
+        """
+        :param log_line: log line, as written to JSON-lines pending files
+        :return: bytes of the record(s)
+        """
+        if not _is_chunk(log_line):
+            return self._encode_json(log_line)
+
+        data = log_line['data']
+        try:
+            samples = bytes(bytearray(data['samples']))
+        except (ValueError, TypeError):
+            # not uint8 samples
+            return self._encode_json(log_line)
+
+        metadata = tuple(data[key] for key in METADATA_KEYS)
+        records = b""
+        badge_index = self._badges.get(metadata)
+        if badge_index is None:
+            badge_index = len(self._badges)
+            self._badges[metadata] = badge_index
+            metadata_json = json.dumps(metadata)
+            records = RECORD_METADATA + _METADATA.pack(badge_index, len(metadata_json)) + metadata_json
+
+        try:
+            header = _CHUNK.pack(badge_index, data['timestamp'], log_line['log_timestamp'], data['voltage'],
+                                 log_line['log_index'], data['sample_period'], data['num_samples'],
+                                 len(samples))
+        except struct.error:
+            # out of range for the chunk layout
+            return records + self._encode_json(log_line)
+
+        return records + RECORD_AUDIO + header + samples
+
+    def _encode_json(self, log_line):
+        line = json.dumps(log_line)
+        return RECORD_JSON + _JSON.pack(len(line)) + line
+
+
+def _read(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise FormatError("Truncated record at {}".format(f.tell()))
+    return data
+
+
+def decode(f):
+    """
+    Decodes a binary segment
+    :param f: open file, at the start of the segment
+    :return: generator of log lines
+    """
+    for log_line, end in decode_records(f):
+        yield log_line
+
+
+def decode_records(f, offset=0, badges=None):
+    """
+    Decodes a binary segment, keeping track of the position of the records
+    :param f: open file, at the start of the segment
+    :param offset: position of the record decoding starts at. The metadata of the badges of the following
+        chunks that was written before it must be passed in badges
+    :param badges: dict of the badge metadata by badge index. Filled with the metadata records read
+    :return: generator of (log line, offset) tuples, where offset is the position in the file
+        right after the record
+    """
+    header = f.read(_FILE_HEADER.size)
+    if len(header) != _FILE_HEADER.size or not is_binary(header):
+        raise FormatError("Not a binary audio segment")
+    magic, version = _FILE_HEADER.unpack(header)
+    if version != VERSION:
+        raise FormatError("Unsupported version: {}".format(version))
+
+    if badges is None:
+        badges = {}
+    if offset > _FILE_HEADER.size:
+        f.seek(offset)
+
+    while True:
+        record_type = f.read(_RECORD_TYPE.size)
+        if not record_type:
+            return
+
+        if record_type == RECORD_METADATA:
+            badge_index, length = _METADATA.unpack(_read(f, _METADATA.size))
+            badges[badge_index] = dict(zip(METADATA_KEYS, json.loads(_read(f, length))))
+
+        elif record_type == RECORD_AUDIO:
+            badge_index, ts, log_ts, voltage, log_index, sample_period, num_samples, length = \
+                _CHUNK.unpack(_read(f, _CHUNK.size))
+            if badge_index not in badges:
+                raise FormatError("Chunk of undefined badge {} at {}".format(badge_index, f.tell()))
+            data = {
+                'voltage': voltage,
+                'timestamp': ts,
+                'sample_period': sample_period,
+                'num_samples': num_samples,
+                'samples': list(bytearray(_read(f, length))),
+            }
+            data.update(badges[badge_index])
+            yield {
+                'type': AUDIO_TYPE,
+                'log_timestamp': log_ts,
+                'log_index': log_index,
+                'data': data,
+            }, f.tell()
+
+        elif record_type == RECORD_JSON:
+            length, = _JSON.unpack(_read(f, _JSON.size))
+            try:
+                log_line = json.loads(_read(f, length))
+            except ValueError:
+                raise FormatError("Invalid JSON record at {}".format(f.tell()))
+            yield log_line, f.tell()
+
+        else:
+            raise FormatError("Unknown record type {!r} at {}".format(record_type, f.tell() - 1))
+
+
+def json_lines_to_binary(fin, fout):
+    """
+    Converts a JSON-lines audio file to the binary format
+    :return: number of converted log lines
+    """
+    encoder = Encoder()
+    fout.write(file_header())
+    count = 0
+    for line in fin:
+        if not line.strip():
+            continue
+        fout.write(encoder.encode(json.loads(line)))
+        count += 1
+    return count
+
+
+def binary_to_json_lines(fin, fout):
+    """
+    Converts a binary audio file to JSON-lines
+    :return: number of converted log lines
+    """
+    count = 0
+    for log_line in decode(fin):
+        json.dump(log_line, fout)
+        fout.write('\n')
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert audio files between JSON-lines and the binary format")
+    parser.add_argument('direction', choices=('to-binary', 'to-json'))
+    parser.add_argument('source')
+    parser.add_argument('destination')
+    args = parser.parse_args()
+
+    with open(args.source, "rb") as fin, open(args.destination, "wb") as fout:
+        if args.direction == "to-binary":
+            count = json_lines_to_binary(fin, fout)
+        else:
+            count = binary_to_json_lines(fin, fout)
+    print("Converted {} records".format(count))
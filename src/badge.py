@@ -10,19 +10,30 @@ from nrf import Nrf, SimpleDelegate
 import logging.handlers
 
 from badge_dialogue import BadgeDialogue
+from deadline import Deadline, TimeoutError
 
 import struct
+from collections import deque
 from math import floor
 import datetime
-import signal
 import traceback
 import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 WAIT_FOR = 1.0  # timeout for WaitForNotification calls.  Must be > samplePeriod of badge
 PULL_WAIT = 2
 
 RECORDING_TIMEOUT = 3*60 # minutes
 
+# Deadlines (in seconds) for the different phases of a badge session
+CONNECT_TIMEOUT = 5.0
+STATUS_TIMEOUT = 5.0   # status request / response
+COMMAND_TIMEOUT = 5.0  # start recording / start scan acknowledgements
+
 # Scan settings. See documentation for more details
 SCAN_WINDOW = 100
 SCAN_INTERVAL = 300
@@ -30,103 +41,156 @@ SCAN_DURATION = 3 # how long each scan lasts
 SCAN_PERIOD = 15 # how often to run a scan
 
 
-class TimeoutError(Exception):
-    """
-    # Raises a timeout exception if a function takes too long
-    # http://stackoverflow.com/questions/2281850/timeout-function-if-it-takes-too-long-to-finish
-    """
-    pass
-
-
-class timeout:
-    """
-    Or, to use with a "with" statement
-    """
-    def __init__(self, seconds=1, error_message='Timeout'):
-        self.seconds = seconds
-        self.error_message = error_message
-
-    def handle_timeout(self, signum, frame):
-        raise TimeoutError(self.error_message)
+# Layouts of the badge notifications
+STATUS = struct.Struct('<BBBLHf')  # clock set, scanning, recording, timestamp (s), timestamp (ms), voltage
+TIMESTAMP = struct.Struct('<LH')  # timestamp (s), timestamp (ms)
+CHUNK_HEADER = struct.Struct('<LHfHB')  # timestamp (s), timestamp (ms), voltage, sample delay, number of samples
+SCAN_HEADER = struct.Struct('<LfB')  # timestamp (s), voltage, number of devices
+SEEN_DEVICE = struct.Struct('<Hbb')  # ID, rssi, count
 
-    def __enter__(self):
-        signal.signal(signal.SIGALRM, self.handle_timeout)
-        signal.alarm(self.seconds)
-
-    def __exit__(self, type, value, traceback):
-        signal.alarm(0)
+# With NumPy, the devices of a scan are read as a structured array of this type
+SEEN_DEVICE_DTYPE = numpy.dtype([('ID', '<u2'), ('rssi', 'i1'), ('count', 'i1')]) if numpy is not None else None
+USE_NUMPY = numpy is not None
 
 
 class Expect:
     none,status,timestamp,header,samples,scanHeader,scanDevices = range(7)
 
 
-class Chunk():
+class Chunk(object):
     """
     #This class is the contents of one chunk of mic data
+    Samples are kept in a bytearray, allocated once the number of samples is known. A pull
+    can hold tens of thousands of chunks, so instances have no __dict__
     """
+    __slots__ = ('ts', 'fract', 'voltage', 'sampleDelay', 'numSamples', 'samples', 'received')
+
     def __init__(self, header, data):
         self.ts,self.fract,self.voltage,self.sampleDelay,self.numSamples = header
-        self.samples = data[0:]
+        self.samples = bytearray(data)
+        self.received = len(self.samples)
     def setHeader(self,header):
         self.ts,self.fract,self.voltage,self.sampleDelay,self.numSamples = header
+        self.samples = bytearray(self.numSamples or 0)
+        self.received = 0
     def getHeader(self):
         return (self.ts,self.fract,self.voltage,self.sampleDelay,self.numSamples)
     def addData(self,data):
-        self.samples.extend(data)
-        if len(self.samples) > self.numSamples:
+        end = self.received + len(data)
+        if end > self.numSamples:
             print("too many samples received?")
             raise UserWarning("Chunk overflow")
+        self.samples[self.received:end] = data
+        self.received = end
     def reset(self):
         self.ts = None
         self.fract = None
         self.voltage = None
         self.sampleDelay = None
         self.numSamples = None
-        self.samples = []
+        self.samples = bytearray()
+        self.received = 0
     def completed(self):
-        return len(self.samples) >= self.numSamples
+        return self.received >= self.numSamples
 
 
-class SeenDevice():
+class SeenDevice(object):
     """
     Represents an instance of a proximity data for a device found during a scan
     """
+    __slots__ = ('ID', 'rssi', 'count')
+
     def __init__(self,(ID,rssi,count)):
         self.ID = ID
         self.rssi = rssi
         self.count = count
 
 
-class Scan():
+class Scan(object):
     """
-    This class holds the content of one scan record
+    This class holds the content of one scan record. Devices are kept packed (SEEN_DEVICE records)
+    in a bytearray, and only decoded when they are read
     """
+    __slots__ = ('ts', 'voltage', 'numDevices', 'deviceData', 'received')
 
     def __init__(self, header, devices):
-        self.ts, self.voltage, self.numDevices = header
-        self.devices = devices[0:]
+        self.setHeader(header)
+        self.addDevices(devices)
 
     def setHeader(self,header):
         self.ts, self.voltage, self.numDevices = header
+        self.deviceData = bytearray((self.numDevices or 0) * SEEN_DEVICE.size)
+        self.received = 0
 
     def getHeader(self):
         return (self.ts, self.voltage, self.numDevices)
 
     def addDevices(self,devices):
-        self.devices.extend(devices)
-        if len(self.devices) > self.numDevices:
+        self.addDeviceData(b"".join(SEEN_DEVICE.pack(device.ID, device.rssi, device.count) for device in devices))
+
+    def addDeviceData(self, data):
+        """
+        Adds packed (ID, rssi, count) device records
+        """
+        end = self.received + len(data)
+        if end > len(self.deviceData):
             print("too many devices received?")
             raise UserWarning("Chunk overflow")
+        self.deviceData[self.received:end] = data
+        self.received = end
+
+    @property
+    def devices(self):
+        """
+        Devices received so far: a NumPy structured array (SEEN_DEVICE_DTYPE) when NumPy is used,
+        a list of SeenDevice otherwise
+        """
+        data = self.deviceData if self.received == len(self.deviceData) else self.deviceData[:self.received]
+        if USE_NUMPY:
+            return numpy.frombuffer(data, dtype=SEEN_DEVICE_DTYPE)
+        return [SeenDevice(SEEN_DEVICE.unpack_from(data, offset)) for offset in range(0, len(data), SEEN_DEVICE.size)]
+
+    def rssiDistances(self):
+        """
+        Return the devices of the scan as logged: {ID: {'rssi': rssi, 'count': count}}. The log lines and
+        serializers work on this dict, not on the array, so NumPy only speeds up decoding
+        """
+        if USE_NUMPY:
+            # tolist converts the columns to Python ints at once
+            devices = self.devices.tolist()
+        else:
+            devices = (SEEN_DEVICE.unpack_from(self.deviceData, offset)
+                       for offset in range(0, self.received, SEEN_DEVICE.size))
+        return {ID: {'rssi': rssi, 'count': count} for ID, rssi, count in devices}
 
     def reset(self):
         self.ts = None
         self.voltage = None
         self.numDevices = None
-        self.devices = []
+        self.deviceData = bytearray()
+        self.received = 0
 
     def completed(self):
-        return len(self.devices) >= self.numDevices
+        return self.received >= self.numDevices * SEEN_DEVICE.size
+
+
+class DataSink(object):
+    """
+    Receives the chunks and scans of a BadgeDelegate as soon as they are complete, instead of
+    the delegate buffering them for the whole session
+    """
+
+    def addChunk(self, chunk):
+        """
+        :param chunk: complete Chunk. It is not modified by the delegate afterwards
+        """
+        pass
+
+    def addScan(self, scan):
+        """
+        :param scan: complete Scan. It is not modified by the delegate afterwards
+        """
+        pass
 
 
 class BadgeDelegate(DefaultDelegate):
@@ -134,6 +198,11 @@ class BadgeDelegate(DefaultDelegate):
     This class handles incoming data from the badge. It will buffer the
     data so external processes can read from it more easy. Reset will
     delete all buffered data
+
+    With a sink (see DataSink), complete chunks and scans are pushed to it instead of being buffered
+
+    Acknowledgements of pipelined requests are queued with expectAck. While any is outstanding,
+    a notification with the layout of one of them is taken as the first such acknowledgement
     """
     tempChunk = Chunk((None,None,None,None,None),[])
     tempScan = Scan((None, None, None), [])
@@ -159,8 +228,9 @@ class BadgeDelegate(DefaultDelegate):
     project_id = None #project id
     timestamp = None # badge time as timestamp (includes seconds+milliseconds)
 
-    def __init__(self, params):
+    def __init__(self, params, sink=None):
         btle.DefaultDelegate.__init__(self)
+        self.sink = sink
         self.reset()
 
     def reset(self):
@@ -186,24 +256,76 @@ class BadgeDelegate(DefaultDelegate):
 
         self.timestamp = None # badge time as timestamp (includes seconds+milliseconds)
 
+        self.acks = deque()  # outstanding acknowledgements, as (request name, Expect.status or Expect.timestamp)
+        self.acked = set()   # names of the acknowledged requests
+        self.firstDataTime = None  # when the first data (chunk or scan) header was received
+
+    def expectAck(self, name, expected):
+        """
+        Queues the acknowledgement of a request sent without waiting for the previous ones
+        :param name: name of the request, added to self.acked once it is acknowledged
+        :param expected: Expect.status or Expect.timestamp
+        """
+        self.acks.append((name, expected))
+
+    def handleAck(self, data):
+        """
+        Matches a notification with the outstanding acknowledgements, by their layout
+        :return: True if it was an acknowledgement
+        """
+        for ack in self.acks:
+            name, expected = ack
+            if len(data) == (STATUS.size if expected == Expect.status else TIMESTAMP.size):
+                self.acks.remove(ack)
+                if expected == Expect.status:
+                    self.handleStatus(data)
+                else:
+                    self.handleTimestamp(data)
+                self.acked.add(name)
+                return True
+        return False
+
+    def handleStatus(self, data):
+        self.dataReady = True
+        self.clockSet,self.scanning,self.recording,self.timestamp_sec,self.timestamp_ms,self.voltage = STATUS.unpack(data)
+        self.gotStatus = True
+
+    def handleTimestamp(self, data):
+        self.timestamp_sec,self.timestamp_ms = TIMESTAMP.unpack(data)
+        self.gotTimestamp = True
+
+    def saveTempChunk(self):
+        # pass tempChunk to the sink, or add it to list. It is replaced rather than copied
+        if self.sink is not None:
+            self.sink.addChunk(self.tempChunk)
+        else:
+            self.chunks.append(self.tempChunk)
+        self.tempChunk = Chunk((None,None,None,None,None),[])
+
     def saveTempScan(self):
-        # add scan with tempScan's data to list
+        # pass tempScan to the sink, or add it to list. It is replaced rather than copied
         # when a scan completes we always expect another scan header after
-        self.scans.append(Scan(self.tempScan.getHeader(), self.tempScan.devices))
+        if self.sink is not None:
+            self.sink.addScan(self.tempScan)
+        else:
+            self.scans.append(self.tempScan)
+        self.tempScan = Scan((None,None,None),[])
 
     def handleNotification(self, cHandle, data):
+        if self.acks and self.handleAck(data):
+            return
+        if self.firstDataTime is None and self.expected in (Expect.header, Expect.scanHeader):
+            self.firstDataTime = time.time()
+
         if self.expected == Expect.status:  # whether we expect a status packet
-            self.dataReady = True
-            self.clockSet,self.scanning,self.recording,self.timestamp_sec,self.timestamp_ms,self.voltage = struct.unpack('<BBBLHf',data)
-            self.gotStatus = True
+            self.handleStatus(data)
             self.expected = Expect.none
         elif self.expected == Expect.timestamp:
-            self.timestamp_sec,self.timestamp_ms = struct.unpack('<LH',data)
-            self.gotTimestamp = True
+            self.handleTimestamp(data)
             self.expected = Expect.none
         elif self.expected == Expect.header:
             self.tempChunk.reset()
-            self.tempChunk.setHeader(struct.unpack('<LHfHB',data)) #time, fraction time (ms), voltage, sample delay, number of samples
+            self.tempChunk.setHeader(CHUNK_HEADER.unpack(data)) #time, fraction time (ms), voltage, sample delay, number of samples
             if (self.tempChunk.sampleDelay == 0): # got an empty header? done
                 self.gotEndOfData = True
                 self.expected = Expect.none
@@ -213,12 +335,9 @@ class BadgeDelegate(DefaultDelegate):
                 self.expected = Expect.samples
 
         elif self.expected == Expect.samples: # just samples
-            sample_arr = struct.unpack('<%dB' % len(data),data) # Nrfuino bytes are unsigned bytes
-            self.tempChunk.addData(sample_arr)
+            self.tempChunk.addData(data) # Nrfuino bytes are unsigned bytes, copied as they are
             if self.tempChunk.completed():
-                # add chunk with tempChunk's data to list
-                # print self.tempChunk.ts, self.tempChunk.samples
-                self.chunks.append(Chunk(self.tempChunk.getHeader(),self.tempChunk.samples))
+                self.saveTempChunk()
                 self.expected = Expect.header  #we should move on to a new chunk
         elif self.expected == Expect.scanHeader:
             if len(data) == 0:
@@ -231,7 +350,7 @@ class BadgeDelegate(DefaultDelegate):
                 return
 
             self.tempScan.reset()
-            header = struct.unpack('<LfB',data)
+            header = SCAN_HEADER.unpack(data)
             self.tempScan.setHeader(header) #timestamp_sec, voltage, number of devices
             #print self.tempScan.ts
             if (self.tempScan.ts == 0): # got an empty header? done
@@ -251,13 +370,11 @@ class BadgeDelegate(DefaultDelegate):
 
             # is there a reason we do this instead of check the scan header?
             # also should we do some sanity checking?
-            num_devices = int(len(data)/4)
-
-            raw_arr = struct.unpack('<' + num_devices * 'Hbb',data)
+            size = len(data) - len(data) % SEEN_DEVICE.size
+            if size != len(data):
+                data = data[:size]
 
-            tuple_arr = zip(raw_arr[0::3],raw_arr[1::3],raw_arr[2::3])
-            device_arr = [SeenDevice(params) for params in tuple_arr]
-            self.tempScan.addDevices(device_arr)
+            self.tempScan.addDeviceData(data)
             if self.tempScan.completed():
                 # we're done with this, write scan and continue
                 self.saveTempScan()
@@ -273,11 +390,42 @@ class BadgeConnection(Nrf):
     """
     dlg = None
 
-    def __init__(self, periph, dlg):
-        Nrf.__init__(self, periph)
+    def __init__(self, dlg):
+        Nrf.__init__(self)
+        self.setDelegate(dlg)
+
+    def open(self, addr, iface=None):
+        """
+        Connects to the badge and enables notifications
+        :param addr: badge address
+        :param iface: index of the HCI adapter to use. Uses the default adapter if None
+        :return:
+        """
+        self.connect(addr, btle.ADDR_TYPE_RANDOM, iface)
         self.NrfReadWrite.enable()
         self.NrfNotifications.enable()
-        self.setDelegate(dlg)
+
+    def abort(self):
+        """
+        Kills the bluepy helper, so any call blocked on it fails immediately. Safe to call from another thread
+        :return:
+        """
+        helper = self._helper
+        if helper is not None and helper.poll() is None:
+            helper.kill()
+
+    def disconnect(self):
+        helper = self._helper
+        if helper is not None and helper.poll() is not None:
+            # helper is gone (e.g. killed by abort), so there is nothing to disconnect from. Only
+            # clean up what bluepy's _stopHelper would, since writing to the helper would fail
+            self._poller.unregister(helper.stdout)
+            self._helper = None
+            if self._stderr is not None:
+                self._stderr.close()
+                self._stderr = None
+            return
+        Nrf.disconnect(self)
 
     def read(self, fmt):
         d = self.NrfReadWrite.read()
@@ -416,10 +564,22 @@ class Badge:
         self.__last_unsync_ts = init_unsync_ts
         self.__last_seen_ts = init_seen_ts
 
-    def connect(self):
-        self.logger.info("Connecting to {}".format(self.addr))
-        self.dlg = BadgeDelegate(params=1)
-        self.conn = BadgeConnection(self.addr, self.dlg)
+    def connect(self, iface=None, connect_timeout=CONNECT_TIMEOUT, sink=None):
+        """
+        Connects to the badge
+        :param iface: index of the HCI adapter to use (e.g. 1 for hci1). Uses the default adapter if None
+        :param connect_timeout: seconds allowed for connecting. Raises TimeoutError when exceeded
+        :param sink: DataSink received chunks and scans are passed to. They are kept in self.dlg if None
+        :return:
+        """
+        if iface is None:
+            self.logger.info("Connecting to {}".format(self.addr))
+        else:
+            self.logger.info("Connecting to {} using hci{}".format(self.addr, iface))
+        self.dlg = BadgeDelegate(params=1, sink=sink)
+        self.conn = BadgeConnection(self.dlg)
+        with Deadline(connect_timeout, "Connect timeout", on_expire=self.conn.abort):
+            self.conn.open(self.addr, iface)
 
     def disconnect(self):
         if self.conn is not None:
@@ -502,16 +662,17 @@ class Badge:
         """
         retcode = -1
         try:
-            with timeout(seconds=5, error_message="Connect timeout"):
-                self.connect()
+            self.connect()
 
             self.logger.info("Connected")
 
-            with timeout(seconds=5, error_message="Status request timeout (wrong firmware version?)"):
+            with Deadline(STATUS_TIMEOUT, "Status request timeout (wrong firmware version?)",
+                          on_expire=self.conn.abort) as deadline:
                 while not self.dlg.gotStatus:
+                    deadline.check()
                     self.logger.info("Setting Badge id : {} , and project id : {}".format(self.badge_id, self.project_id))
                     self.sendStatusRequest()  # ask for status
-                    self.conn.waitForNotifications(WAIT_FOR)  # waiting for status report
+                    self.conn.waitForNotifications(deadline.remaining(WAIT_FOR))  # waiting for status report
 
                 self.logger.info("Got status")
                 self.sendIdentifyReq(5)
@@ -543,17 +704,18 @@ class Badge:
         """
         retcode = -1
         try:
-            with timeout(seconds=5, error_message="Connect timeout"):
-                self.connect()
+            self.connect()
 
             self.logger.info("Connected")
 
             # Starting audio rec
             self.logger.info("Starting audio recording")
-            with timeout(seconds=5, error_message="StartRec timeout (wrong firmware version?)"):
+            with Deadline(COMMAND_TIMEOUT, "StartRec timeout (wrong firmware version?)",
+                          on_expire=self.conn.abort) as deadline:
                 while not self.dlg.gotTimestamp:
+                    deadline.check()
                     self.sendStartRecRequest(RECORDING_TIMEOUT)  # start recording
-                    self.conn.waitForNotifications(WAIT_FOR)  # waiting for time acknowledgement
+                    self.conn.waitForNotifications(deadline.remaining(WAIT_FOR))  # waiting for time acknowledgement
 
                 self.logger.info("Got time ack")
 
@@ -564,10 +726,12 @@ class Badge:
 
             # Starting scans
             self.logger.info("Starting proximity scans")
-            with timeout(seconds=5, error_message="StartScan timeout (wrong firmware version?)"):
+            with Deadline(COMMAND_TIMEOUT, "StartScan timeout (wrong firmware version?)",
+                          on_expire=self.conn.abort) as deadline:
                 while not self.dlg.gotTimestamp:
+                    deadline.check()
                     self.sendStartScanRequest(RECORDING_TIMEOUT, SCAN_WINDOW, SCAN_INTERVAL, SCAN_DURATION, SCAN_PERIOD)
-                    self.conn.waitForNotifications(WAIT_FOR)  # waiting for time acknowledgement
+                    self.conn.waitForNotifications(deadline.remaining(WAIT_FOR))  # waiting for time acknowledgement
 
                 self.logger.info("Got time ack")
 
@@ -589,57 +753,122 @@ class Badge:
 
         return retcode
 
-    def pull_data(self, activate_audio, activate_proximity):
+    def pipelined_handshake(self, activate_audio, activate_proximity, status_timeout=STATUS_TIMEOUT):
+        """
+        Sends the status request and the start recording / start scan requests back to back, and waits
+        for their acknowledgements together, instead of one round trip per request. Requests that are
+        not acknowledged within WAIT_FOR are sent again. Acknowledgements of the start requests look
+        the same, so when one of them is missing, both are sent again
+        :param status_timeout: seconds allowed for all the requests to be acknowledged
+        """
+        requests = [("status", Expect.status, self.sendStatusRequest)]
+        if activate_audio:
+            requests.append(("start recording", Expect.timestamp,
+                             lambda: self.sendStartRecRequest(RECORDING_TIMEOUT)))
+        if activate_proximity:
+            requests.append(("start scan", Expect.timestamp,
+                             lambda: self.sendStartScanRequest(RECORDING_TIMEOUT, SCAN_WINDOW, SCAN_INTERVAL,
+                                                               SCAN_DURATION, SCAN_PERIOD)))
+
+        self.logger.info("Sending {} requests (Badge id : {} , project id : {})".format(
+            ", ".join(name for name, expected, send in requests), self.badge_id, self.project_id))
+        with Deadline(status_timeout, "Handshake timeout (wrong firmware version?)",
+                      on_expire=self.conn.abort) as deadline:
+            while True:
+                missing = set(expected for name, expected, send in requests if name not in self.dlg.acked)
+                if not missing:
+                    break
+                deadline.check()
+
+                pending = [request for request in requests if request[1] in missing]
+                self.dlg.acked.difference_update(name for name, expected, send in pending)
+
+                self.dlg.acks.clear()
+                for name, expected, send in pending:
+                    # queued first, bluepy may deliver the acknowledgement while the request is written
+                    self.dlg.expectAck(name, expected)
+                    send()
+                # acknowledgements are matched by the queue, not by what was sent last
+                self.dlg.expected = Expect.none
+
+                while self.dlg.acks and self.conn.waitForNotifications(deadline.remaining(WAIT_FOR)):
+                    pass
+
+            self.logger.info("Got acks")
+
+        # got status back - check if the badge was synced or not
+        self.check_if_synced()
+
+    def pull_data(self, activate_audio, activate_proximity, iface=None,
+                  connect_timeout=CONNECT_TIMEOUT, status_timeout=STATUS_TIMEOUT, sink=None, pipelined=False):
         """
         Attempts to read data from the device
+        :param iface: index of the HCI adapter to use. Uses the default adapter if None
+        :param connect_timeout: seconds allowed for connecting
+        :param status_timeout: seconds allowed for the status request
+        :param sink: DataSink chunks and scans are passed to as they are received. Without one, they are
+            kept in self.dlg.chunks and self.dlg.scans until the end of the session
+        :param pipelined: send the status and start requests back to back (see pipelined_handshake)
         """
         retcode = -1
+        start_time = time.time()
         try:
-            with timeout(seconds=5, error_message="Connect timeout"):
-                self.connect()
+            self.connect(iface, connect_timeout, sink)
 
             self.logger.info("Connected")
             self.last_contacted_ts=time.time()
+            connect_time = self.last_contacted_ts
 
-            # Sending status (and setting ids)
-            self.logger.info("Sending status request (Badge id : {} , project id : {})".format(self.badge_id, self.project_id))
-            with timeout(seconds=5, error_message="StartusRequest timeout (wrong firmware version?)"):
-                while not self.dlg.gotStatus:
-                    self.sendStatusRequest()  # start recording
-                    self.conn.waitForNotifications(WAIT_FOR)  # waiting for time acknowledgement
+            if pipelined:
+                self.pipelined_handshake(activate_audio, activate_proximity, status_timeout)
+            else:
+                # Sending status (and setting ids)
+                self.logger.info("Sending status request (Badge id : {} , project id : {})".format(self.badge_id, self.project_id))
+                with Deadline(status_timeout, "StartusRequest timeout (wrong firmware version?)",
+                              on_expire=self.conn.abort) as deadline:
+                    while not self.dlg.gotStatus:
+                        deadline.check()
+                        self.sendStatusRequest()  # start recording
+                        self.conn.waitForNotifications(deadline.remaining(WAIT_FOR))  # waiting for time acknowledgement
 
-                self.logger.info("Got time ack")
+                    self.logger.info("Got time ack")
 
-                # got status back - check if the badge was synced or not
-                self.check_if_synced()
+                    # got status back - check if the badge was synced or not
+                    self.check_if_synced()
 
 
-            if activate_audio:
-                # Starting audio rec
-                self.logger.info("Starting audio recording")
-                with timeout(seconds=5, error_message="StartRec timeout (wrong firmware version?)"):
-                    while not self.dlg.gotTimestamp:
-                        self.sendStartRecRequest(RECORDING_TIMEOUT)  # start recording
-                        self.conn.waitForNotifications(WAIT_FOR)  # waiting for time acknowledgement
+                if activate_audio:
+                    # Starting audio rec
+                    self.logger.info("Starting audio recording")
+                    with Deadline(COMMAND_TIMEOUT, "StartRec timeout (wrong firmware version?)",
+                                  on_expire=self.conn.abort) as deadline:
+                        while not self.dlg.gotTimestamp:
+                            deadline.check()
+                            self.sendStartRecRequest(RECORDING_TIMEOUT)  # start recording
+                            self.conn.waitForNotifications(deadline.remaining(WAIT_FOR))  # waiting for time acknowledgement
 
-                    self.logger.info("Got time ack")
+                        self.logger.info("Got time ack")
 
-                    self.logger.info("Badge datetime was: {},{}".format(self.dlg.timestamp_sec, self.dlg.timestamp_ms))
+                        self.logger.info("Badge datetime was: {},{}".format(self.dlg.timestamp_sec, self.dlg.timestamp_ms))
 
-            # Reset flag (hacky)
-            self.dlg.gotTimestamp = False
+                # Reset flag (hacky)
+                self.dlg.gotTimestamp = False
 
-            if activate_proximity:
-                # Starting scans
-                self.logger.info("Starting proximity scans")
-                with timeout(seconds=5, error_message="StartScan timeout (wrong firmware version?)"):
-                    while not self.dlg.gotTimestamp:
-                        self.sendStartScanRequest(RECORDING_TIMEOUT, SCAN_WINDOW, SCAN_INTERVAL, SCAN_DURATION, SCAN_PERIOD)
-                        self.conn.waitForNotifications(WAIT_FOR)  # waiting for time acknowledgement
+                if activate_proximity:
+                    # Starting scans
+                    self.logger.info("Starting proximity scans")
+                    with Deadline(COMMAND_TIMEOUT, "StartScan timeout (wrong firmware version?)",
+                                  on_expire=self.conn.abort) as deadline:
+                        while not self.dlg.gotTimestamp:
+                            deadline.check()
+                            self.sendStartScanRequest(RECORDING_TIMEOUT, SCAN_WINDOW, SCAN_INTERVAL, SCAN_DURATION, SCAN_PERIOD)
+                            self.conn.waitForNotifications(deadline.remaining(WAIT_FOR))  # waiting for time acknowledgement
 
-                    self.logger.info("Got time ack")
+                        self.logger.info("Got time ack")
 
-                    self.logger.info("Badge datetime was: {},{}".format(self.dlg.timestamp_sec, self.dlg.timestamp_ms))
+                        self.logger.info("Badge datetime was: {},{}".format(self.dlg.timestamp_sec, self.dlg.timestamp_ms))
+
+            handshake_time = time.time()
 
             # audio data data request since time X
             self.logger.info("Requesting data since {} {}".format(self.last_audio_ts_int, self.last_audio_ts_fract))
@@ -674,6 +903,10 @@ class Badge:
                 if wait_count >= PULL_WAIT: break
             self.logger.info("finished reading data")
 
+            if self.dlg.firstDataTime is not None:
+                self.logger.info("Connect to data: {:.2f}s (connect {:.2f}s, handshake {:.2f}s)".format(
+                    self.dlg.firstDataTime - start_time, connect_time - start_time, handshake_time - connect_time))
+
             retcode = 0
 
         except BTLEException, e:
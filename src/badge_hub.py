@@ -12,11 +12,12 @@ import csv
 import logging
 import json
 import time
-from datetime import datetime as dt
 from requests.exceptions import RequestException
 import glob
 import traceback
 import random
+import threading
+import atexit
 
 from badge import *
 from badge_discoverer import BadgeDiscoverer, BeaconDiscoverer
@@ -25,14 +26,24 @@ from beacon_manager_server import BeaconManagerServer
 from badge_manager_standalone import BadgeManagerStandalone
 from beacon_manager_standalone import BeaconManagerStandalone
 import hub_manager 
-from settings import DATA_DIR, LOG_DIR
+from worker_pool import WorkerPool
+from archive import Archive
+from audio_format import FormatError
+from pending import PendingSegments, SegmentWriter, DURABILITY_POLICIES, FLUSH_BADGE, FLUSH_SEGMENT
+import serializers
+from settings import DATA_DIR, LOG_DIR, ARCHIVE_MAX_BYTES, PENDING_FILE_MAX_AGE
 
 log_file_name = LOG_DIR + 'hub.log'
 scans_file_name = DATA_DIR + 'scan.txt'
 
 pending_file_prefix = DATA_DIR + 'pending_'
-audio_archive_file_name = DATA_DIR + 'audio_archive.txt'
-proximity_archive_file_name = DATA_DIR + 'proximity_archive.txt'
+uploading_file_prefix = DATA_DIR + 'uploading_'
+# upload checkpoints are kept next to the uploading files, with this suffix
+CURSOR_SUFFIX = '.offset'
+# uploaded files are sealed into compressed segments in the archive directory
+archive_dir = DATA_DIR + 'archive/'
+# claimed files that cannot be read are moved here
+corrupt_dir = DATA_DIR + 'corrupt/'
 
 standalone_audio_file = DATA_DIR + 'audio_data.txt'
 standalone_proximity_file = DATA_DIR + 'proximity_data.txt'
@@ -45,6 +56,18 @@ SCAN_DURATION = 3  # seconds
 #NOTE try to keep under 100MB or so due to memory constraints
 MAX_PENDING_FILE_SIZE = 15000000 # in bytes, so 15MB
 
+# pending files are uploaded in batches of (at most) this many bytes, so memory use
+# while offloading does not depend on the size of the file
+UPLOAD_BATCH_SIZE = 1000000 # in bytes, so 1MB
+
+UPLOAD_WORKERS = 2  # files uploaded concurrently
+UPLOAD_INTERVAL = 10  # seconds between checks for pending files
+
+HCI_DEVICES_DIR = "/sys/class/bluetooth"
+
+# guards pending/data files when several adapters pull in parallel
+_storage_lock = threading.Lock()
+
 # create logger with 'badge_server'
 logger = logging.getLogger('badge_server')
 logger.setLevel(logging.DEBUG)
@@ -67,9 +90,18 @@ ch.setFormatter(formatter)
 logger.addHandler(fh)
 logger.addHandler(ch)
 
+archive = Archive(archive_dir, ARCHIVE_MAX_BYTES, logger=logger)
+pending = PendingSegments(pending_file_prefix, MAX_PENDING_FILE_SIZE, PENDING_FILE_MAX_AGE, logger=logger)
+
+# durability policy of the data writers (see pending.SegmentWriter)
+durability = FLUSH_BADGE
+# serializer of the data files, per data type (see serializers)
+data_serializers = {AUDIO: serializers.JSON, PROXIMITY: serializers.JSON}
+_writers = {}
+
 
 def round_float_for_log(x):
-    return float("{0:.3f}".format(x))
+    return round(x, 3)
 
 
 def has_chunks(filename):
@@ -79,65 +111,254 @@ def has_chunks(filename):
     return os.path.exists(filename) and os.path.getsize(filename) > 0
 
 
-def offload_data():
+def read_batches(pending_file, max_bytes=UPLOAD_BATCH_SIZE, offset=0, serializer=None, state=None):
     """
-    Send pending files to server and move pending to archive
-    
+    Reads the records of a pending file in batches of JSON lines. JSON-lines files are read
+    without decoding them
+    :param pending_file: open file
+    :param max_bytes: maximal size of a batch. A single line larger than that is sent on its own
+    :param offset: position in the file where reading starts
+    :param serializer: serializer of the file (see serializers.detect). None for JSON-lines
+        read from the current position
+    :param state: resume state of the serializer, kept along with the offset (see serializers)
+    :return: generator of (lines, offset) tuples, where offset is the position in the file
+        right after the last record of the batch
+    """
+    if serializer is None:
+        records = serializers.read_lines(pending_file, offset)
+    else:
+        records = serializer.records(pending_file, offset, state)
+
+    batch = []
+    batch_size = 0
+    batch_end = offset
+    for line, end in records:
+        if batch and batch_size + len(line) > max_bytes:
+            yield batch, batch_end
+            batch = []
+            batch_size = 0
+        batch.append(line)
+        batch_size += len(line)
+        batch_end = end
+
+    if batch:
+        yield batch, batch_end
+
+
+def get_cursor_name(uploading_file_name):
+    """
+    Return the name of the file holding the upload checkpoint of the passed file
+    """
+    return uploading_file_name + CURSOR_SUFFIX
+
+
+def read_cursor(uploading_file_name):
+    """
+    Return the offset up to which the passed file was acknowledged by the server (0 if none)
+    """
+    return read_cursor_state(uploading_file_name)[0]
+
+
+def read_cursor_state(uploading_file_name):
+    """
+    Return the offset up to which the passed file was acknowledged by the server (0 if none), and
+    the resume state of its serializer at that offset (see serializers)
+    """
+    try:
+        with open(get_cursor_name(uploading_file_name), "r") as f:
+            lines = f.read().split("\n", 1)
+        offset = int(lines[0].strip() or 0)
+        state = json.loads(lines[1]) if len(lines) > 1 and lines[1].strip() else {}
+        return offset, state
+    except (IOError, ValueError):
+        return 0, {}
+
+
+def write_cursor(uploading_file_name, offset, state=None):
+    """
+    Checkpoints the offset up to which the passed file was acknowledged by the server, and the
+    resume state of its serializer. The cursor is replaced atomically, so a crash leaves either
+    the old or the new offset
+    """
+    cursor_file_name = get_cursor_name(uploading_file_name)
+    tmp_file_name = cursor_file_name + ".tmp"
+    with open(tmp_file_name, "w") as f:
+        f.write(str(offset))
+        if state:
+            f.write("\n" + json.dumps(state))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_file_name, cursor_file_name)
+
+
+def get_data_type(pending_file_name):
+    """
+    Return the data type of the given pending file, based on its name
+    """
+    return AUDIO if AUDIO in os.path.basename(pending_file_name) else PROXIMITY
+
+
+def claim_pending_files():
+    """
+    Hands the sealed pending files over to the uploader by renaming them. Pending files are
+    sealed when they are full or older than PENDING_FILE_MAX_AGE. Files claimed earlier and not
+    uploaded yet (e.g. after a failure or a restart) are returned as well. Upload cursors of files
+    that are gone are removed
+    :return: sorted list of the claimed file names
+    """
+    with _storage_lock:
+        pending.seal_expired()
+        for writer in _writers.values():
+            if writer.file_name is not None and not pending.is_active(writer.file_name):
+                writer.close()
+
+        # offload_file removes the cursor after sealing the file into the archive. A cursor left behind
+        # by a crash in between must not apply to a file claimed later under the same name
+        for cursor_file_name in glob.glob(uploading_file_prefix + "*" + CURSOR_SUFFIX + "*"):
+            uploading_file_name = cursor_file_name[:cursor_file_name.rindex(CURSOR_SUFFIX)]
+            if not os.path.exists(uploading_file_name):
+                logger.debug("Removing the cursor of {}, which was archived".format(uploading_file_name))
+                os.remove(cursor_file_name)
+
+        # the active pending files are never touched, data is still written to them
+        for pending_file_name in pending.sealed():
+            uploading_file_name = uploading_file_prefix + pending_file_name[len(pending_file_prefix):]
+            # a file with the same name may still be waiting for upload, claim this one next time
+            if has_chunks(pending_file_name) and not os.path.exists(uploading_file_name):
+                os.rename(pending_file_name, uploading_file_name)
+
+    return sorted(name for name in glob.glob(uploading_file_prefix + "*")
+                  if not name.endswith(CURSOR_SUFFIX) and not name.endswith(CURSOR_SUFFIX + ".tmp"))
+
+
+def offload_file(uploading_file_name):
+    """
+    Send a claimed file to server and seal it into the archive. Progress is checkpointed after
+    every acknowledged batch, and a later attempt resumes from the last checkpoint
+
+    Return True on success, False on failure (the file is kept for the next attempt)
+    """
+    data_type = get_data_type(uploading_file_name)
+    file_size = os.path.getsize(uploading_file_name)
+    offset, state = read_cursor_state(uploading_file_name)
+    if offset:
+        logger.debug("Resuming {} from byte {}".format(uploading_file_name, offset))
+    else:
+        logger.debug("Sending {} to server".format(uploading_file_name))
+
+    # fire away!
+    try:
+        chunks_sent = 0
+        with open(uploading_file_name, "rb") as uploading_file:
+            serializer = serializers.detect(uploading_file)
+            for batch, batch_end in read_batches(uploading_file, UPLOAD_BATCH_SIZE, offset, serializer, state):
+                chunks_written = hub_manager.send_serialized_data_to_server(logger, data_type, batch)
+                if chunks_written != len(batch):
+                    # this seems unlikely to happen but is good to keep track of i guess
+                    logger.error("Data mismatch: {} data entries were not written to server"
+                        .format(len(batch) - chunks_written))
+                    logger.error("Error sending data from file {} to server!"
+                        .format(uploading_file_name))
+                    return False
+                chunks_sent += chunks_written
+                write_cursor(uploading_file_name, batch_end, state)
+                logger.debug("{}: {}/{} bytes uploaded".format(
+                    os.path.basename(uploading_file_name), batch_end, file_size))
+
+        logger.debug("Successfully wrote {} data entries to server"
+            .format(chunks_sent))
+
+        # seal into a compressed archive segment, and erase uploaded file
+        archive.seal(uploading_file_name, data_type)
+        if os.path.exists(get_cursor_name(uploading_file_name)):
+            os.remove(get_cursor_name(uploading_file_name))
+    except RequestException as e:
+        s = traceback.format_exc()
+        logger.error("Error sending data from file {} to server!"
+            .format(uploading_file_name))
+        logger.error("{},{}".format(e,s))
+        return False
+    except FormatError as e:
+        # retrying would fail the same way. The records before the corrupt one were sent
+        logger.error("Corrupt data file {}: {}. Moving it to {}".format(uploading_file_name, e, corrupt_dir))
+        quarantine_file(uploading_file_name)
+        return False
+    return True
+
+
+def quarantine_file(uploading_file_name):
+    """
+    Moves a claimed file that cannot be read out of the way of the uploader, into corrupt_dir.
+    Its upload cursor is kept next to it
+    """
+    if not os.path.isdir(corrupt_dir):
+        os.makedirs(corrupt_dir)
+    for file_name in (uploading_file_name, get_cursor_name(uploading_file_name)):
+        if os.path.exists(file_name):
+            os.rename(file_name, corrupt_dir + os.path.basename(file_name))
+
+
+def offload_data(workers=1):
+    """
+    Send pending files to server and move them to archive
+    :param workers: number of files uploaded concurrently
+
     Return True on success, False on failure
     """
     #TODO test with standalone
-    #NOTE not currently doing anything with the True/False
-    # return values, might decide to do something later
-    pending_files = sorted(glob.glob(pending_file_prefix + "*"))
-    for pending_file_name in pending_files:
-        logger.debug("Sending {} to server".format(pending_file_name))
-
-        if not has_chunks(pending_file_name):
-            continue
-
-        chunks = []
-        with open(pending_file_name, "r") as pending_file:
-            for line in pending_file:
-                chunks.append(json.loads(line))
-
-        # real quick grab the data type from the first data entry
-        data_type = "audio" if "audio" in chunks[0]["type"] else "proximity"
-        # fire away!
-        try:
-            chunks_written = hub_manager.send_data_to_server(logger, data_type, chunks)
-            if chunks_written == len(chunks):
-                logger.debug("Successfully wrote {} data entries to server"
-                    .format(len(chunks)))
-            else:
-                # this seems unlikely to happen but is good to keep track of i guess
-                logger.error("Data mismatch: {} data entries were not written to server"
-                    .format(len(chunks) - chunks_written))
-                logger.error("Error sending data from file {} to server!"
-                    .format(pending_file_name))
-                return False
-                
-            # write to archive and erase pending file
-            with open(get_archive_name(data_type), "a") as archive_file:
-                for chunk in chunks:
-                    archive_file.write(json.dumps(chunk) + "\n")
-            os.remove(pending_file_name)
-        except RequestException as e:
-            s = traceback.format_exc()
-            logger.error("Error sending data from file {} to server!"
-                .format(pending_file_name))
-            logger.error("{},{}".format(e,s))
-            return False
-    return True
+    uploading_files = claim_pending_files()
+    if not uploading_files:
+        return True
+
+    start = time.time()
+    results = {}
 
+    def upload(uploading_file_name, worker):
+        results[uploading_file_name] = offload_file(uploading_file_name)
 
-def get_archive_name(data_type):
+    WorkerPool(logger, range(workers), name="upload").run(uploading_files, upload)
+
+    uploaded = [name for name, success in results.items() if success]
+    logger.info("Uploaded {}/{} pending files in {:.1f} seconds"
+        .format(len(uploaded), len(uploading_files), time.time() - start))
+
+    archive.enforce_retention()
+    return len(uploaded) == len(uploading_files)
+
+
+class Uploader(threading.Thread):
     """
-    Return the name of the archive file for the passed data type
+    Uploads pending files in the background, so pulling badges never waits for the server
+    and uploads never wait for the badges
     """
-    if data_type == AUDIO:
-        return audio_archive_file_name
-    else:
-        return proximity_archive_file_name
+
+    def __init__(self, workers=UPLOAD_WORKERS, interval=UPLOAD_INTERVAL):
+        """
+        :param workers: number of files uploaded concurrently
+        :param interval: seconds between checks for new pending files
+        """
+        threading.Thread.__init__(self, name="uploader")
+        self.daemon = True
+        self.workers = workers
+        self.interval = interval
+        self._done = threading.Event()
+
+    def run(self):
+        logger.info("Uploader started ({} workers)".format(self.workers))
+        while not self._done.is_set():
+            try:
+                offload_data(self.workers)
+            except Exception as e:
+                s = traceback.format_exc()
+                logger.error("Uploader error: {},{}".format(e, s))
+            self._done.wait(self.interval)
+
+    def stop(self):
+        """
+        Stops the uploader after the current pass
+        """
+        self._done.set()
+
 
 def get_proximity_name(mode="server"):
     """
@@ -160,17 +381,10 @@ def get_audio_name(mode="server"):
 
 def _get_pending_file_name(data_type):
     """
-    If there are no current pending files < MAX_PENDING_FILE_SIZE in size,
-        return a new pending filename
-    Else, return an existing one.
+    Return the name of the current pending file, or a new one
+    if the current one is >= MAX_PENDING_FILE_SIZE in size
     """
-    filenames = filter(
-            lambda x: os.path.getsize(x) < MAX_PENDING_FILE_SIZE,
-            glob.glob("{}*{}*".format(pending_file_prefix, data_type)))
-    if len(filenames) == 0:
-        return _create_pending_file_name(data_type)
-    else:
-        return filenames[0]
+    return pending.active(data_type)
 
 
 def _create_pending_file_name(data_type):
@@ -179,26 +393,159 @@ def _create_pending_file_name(data_type):
     
     Uses the current date/time to create a unique filename
     """
-    now = dt.now().strftime("%Y%m%d%H%M%S")
-    filename = "{}{}_{}.txt".format(pending_file_prefix, now, data_type)
-    if os.path.exists(filename):
-        # this seems unlikely to happen, but just in case :)
-        # get the number of pending files that match this time and add one
-        files = glob.glob("{}{}*{}*".format(pending_file_prefix, now, data_type))
-        now = '_'.join((now, str(len(files) + 1)))
-        filename =  "{}{}_{}.txt".format(pending_file_prefix, now, data_type)
+    return pending.create_name(data_type)
+
+
+def get_writer(data_type, mode="server"):
+    """
+    Return the long-lived writer of the passed data type, creating it on first use.
+    Callers must hold _storage_lock
+    """
+    key = (data_type, mode)
+    if key not in _writers:
+        if data_type == AUDIO:
+            name_source = lambda: get_audio_name(mode)
+        else:
+            name_source = lambda: get_proximity_name(mode)
+        _writers[key] = SegmentWriter(name_source, durability, logger=logger,
+                                      serializer=serializers.get(data_serializers[data_type]))
+    return _writers[key]
+
+
+def flush_writers():
+    """
+    Writes the buffered data of all writers to the pending files (fsync-ed with the segment policy), which
+    advances the timestamps of the badges it came from (see StorageSink)
+    """
+    with _storage_lock:
+        for writer in _writers.values():
+            writer.flush(sync=writer.policy == FLUSH_SEGMENT)
 
-    return filename 
+
+@atexit.register
+def close_writers():
+    """
+    Flushes and closes the data files. Callers must hold _storage_lock (or be exiting)
+    """
+    for writer in _writers.values():
+        writer.close()
 
      
-def dialogue(bdg, activate_audio, activate_proximity, mode="server"):
+class StorageSink(DataSink):
+    """
+    Writes the chunks and scans of a badge to the pending files as soon as they are received. Memory
+    use does not grow with the backlog of the badge, and a session that breaks off keeps everything
+    received until then.
+
+    The last timestamps of the badge are advanced once a chunk or scan is written to the file, not when
+    it is buffered (see SegmentWriter and --durability). They are sent to the server, so data that is
+    lost with the buffer of the writer is pulled again instead of being skipped
+    """
+
+    def __init__(self, bdg, mode):
+        self.bdg = bdg
+        self.mode = mode
+        self.chunks = 0
+        self.scans = 0
+
+    def addChunk(self, chunk):
+        bdg = self.bdg
+        ts_with_ms = round_float_for_log(ts_and_fract_to_float(chunk.ts, chunk.fract))
+        log_line = {
+            'type': "audio received",
+            'log_timestamp': round_float_for_log(time.time()),
+            'log_index': -1,  # need to find a good accumulator.
+            'data': {
+                'voltage': round_float_for_log(chunk.voltage),
+                'timestamp': ts_with_ms,
+                'sample_period': chunk.sampleDelay,
+                'num_samples': len(chunk.samples),
+                'samples': list(chunk.samples),
+                'badge_address': bdg.addr,
+                'member': bdg.key,
+                'member_id':bdg.badge_id
+            }
+        }
+
+        logger.debug("Chunk timestamp: {0:.3f}, Voltage: {1:.3f}, Delay: {2}, Samples in chunk: {3}".format(
+            ts_with_ms, chunk.voltage, chunk.sampleDelay, len(chunk.samples)))
+
+        # store in the data file
+        # once the chunk is stored, it does not need to be pulled again
+        def stored(ts=chunk.ts, fract=chunk.fract):
+            if bdg.is_newer_audio_ts(ts, fract):
+                bdg.set_audio_ts(ts, fract)
+
+        with _storage_lock:
+            get_writer(AUDIO, self.mode).write([log_line], on_flush=stored)
+        self.chunks += 1
+
+    def end_of_badge(self):
+        """
+        Called once the session with the badge is over. With the badge policy, its data is written to
+        the pending files, which advances its timestamps
+        """
+        with _storage_lock:
+            for data_type in (AUDIO, PROXIMITY):
+                get_writer(data_type, self.mode).end_of_badge()
+
+    def addScan(self, scan):
+        bdg = self.bdg
+        ts_with_ms = round_float_for_log(scan.ts)
+        log_line = {
+            'type': "proximity received",
+            'log_timestamp': round_float_for_log(time.time()),
+            'log_index': -1,  # need to find a good accumulator.
+            'data': {
+                'voltage': round_float_for_log(scan.voltage),
+                'timestamp': ts_with_ms,
+                'badge_address': bdg.addr,
+                'rssi_distances': scan.rssiDistances(),
+                'member': bdg.key,
+                'member_id': bdg.badge_id
+            }
+        }
+
+        logger.debug("SCAN: scan timestamp: {0:.3f}, voltage: {1:.3f}, Devices in scan: {2}".format(
+            ts_with_ms, scan.voltage, scan.numDevices))
+
+        def stored(ts=scan.ts):
+            if ts > bdg.last_proximity_ts:
+                bdg.last_proximity_ts = ts
+
+        with _storage_lock:
+            get_writer(PROXIMITY, self.mode).write([log_line], on_flush=stored)
+        self.scans += 1
+
+
+def dialogue(bdg, activate_audio, activate_proximity, mode="server", iface=None,
+             connect_timeout=CONNECT_TIMEOUT, status_timeout=STATUS_TIMEOUT, pipelined=False, adv_payload=None):
     """
     Attempts to read data from the device specified by the address. Reading is handled by gatttool.
+    Data is written to the pending files while it is received (see StorageSink)
     :param bdg:
+    :param iface: index of the HCI adapter to pull with (None for the default one)
+    :param connect_timeout: seconds allowed for connecting to the badge
+    :param status_timeout: seconds allowed for the status request
+    :param pipelined: send the badge requests back to back (see Badge.pipelined_handshake), and do not
+        start recording or scans the advertisement of the badge shows as active already
+    :param adv_payload: advertisement payload of the badge, from the last scan
     :return:
     """
-    ret = bdg.pull_data(activate_audio, activate_proximity)
-    addr = bdg.addr
+    if pipelined and adv_payload is not None:
+        if activate_audio and adv_payload['audio_status']:
+            logger.debug("Audio recording is active already")
+            activate_audio = False
+        if activate_proximity and adv_payload['proximity_status']:
+            logger.debug("Proximity scans are active already")
+            activate_proximity = False
+
+    sink = StorageSink(bdg, mode)
+    try:
+        ret = bdg.pull_data(activate_audio, activate_proximity, iface, connect_timeout, status_timeout, sink,
+                            pipelined)
+    finally:
+        sink.end_of_badge()
     if ret == 0:
         logger.info("Successfully pulled data")
         # if we were able to pull data, we saw the badge again
@@ -206,85 +553,15 @@ def dialogue(bdg, activate_audio, activate_proximity, mode="server"):
     else:
         logger.info("Errors pulling data.")
 
-    if bdg.dlg.chunks:
-        logger.info("Chunks received: {}".format(len(bdg.dlg.chunks)))
-        logger.info("saving chunks to file")
-
-        # store in JSON file
-        with open(get_audio_name(mode), "a") as fout:
-            for chunk in bdg.dlg.chunks:
-                ts_with_ms = round_float_for_log(ts_and_fract_to_float(chunk.ts, chunk.fract))
-                log_line = {
-                    'type': "audio received",
-                    'log_timestamp': round_float_for_log(time.time()),
-                    'log_index': -1,  # need to find a good accumulator.
-                    'data': {
-                        'voltage': round_float_for_log(chunk.voltage),
-                        'timestamp': ts_with_ms,
-                        'sample_period': chunk.sampleDelay,
-                        'num_samples': len(chunk.samples),
-                        'samples': chunk.samples,
-                        'badge_address': addr,
-                        'member': bdg.key,
-                        'member_id':bdg.badge_id
-                    }
-                }
-
-                logger.debug("Chunk timestamp: {0:.3f}, Voltage: {1:.3f}, Delay: {2}, Samples in chunk: {3}".format(
-                    ts_with_ms, chunk.voltage, chunk.sampleDelay, len(chunk.samples)))
-                #logger.debug(json.dumps(log_line))
-                json.dump(log_line, fout)
-                fout.write('\n')
-
-            logger.info("done writing")
-
-        # update badge object to hold latest timestamps
-        last_chunk = bdg.dlg.chunks[-1]
-        if bdg.is_newer_audio_ts(last_chunk.ts, last_chunk.fract):
-            logger.debug("Setting last badge audio timestamp to {} {}".format(last_chunk.ts, last_chunk.fract))
-            bdg.set_audio_ts(last_chunk.ts, last_chunk.fract)
-        else:
-            logger.debug("Keeping existing timestamp ({}.{}) for {}. Last chunk timestamp was: {}.{}"
-                              .format(bdg.last_audio_ts_int,bdg.last_audio_ts_fract,bdg.addr, last_chunk.ts, last_chunk.fract))
-
-
+    if sink.chunks:
+        logger.info("Chunks received: {}".format(sink.chunks))
+        logger.info("Last badge audio timestamp is {} {}".format(bdg.last_audio_ts_int, bdg.last_audio_ts_fract))
     else:
         logger.info("No mic data ready")
 
-    if bdg.dlg.scans:
-        logger.info("Proximity scans received: {}".format(len(bdg.dlg.scans)))
-        logger.info("saving proximity scans to file")
-        with open(get_proximity_name(mode), "a") as fout:
-            for scan in bdg.dlg.scans:
-                ts_with_ms = round_float_for_log(scan.ts)
-                log_line = {
-                    'type': "proximity received",
-                    'log_timestamp': round_float_for_log(time.time()),
-                    'log_index': -1,  # need to find a good accumulator.
-                    'data': {
-                        'voltage': round_float_for_log(scan.voltage),
-                        'timestamp': ts_with_ms,
-                        'badge_address': addr,
-                        'rssi_distances':
-                            {
-                                device.ID: {'rssi': device.rssi, 'count': device.count} for device in scan.devices
-                                },
-                        'member': bdg.key,
-                        'member_id': bdg.badge_id
-                    }
-                }
-
-                logger.debug("SCAN: scan timestamp: {0:.3f}, voltage: {1:.3f}, Devices in scan: {2}".format(
-                    ts_with_ms, scan.voltage, scan.numDevices))
-                #logger.info(json.dumps(log_line))
-
-                json.dump(log_line, fout)
-                fout.write('\n')
-
-        # update badge object to hold latest timestamps
-        last_scan = bdg.dlg.scans[-1]
-        logger.debug("Setting last badge proximity timestamp to {}".format(last_scan.ts))
-        bdg.last_proximity_ts = last_scan.ts
+    if sink.scans:
+        logger.info("Proximity scans received: {}".format(sink.scans))
+        logger.info("Last badge proximity timestamp is {}".format(bdg.last_proximity_ts))
     else:
         logger.info("No proximity scans ready")
 
@@ -349,27 +626,65 @@ def create_beacon_manager_instance(mode,timestamp):
     return mgrb
 
 
-def reset():
+def list_hci_adapters():
+    '''
+    Returns the indexes of the HCI adapters available on this machine (e.g. [0, 1] for hci0 and hci1)
+    :return:
+    '''
+    if not os.path.isdir(HCI_DEVICES_DIR):
+        return []
+
+    adapters = []
+    for name in os.listdir(HCI_DEVICES_DIR):
+        match = re.match(r'^hci(\d+)$', name)
+        if match:
+            adapters.append(int(match.group(1)))
+    return sorted(adapters)
+
+
+def select_adapters(count):
+    '''
+    Picks the adapters used for pulling data
+    :param count: number of adapters to use. 0 means all available adapters
+    :return: list of adapter indexes
+    '''
+    available = list_hci_adapters()
+    if len(available) == 0:
+        logger.warn("Could not list HCI adapters, using hci0")
+        return [0]
+
+    if count == 0:
+        count = len(available)
+    elif count > len(available):
+        logger.warn("Requested {} adapters, but only {} available".format(count, len(available)))
+
+    return available[:count]
+
+
+def reset(adapters=(0,)):
     '''
     Resets and reconfigures Bluetooth parameters. The specific parameters affect connection speed negotiation. It's
     not pretty, but safer to change the conn params this way
+    :param adapters: indexes of the HCI adapters to reset
     :return:
     '''
 
     # Resets BLE hci
     logger.info("Resetting bluetooth")
-    reset_command = "hciconfig hci0 reset"
-    args = shlex.split(reset_command)
-    p = subprocess.Popen(args)
+    for adapter in adapters:
+        reset_command = "hciconfig hci{} reset".format(adapter)
+        args = shlex.split(reset_command)
+        p = subprocess.Popen(args)
 
     # israspberry pi?
     logger.info("Setting bluetooth connection parameters")
     if os.uname()[4][:3] == 'arm':
         logger.info("Raspberry Pi detected, changing bluetooth connection parameters")
-        with open("/sys/kernel/debug/bluetooth/hci0/conn_min_interval", "w") as connparam:
-            connparam.write("16")
-        with open("/sys/kernel/debug/bluetooth/hci0/conn_max_interval", "w") as connparam:
-            connparam.write("17")
+        for adapter in adapters:
+            with open("/sys/kernel/debug/bluetooth/hci{}/conn_min_interval".format(adapter), "w") as connparam:
+                connparam.write("16")
+            with open("/sys/kernel/debug/bluetooth/hci{}/conn_max_interval".format(adapter), "w") as connparam:
+                connparam.write("17")
     else:
         logger.warn("Not a Raspberry Pi, Bluetooth connection parameters remain untouched (communication may be slower)")
 
@@ -409,8 +724,10 @@ def kill_bluepy():
             logger.error(err)
         
 
-def pull_devices(mgr, mgrb, start_recording):
-    logger.info('Started pulling')
+def pull_devices(mgr, mgrb, start_recording, adapters=(0,),
+                 connect_timeout=CONNECT_TIMEOUT, status_timeout=STATUS_TIMEOUT,
+                 upload_workers=UPLOAD_WORKERS, pipelined=False):
+    logger.info('Started pulling (adapters: {})'.format(", ".join("hci{}".format(a) for a in adapters)))
     activate_audio = False
     activate_proximity = False
 
@@ -428,15 +745,36 @@ def pull_devices(mgr, mgrb, start_recording):
     logger.info("Start recording: Audio = {}, Proximity = {}".format(activate_audio,activate_proximity))
     mode = "server" if isinstance(mgr, BadgeManagerServer) else "standalone"
 
+    pool = WorkerPool(logger, adapters, name="hci")
+
+    # pending files are uploaded in the background, so collection never waits for the server
+    if mode == "server":
+        uploader = Uploader(upload_workers)
+        uploader.start()
+
+    def collect(device, iface):
+        # try to update latest badge timestamps from the server
+        mac = device['mac']
+        pull_success = mgr.pull_badge(mac)
+        if not pull_success:
+            logger.warn("""Problem pulling badge from server\n
+                        Skipping badge with mac {} until next full badge list refresh"""
+                        .format(mac))
+            return
+        b = mgr.badges.get(mac)
+        # pull data
+        dialogue(b, activate_audio, activate_proximity, mode, iface, connect_timeout, status_timeout,
+                 pipelined, device['device_info']['adv_payload'])
+
+        # timestamps are sent to the server at the end of the pass, the pull does not wait on it
+        mgr.queue_badge(mac)
+
+        time.sleep(2)  # requires sleep between devices
+
     while True:
         mgr.pull_badges_list()
         mgrb.pull_beacons_list()
 
-        # When we refactor we can change this, but for now:
-        if mode == "server":
-            logger.info("Attempting to offload data to server")
-            offload_data()
-
         logger.info("Scanning for members...")
         scanned_devices = scan_for_devices(mgr.badges.keys())
 
@@ -460,26 +798,24 @@ def pull_devices(mgr, mgrb, start_recording):
 
             b.last_seen_ts = time.time()
 
-            mgr.send_badge(device['mac'])
+            mgr.queue_badge(device['mac'])
 
-        # now the actual data collection 
-        for device in scanned_devices:
-            # try to update latest badge timestamps from the server 
-            mac = device['mac']
-            pull_success = mgr.pull_badge(mac)
-            if not pull_success:
-                logger.warn("""Problem pulling badge from server\n
-                            Skipping badge with mac {} until next full badge list refresh"""
-                            .format(mac))
-                continue
-            b = mgr.badges.get(mac)
-            # pull data
-            dialogue(b, activate_audio, activate_proximity, mode)
-
-            # update timestamps on server
-            mgr.send_badge(mac)
-
-            time.sleep(2)  # requires sleep between devices
+        # the list read at the start of the pass revalidates all badges, so pull_badge does not contact
+        # the server per badge. The voltages and last seen times above are sent with the timestamps at
+        # the end of the pass, one update per badge. Without a list, pull_badge replaces the badges with
+        # their server copy, so they are sent before
+        if not mgr.revalidate_badges():
+            mgr.flush_badges()
+
+        # now the actual data collection. Each adapter takes the next badge
+        # from the shared queue, so badges are pulled in parallel across radios
+        pull_start = time.time()
+        pulled = pool.run(scanned_devices, collect)
+        logger.info("Pulled {} badges in {:.1f} seconds".format(pulled, time.time() - pull_start))
+
+        # update timestamps on server. They only cover stored data, so buffered data is written first
+        flush_writers()
+        mgr.flush_badges()
 
         logger.info("Scanning for beacons...")
         scanned_beacons = scan_for_bc_devices(mgrb.beacons.keys())
@@ -502,7 +838,7 @@ def pull_devices(mgr, mgrb, start_recording):
 
             bcn.last_seen_ts = time.time()
 
-            mgrb.send_beacon(device['mac'])
+            mgrb.queue_beacon(device['mac'])
 
         # Update beacons with wrong id or project id
         for device in scanned_beacons:
@@ -512,10 +848,13 @@ def pull_devices(mgr, mgrb, start_recording):
                 observed_project_id = device['device_info']['adv_payload']['project_id']
                 if bcn.badge_id != observed_id or bcn.project_id != observed_project_id:
                     bcn.sync_timestamp()
-                    mgrb.send_beacon(device['mac'])
+                    mgrb.queue_beacon(device['mac'])
             
             time.sleep(2)
 
+        # voltages, last seen times and synced timestamps, one update per beacon
+        mgrb.flush_beacons()
+
         time.sleep(2)  # allow BLE time to disconnect
 
 
@@ -626,6 +965,39 @@ def add_pull_command_options(subparsers):
                              , choices=('audio', 'proximity', 'both','none'), required=False
                              , default='both'
                              , dest='start_recording',help='data recording option')
+    pull_parser.add_argument('-n','--adapters'
+                             , type=int, required=False, default=1
+                             , dest='adapters'
+                             , help='number of HCI adapters to pull with in parallel (0 for all available)')
+    pull_parser.add_argument('--connect_timeout'
+                             , type=float, required=False, default=CONNECT_TIMEOUT
+                             , dest='connect_timeout', help='seconds allowed for connecting to a badge')
+    pull_parser.add_argument('--status_timeout'
+                             , type=float, required=False, default=STATUS_TIMEOUT
+                             , dest='status_timeout', help='seconds allowed for a badge to answer a status request '
+                                                           '(with --pipelined, to acknowledge all the requests)')
+    pull_parser.add_argument('--durability'
+                             , choices=DURABILITY_POLICIES, required=False, default=FLUSH_BADGE
+                             , dest='durability'
+                             , help='when collected data is written to the pending files: after every chunk and scan '
+                                    '(chunk, nothing is lost if the hub crashes), after every badge (badge, the data '
+                                    'of the badges being pulled is lost), every 64KB (bytes, less than 64KB is lost), '
+                                    'or every 1MB with an fsync (segment, less than 1MB is lost, also on power loss). '
+                                    'Lost data is pulled again. Files are fsync-ed when they are closed')
+    pull_parser.add_argument('--audio_serializer'
+                             , choices=serializers.SERIALIZERS, required=False, default=serializers.JSON
+                             , dest='audio_serializer', help='format of the audio data files')
+    pull_parser.add_argument('--proximity_serializer'
+                             , choices=serializers.SERIALIZERS, required=False, default=serializers.JSON
+                             , dest='proximity_serializer', help='format of the proximity data files')
+    pull_parser.add_argument('--upload_workers'
+                             , type=int, required=False, default=UPLOAD_WORKERS
+                             , dest='upload_workers', help='number of pending files uploaded concurrently (server mode)')
+    pull_parser.add_argument('--pipelined'
+                             , action='store_true', default=False
+                             , dest='pipelined'
+                             , help='send the status and start requests to a badge back to back, and skip starting '
+                                    'recording or scans that the badge advertises as active')
 
 
 def add_scan_command_options(subparsers):
@@ -670,8 +1042,13 @@ if __name__ == "__main__":
     mgr = create_badge_manager_instance(args.hub_mode, args.timestamp)
     mgrb = create_beacon_manager_instance(args.hub_mode, args.timestamp)
 
+    if args.mode == "pull" and args.adapters != 1:
+        adapters = select_adapters(args.adapters)
+    else:
+        adapters = [0]
+
     if not args.disable_reset_ble:
-        reset()
+        reset(adapters)
 
     if args.mode == "sync_all":
         sync_all_devices(mgr)  
@@ -682,7 +1059,15 @@ if __name__ == "__main__":
 
     # pull data from all devices
     if args.mode == "pull":
-        pull_devices(mgr, mgrb, args.start_recording)
+        if args.hub_mode == "server" and not ARCHIVE_MAX_BYTES:
+            logger.warn("ARCHIVE_MAX_BYTES is 0, the archive of uploaded data will grow until the disk is full")
+        durability = args.durability
+        data_serializers = {AUDIO: args.audio_serializer, PROXIMITY: args.proximity_serializer}
+        for name in data_serializers.values():
+            if name == serializers.MSGPACK and serializers.msgpack is None:
+                parser.error("the msgpack serializer requires the msgpack package")
+        pull_devices(mgr, mgrb, args.start_recording, adapters, args.connect_timeout, args.status_timeout,
+                     args.upload_workers, args.pipelined)
 
     if args.mode == "start_all":
         start_all_devices(mgr)
@@ -4,15 +4,23 @@ import time
 
 from badge import *
 from server import BADGE_ENDPOINT, BADGES_ENDPOINT, BEACON_ENDPOINT, BEACONS_ENDPOINT, request_headers
+from server import session, DEFAULT_TIMEOUT, LIST_TIMEOUT
 from settings import APPKEY, HUB_UUID
+from device_sync import ServerList, UpdateQueue
 import traceback
 
 class BadgeManagerServer:
-    DEFAULT_TIMEOUT = (9.05, 15)
+    DEFAULT_TIMEOUT = DEFAULT_TIMEOUT
+    LIST_TIMEOUT = LIST_TIMEOUT
+    LIST_MAX_AGE = 300  # seconds a badges list read from the server is used by revalidate_badges()
 
     def __init__(self, logger):
         self._badges = None
         self.logger = logger
+        # updates of the badges, sent in batches
+        self._updates = UpdateQueue(logger, self.send_badge, "badge", is_known=lambda mac: mac in self._badges)
+        self._list = ServerList(logger, "badges", self._jason_badge_to_object, self._update_badge_from_json)
+        self._revalidated_version = None  # list version confirmed by the last revalidate_badges()
 
     def _jason_badge_to_object(self, d):
         conv = lambda x: int(float(x))
@@ -30,39 +38,41 @@ class BadgeManagerServer:
 
         )
 
-    def _read_badges_list_from_server(self, retry=True, retry_delay_sec=5):
+    def _update_badge_from_json(self, badge, d):
         """
-        Reads badges info from the server
-        :param retry: if blocking is set, hub will keep retrying
+        Updates an existing badge object with a newer server record of the same badge. Timestamps
+        only move forward, and the voltage seen locally is kept
+        :param badge:
+        :param d: server record
         :return:
         """
-        server_badges = {}
-        done = False
+        conv = lambda x: int(float(x))
+        is_newer = lambda value, current: value is not None and (current is None or value > current)
 
-        while not done:
-            try:
-                self.logger.info("Requesting devices from server...")
-                response = requests.get(BADGES_ENDPOINT, headers=request_headers(), timeout=self.DEFAULT_TIMEOUT)
-                if response.ok:
-                    self.logger.info("Updating devices list ({})...".format(len(response.json())))
-                    for d in response.json():
-                        if(d.get('active')==True):
-                            server_badges[d.get('badge')] = self._jason_badge_to_object(d)
+        badge.badge_id = d.get('id')
+        badge.project_id = d.get('advertisement_project_id')
 
-                    done = True
-                else:
-                    raise Exception('Got a {} from the server'.format(response.status_code))
+        audio_ts_int, audio_ts_fract = conv(d.get('last_audio_ts')), conv(d.get('last_audio_ts_fract'))
+        if badge.is_newer_audio_ts(audio_ts_int, audio_ts_fract):
+            badge.set_audio_ts(audio_ts_int, audio_ts_fract)
 
-            except (requests.exceptions.ConnectionError, Exception) as e:
-                s = traceback.format_exc()
-                self.logger.error("Error reading badges list from server : {}, {}".format(e,s))
-                if not retry:
-                    done = True
-                else:
-                    self.logger.info("Sleeping for {} seconds before retrying".format(retry_delay_sec))
-                    time.sleep(retry_delay_sec)
+        proximity_ts = conv(d.get('last_proximity_ts'))
+        if is_newer(proximity_ts, badge.last_proximity_ts):
+            badge.last_proximity_ts = proximity_ts
 
-        return server_badges
+        if is_newer(d.get('last_contacted_ts'), badge.last_contacted_ts):
+            badge.last_contacted_ts = d.get('last_contacted_ts')
+
+        if is_newer(d.get('last_unsync_ts'), badge.last_unsync_ts):
+            badge.last_unsync_ts = d.get('last_unsync_ts')
+
+    def _read_badges_list_from_server(self, retry=True, retry_delay_sec=5):
+        """
+        Reads badges info from the server (see device_sync.ServerList)
+        :param retry: if blocking is set, hub will keep retrying
+        :return: dict of active badges by mac, or None if the list could not be read
+        """
+        return self._list.read(BADGES_ENDPOINT, self._badges, self.LIST_TIMEOUT, retry, retry_delay_sec)
 
     def _read_badge_from_server(self, badge_key, retry=False, retry_delay_sec=5):
         """
@@ -75,7 +85,7 @@ class BadgeManagerServer:
         while not done:
             try:
                 self.logger.info("Requesting device {} from server...".format(badge_key))
-                response = requests.get(BADGE_ENDPOINT(badge_key), headers=request_headers(), timeout=self.DEFAULT_TIMEOUT)
+                response = session().get(BADGE_ENDPOINT(badge_key), headers=request_headers(), timeout=self.DEFAULT_TIMEOUT)
                 if response.ok:
                     #self.logger.debug("Received ({})...".format(response.json()))
                     return self._jason_badge_to_object(response.json())
@@ -95,12 +105,44 @@ class BadgeManagerServer:
     def pull_badges_list(self):
         self._badges = self._read_badges_list_from_server(retry=True)
 
+    def revalidate_badges(self):
+        """
+        Makes pull_badge() answer from the local copy of the badges list instead of contacting the server
+        for every badge, until the list is read again. A list read less than LIST_MAX_AGE seconds ago (e.g.
+        by pull_badges_list() at the start of the pass) is used as is. Reading it again would download
+        it in full anyway, since the updates sent by the hub change it. Older lists are re-read with a
+        single (conditional) request
+        :return: True if the list was revalidated
+        """
+        if self._badges is not None and self._list.age() < self.LIST_MAX_AGE:
+            self._revalidated_version = self._list.version
+            return True
+
+        badges = self._read_badges_list_from_server(retry=False)
+        if badges is None:
+            self._revalidated_version = None
+            self.logger.warn("Could not revalidate devices list, falling back to per-badge requests")
+            return False
+
+        self._badges = badges
+        self._revalidated_version = self._list.version
+        return True
+
     def pull_badge(self, mac):
         """
-        Contacts to server (if responding) and updates the given badge data
+        Contacts to server (if responding) and updates the given badge data. If the list was
+        revalidated (see revalidate_badges), the local copy is used and no request is made
         :param mac:
-        :return:
+        :return: False if the badge was removed or reassigned to another mac
         """
+        if self._revalidated_version is not None and self._revalidated_version == self._list.version:
+            if mac not in self._badges:
+                # the badge was removed from the server, or its member was given another badge,
+                # in which case keeping it would associate its data with the wrong user
+                self.logger.warn("Device {} is no longer in the server list".format(mac))
+                return False
+            return True
+
         badge = self._badges[mac]
         server_badge = self._read_badge_from_server(badge.key)
         if server_badge is None:
@@ -122,7 +164,7 @@ class BadgeManagerServer:
         """
         Sends timestamps of the given badge to the server
         :param mac:
-        :return:
+        :return: True if the server accepted the update (or had more recent data), False otherwise
         """
         try:
             badge = self._badges[mac]
@@ -138,7 +180,7 @@ class BadgeManagerServer:
             }
 
             self.logger.debug("Sending update badge data to server, badge {} : {}".format(badge.key, data))
-            response = requests.patch(
+            response = session().patch(
                 BADGE_ENDPOINT(badge.key), data=data, headers=request_headers(), timeout=self.DEFAULT_TIMEOUT)
             if response.ok is False:
                 if response.status_code == 400:
@@ -146,8 +188,26 @@ class BadgeManagerServer:
                 else:
                     raise Exception('Server sent a {} status code instead of 200: {}'.format(response.status_code,
                                                                                          response.text))
+            return True
         except Exception as e:
             self.logger.error('Error sending updated badge into to server: {}'.format(e))
+            return False
+
+    def queue_badge(self, mac):
+        """
+        Marks the given badge as changed. Its data is sent to the server by the next flush_badges(),
+        once per pass (see device_sync.UpdateQueue). Does not contact the server
+        :param mac:
+        :return:
+        """
+        self._updates.queue(mac)
+
+    def flush_badges(self):
+        """
+        Sends the data of all queued badges to the server. Badges that failed to update are queued again
+        :return: number of badges updated
+        """
+        return self._updates.flush()
 
     def create_badge(self, name, email, mac ):
         """
@@ -165,7 +225,7 @@ class BadgeManagerServer:
             }
 
             self.logger.info("Creating new badge : {}".format(data))
-            response = requests.post(
+            response = session().post(
                 BADGES_ENDPOINT, data=data, headers=request_headers(), timeout=self.DEFAULT_TIMEOUT)
             if response.ok is False:
                 s = traceback.format_exc()
@@ -84,6 +84,13 @@ class BadgeManagerStandalone():
         # Return success so it doesn't break everything else
         return True
 
+    def revalidate_badges(self):
+        """
+        Re-reads the badges list from the server
+        :return: True if the list was revalidated
+        """
+        return True # not implemented in standalone
+
     def send_badge(self, mac):
         """
         Sends timestamps of the given badge to the server
@@ -92,6 +99,21 @@ class BadgeManagerStandalone():
         """
         pass # not implemented in standalone
 
+    def queue_badge(self, mac):
+        """
+        Marks the given badge as changed, so it is sent by the next flush
+        :param mac:
+        :return:
+        """
+        pass # not implemented in standalone
+
+    def flush_badges(self):
+        """
+        Sends all queued badge updates to the server
+        :return: number of badges updated
+        """
+        return 0 # not implemented in standalone
+
     def create_badge(self, name, email, mac):
         """
         Creates a badge using the giving information
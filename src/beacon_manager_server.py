@@ -5,15 +5,21 @@ import time
 from badge import *
 from settings import APPKEY, HUB_UUID
 from server import BEACON_ENDPOINT, BEACONS_ENDPOINT, request_headers
+from server import session, DEFAULT_TIMEOUT, LIST_TIMEOUT
+from device_sync import ServerList, UpdateQueue
 import traceback
 
 
 class BeaconManagerServer:
-    DEFAULT_TIMEOUT = (9.05, 15)
+    DEFAULT_TIMEOUT = DEFAULT_TIMEOUT
+    LIST_TIMEOUT = LIST_TIMEOUT
 
     def __init__(self, logger):
         self._beacons = None
         self.logger = logger
+        # updates of the beacons, sent in batches
+        self._updates = UpdateQueue(logger, self.send_beacon, "beacon", is_known=lambda mac: mac in self._beacons)
+        self._list = ServerList(logger, "beacons", self._jason_beacon_to_object, self._update_beacon_from_json)
 
 
     def _jason_beacon_to_object(self, d):
@@ -26,38 +32,23 @@ class BeaconManagerServer:
                     init_voltage=d.get('last_voltage')
         )
 
-    def _read_beacons_list_from_server(self, retry=True, retry_delay_sec=5):
+    def _update_beacon_from_json(self, beacon, d):
         """
-        Reads beacons info from the server
-        :param retry: if blocking is set, hub will keep retrying
+        Updates an existing beacon object with a newer server record of the same beacon
+        :param beacon:
+        :param d: server record
         :return:
         """
-        server_beacons = {}
-        done = False
-
-        while not done:
-            try:
-                self.logger.info("Requesting devices from server...")
-                response = requests.get(BEACONS_ENDPOINT, headers=request_headers(), timeout=self.DEFAULT_TIMEOUT)
-                if response.ok:
-                    self.logger.info("Updating beacons list ({})...".format(len(response.json())))
-                    for d in response.json():
-                        if(d.get('active')==True):
-                            server_beacons[d.get('badge')] = self._jason_beacon_to_object(d)
-                    done = True
-                else:
-                    raise Exception('Got a {} from the server'.format(response.status_code))
+        beacon.badge_id = d.get('id')
+        beacon.project_id = d.get('advertisement_project_id')
 
-            except (requests.exceptions.ConnectionError, Exception) as e:
-                s = traceback.format_exc()
-                self.logger.error("Error reading beacon list from server : {}, {}".format(e,s))
-                if not retry:
-                    done = True
-                else:
-                    self.logger.info("Sleeping for {} seconds before retrying".format(retry_delay_sec))
-                    time.sleep(retry_delay_sec)
-
-        return server_beacons
+    def _read_beacons_list_from_server(self, retry=True, retry_delay_sec=5):
+        """
+        Reads beacons info from the server (see device_sync.ServerList)
+        :param retry: if blocking is set, hub will keep retrying
+        :return: dict of active beacons by mac, or None if the list could not be read
+        """
+        return self._list.read(BEACONS_ENDPOINT, self._beacons, self.LIST_TIMEOUT, retry, retry_delay_sec)
 
     def _read_beacon_from_server(self, beacon_key, retry=False, retry_delay_sec=5):
         """
@@ -70,7 +61,7 @@ class BeaconManagerServer:
         while not done:
             try:
                 self.logger.info("Requesting device {} from server...".format(beacon_key))
-                response = requests.get(
+                response = session().get(
                     BEACON_ENDPOINT(beacon_key), headers=request_headers(), timeout=self.DEFAULT_TIMEOUT)
                 if response.ok:
                     #self.logger.debug("Received ({})...".format(response.json()))
@@ -103,7 +94,7 @@ class BeaconManagerServer:
         """
         Sends timestamps of the given beacon to the server
         :param mac:
-        :return:
+        :return: True if the server accepted the update (or had more recent data), False otherwise
         """
         try:
             beacon = self._beacons[mac]
@@ -114,7 +105,7 @@ class BeaconManagerServer:
             }
 
             self.logger.debug("Sending update beacon data to server, beacon {} : {}".format(beacon.key, data))
-            response = requests.patch(
+            response = session().patch(
                 BEACON_ENDPOINT(beacon.key), data=data, headers=request_headers(), timeout=self.DEFAULT_TIMEOUT)
             if response.ok is False:
                 if response.status_code == 400:
@@ -122,8 +113,26 @@ class BeaconManagerServer:
                 else:
                     raise Exception('Server sent a {} status code instead of 200: {}'.format(response.status_code,
                                                                                          response.text))
+            return True
         except Exception as e:
             self.logger.error('Error sending updated beacon info to server: {}'.format(e))
+            return False
+
+    def queue_beacon(self, mac):
+        """
+        Marks the given beacon as changed. Its data is sent to the server by the next flush_beacons(),
+        once per pass (see device_sync.UpdateQueue). Does not contact the server
+        :param mac:
+        :return:
+        """
+        self._updates.queue(mac)
+
+    def flush_beacons(self):
+        """
+        Sends the data of all queued beacons to the server. Beacons that failed to update are queued again
+        :return: number of beacons updated
+        """
+        return self._updates.flush()
 
     def create_beacon(self, name, mac , beacon_id ,project_id):
         """
@@ -143,7 +152,7 @@ class BeaconManagerServer:
             }
 
             self.logger.info("Creating new beacon : {}".format(data))
-            response = requests.post(
+            response = session().post(
                 BEACONS_ENDPOINT, data=data, headers=request_headers(), timeout=self.DEFAULT_TIMEOUT)
             if response.ok is False:
                 s = traceback.format_exc()
@@ -88,6 +88,21 @@ class BeaconManagerStandalone():
         """
         pass # not implemented in standalone
 
+    def queue_beacon(self, mac):
+        """
+        Marks the given beacon as changed, so it is sent by the next flush
+        :param mac:
+        :return:
+        """
+        pass # not implemented in standalone
+
+    def flush_beacons(self):
+        """
+        Sends all queued beacon updates to the server
+        :return: number of beacons updated
+        """
+        return 0 # not implemented in standalone
+
     def create_beacon(self, name, mac , beacon_id ,project_id):
         """
         Creates a beacon using the giving information
@@ -0,0 +1,138 @@
+from __future__ import absolute_import, division, print_function
+
+import ctypes
+import ctypes.util
+import threading
+import time
+
+
+class TimeoutError(Exception):
+    """
+    # Raises a timeout exception if a function takes too long
+    # http://stackoverflow.com/questions/2281850/timeout-function-if-it-takes-too-long-to-finish
+    """
+    pass
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+CLOCK_MONOTONIC = 1  # from <linux/time.h>
+
+
+def _load_clock_gettime():
+    for name in ('rt', 'c'):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        return clock_gettime
+    return None
+
+_clock_gettime = _load_clock_gettime()
+
+
+def monotonic():
+    """
+    Returns seconds from a monotonic clock. Unlike time.time(), it is not affected by NTP or manual clock changes.
+    Falls back to time.time() if clock_gettime is not available
+    :return: float
+    """
+    if _clock_gettime is None:
+        return time.time()
+
+    t = _timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+        return time.time()
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+
+class Deadline(object):
+    """
+    Deadline for a single operation. Unlike SIGALRM, it works in any thread and has sub-second resolution.
+    To use with a "with" statement:
+
+        with Deadline(1.5, "Status timeout", on_expire=conn.abort) as deadline:
+            while not done:
+                deadline.check()
+                conn.waitForNotifications(deadline.remaining(WAIT_FOR))
+
+    Loops should call check() and bound their waits with remaining(). Calls that block without a timeout
+    are interrupted by on_expire, which is invoked from a watchdog thread once the deadline passes. Once
+    on_expire was invoked, an error raised inside the block is reported as a TimeoutError, with the original
+    error in its message and in its cause attribute
+    """
+    MIN_WAIT = 0.001  # remaining() never returns 0, since bluepy treats a 0 timeout as "wait forever"
+
+    def __init__(self, seconds, error_message='Timeout', on_expire=None):
+        """
+        :param seconds: time allowed for the operation (float)
+        :param error_message: message of the raised TimeoutError
+        :param on_expire: callable used to cancel blocking calls when the deadline passes
+        """
+        self.seconds = seconds
+        self.error_message = error_message
+        self.on_expire = on_expire
+        self.expires_at = None
+        self.fired = False  # on_expire was invoked
+        self._watchdog = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.expires_at = monotonic() + self.seconds
+        if self.on_expire is not None:
+            self._watchdog = threading.Timer(self.seconds, self._expire)
+            self._watchdog.daemon = True
+            self._watchdog.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        # cancel() does not stop a watchdog that is running already. Waits for it, so on_expire never
+        # runs after the block was left
+        with self._lock:
+            self._closed = True
+
+        if type is not None and not issubclass(type, TimeoutError) and self.fired:
+            # most likely caused by on_expire cancelling a blocking call
+            error = TimeoutError("{} ({}: {})".format(self.error_message, type.__name__, value))
+            error.cause = value
+            raise error
+        return False
+
+    def _expire(self):
+        with self._lock:
+            if self._closed:
+                return
+            self.fired = True
+            self.on_expire()
+
+    def remaining(self, cap=None):
+        """
+        Returns the number of seconds left before the deadline
+        :param cap: if given, the result is never larger than cap
+        :return:
+        """
+        left = max(self.expires_at - monotonic(), self.MIN_WAIT)
+        if cap is not None:
+            left = min(left, cap)
+        return left
+
+    def expired(self):
+        return monotonic() >= self.expires_at
+
+    def check(self):
+        """
+        Raises TimeoutError if the deadline has passed
+        :return:
+        """
+        if self.expired():
+            raise TimeoutError(self.error_message)
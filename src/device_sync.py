@@ -0,0 +1,191 @@
+"""
+Keeps the badges and beacons of the hub in sync with the server. Shared by BadgeManagerServer and
+BeaconManagerServer
+"""
+from __future__ import absolute_import, division, print_function
+import collections
+import threading
+import time
+import traceback
+
+from deadline import monotonic
+from server import session, request_headers
+from worker_pool import WorkerPool
+
+
+class UpdateQueue(object):
+    """
+    Devices with updates that were not sent to the server yet. Queuing a device several times results in a
+    single update with its latest data.
+
+    queue() only records the device, so it can be called from the threads that pull the devices without
+    waiting on the server. Updates are sent by flush(), which the main loop calls once per pass
+    """
+    WORKERS = 4  # concurrent requests used when flushing
+
+    def __init__(self, logger, send, name, is_known=None, workers=WORKERS):
+        """
+        :param send: callable, send(mac). Returns False if the update failed
+        :param name: name of the devices, for logging (e.g. "badge")
+        :param is_known: callable, is_known(mac). Failed updates are only queued again for known devices
+        """
+        self.logger = logger
+        self.send = send
+        self.name = name
+        self.is_known = is_known
+        self.workers = workers
+        self._dirty = collections.OrderedDict()  # macs of devices with unsent updates
+        self._lock = threading.Lock()
+
+    def queue(self, mac):
+        """
+        Marks the given device as changed. Its data is sent by the next flush
+        :param mac:
+        :return:
+        """
+        with self._lock:
+            self._dirty[mac] = True
+
+    def flush(self):
+        """
+        Sends the data of all queued devices to the server, up to self.workers requests at a time.
+        Devices that failed to update are queued again
+        :return: number of devices updated
+        """
+        with self._lock:
+            macs = self._dirty.keys()
+            self._dirty = collections.OrderedDict()
+
+        if len(macs) == 0:
+            return 0
+
+        failed = []
+
+        def send(mac, worker):
+            if not self.send(mac):
+                failed.append(mac)
+
+        start = time.time()
+        pool = WorkerPool(self.logger, range(min(self.workers, len(macs))), name="{}-flush".format(self.name))
+        pool.run(macs, send)
+
+        with self._lock:
+            for mac in failed:
+                # no point in retrying devices that are no longer in the list
+                if self.is_known is None or self.is_known(mac):
+                    self._dirty.setdefault(mac, True)
+
+        self.logger.info("Sent {} {} updates in {:.2f} seconds ({} failed)"
+                         .format(len(macs) - len(failed), self.name, time.time() - start, len(failed)))
+        return len(macs) - len(failed)
+
+
+class ServerList(object):
+    """
+    List of devices (badges or beacons) read from the server. Requests are conditional (If-None-Match),
+    and a changed list is merged into the existing device objects: unchanged records keep their objects,
+    changed records are merged into them, and only new devices (or a mac that now has another key) are
+    created from scratch.
+
+    How often the server answers 304: the hub sends the timestamps of every device it saw after each pass
+    (see UpdateQueue), which changes the list on the server. So while devices are in range, the list is
+    downloaded again on nearly every pass, and 304s are mostly seen by hubs that saw no device since the
+    last read, or that read the list twice without sending updates in between
+    """
+
+    def __init__(self, logger, name, create, update):
+        """
+        :param name: name of the list, for logging (e.g. "badges")
+        :param create: callable, create(record). Returns a new device object
+        :param update: callable, update(device, record). Merges a changed record into an existing device
+        """
+        self.logger = logger
+        self.name = name
+        self.create = create
+        self.update = update
+        self.etag = None     # ETag of the last list, for conditional requests
+        self.records = {}    # last server record of each device, by mac
+        self.version = 0     # incremented every time the list is read from the server
+        self._read_at = None
+
+    def merge(self, current, records):
+        """
+        :param current: dict of the current devices by mac, or None
+        :param records: list of server records
+        :return: dict of active devices, by mac
+        """
+        current = current or {}
+        devices = {}
+        records_by_mac = {}
+        updated = created = 0
+
+        for d in records:
+            if d.get('active') != True:
+                continue
+
+            mac = d.get('badge')
+            device = current.get(mac)
+            if device is not None and self.records.get(mac) == d:
+                pass  # unchanged
+            elif device is not None and device.key == d.get('key'):
+                self.update(device, d)
+                updated += 1
+            else:
+                device = self.create(d)
+                created += 1
+
+            devices[mac] = device
+            records_by_mac[mac] = d
+
+        self.records = records_by_mac
+        self.logger.info("{} list: {} unchanged, {} updated, {} new".format(
+            self.name.capitalize(), len(devices) - updated - created, updated, created))
+        return devices
+
+    def age(self):
+        """
+        :return: seconds since the list was last read from the server (infinite if it was never read)
+        """
+        if self._read_at is None:
+            return float('inf')
+        return monotonic() - self._read_at
+
+    def read(self, endpoint, current, timeout, retry=True, retry_delay_sec=5):
+        """
+        Reads the list from the server. It is only downloaded again if it changed since the last read
+        :param endpoint: url of the list
+        :param current: dict of the current devices by mac, or None if the list was never read
+        :param retry: if blocking is set, hub will keep retrying
+        :return: dict of active devices by mac, or None if the list could not be read
+        """
+        while True:
+            try:
+                self.logger.info("Requesting {} from server...".format(self.name))
+                headers = request_headers()
+                if current is not None and self.etag is not None:
+                    headers["If-None-Match"] = self.etag
+
+                response = session().get(endpoint, headers=headers, timeout=timeout)
+                if response.status_code == 304:
+                    self.logger.info("{} list did not change".format(self.name.capitalize()))
+                    self.version += 1
+                    self._read_at = monotonic()
+                    return current
+                elif response.ok:
+                    records = response.json()
+                    self.logger.info("Updating {} list ({})...".format(self.name, len(records)))
+                    devices = self.merge(current, records)
+                    self.etag = response.headers.get('ETag')
+                    self.version += 1
+                    self._read_at = monotonic()
+                    return devices
+                else:
+                    raise Exception('Got a {} from the server'.format(response.status_code))
+
+            except Exception as e:
+                s = traceback.format_exc()
+                self.logger.error("Error reading {} list from server : {}, {}".format(self.name, e, s))
+                if not retry:
+                    return None
+                self.logger.info("Sleeping for {} seconds before retrying".format(retry_delay_sec))
+                time.sleep(retry_delay_sec)
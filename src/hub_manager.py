@@ -4,19 +4,27 @@ from __future__ import absolute_import, division, print_function
 import socket
 import requests
 import logging
+import threading
 import traceback
 import time
+import zlib
 
 import settings
 import json
 from urllib2 import urlopen
 from server import HUB_ENDPOINT, HUBS_ENDPOINT, PROJECTS_ENDPOINT, DATA_ENDPOINT
-from server import request_headers
+from server import request_headers, session, DEFAULT_TIMEOUT, LIST_TIMEOUT, UPLOAD_TIMEOUT
 from urllib import quote_plus
+from deadline import monotonic
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 SLEEP_WAIT_SEC = 60 # 1 minute
-LONG_TIMEOUT = (9.05, 900)
-DEFAULT_TIMEOUT = (9.05, 15)
+LONG_TIMEOUT = UPLOAD_TIMEOUT
+PROJECT_KEY_TTL = 60 * 60 # seconds before the project key is looked up again
 
 def get_uuid():
     """
@@ -55,7 +63,7 @@ def send_hub_ip():
         }
 
         logger.debug("Sending update to server: {}".format(data))
-        response = requests.patch(HUB_ENDPOINT(encoded_hostname), data=data, timeout=DEFAULT_TIMEOUT)
+        response = session().patch(HUB_ENDPOINT(encoded_hostname), data=data, timeout=DEFAULT_TIMEOUT)
         if response.ok is False:
             raise Exception('Server sent a {} status code instead of 200: {}'.format(response.status_code,
                                                                                          response.text))
@@ -87,7 +95,7 @@ def _read_hubs_list_from_server(logger, retry=True, retry_delay_sec=5):
     while not done:
         try:
             logger.info("Requesting devices from server...")
-            response = requests.get(HUBS_ENDPOINT, timeout=DEFAULT_TIMEOUT)
+            response = session().get(HUBS_ENDPOINT, timeout=LIST_TIMEOUT)
             if response.ok:
                 logger.info("Updating hubs list ({})...".format(len(response.json())))
                 for d in response.json():
@@ -114,14 +122,52 @@ def pull_hubs_list(logger):
 
 
 def _get_project_id(logger):
-    resp = requests.request("GET", PROJECTS_ENDPOINT, headers=request_headers(), timeout=DEFAULT_TIMEOUT)
+    """
+    Reads the key of the hub's project from the server
+    Raises:
+        RequestException: if the key could not be read
+    """
+    resp = session().request("GET", PROJECTS_ENDPOINT, headers=request_headers(), timeout=DEFAULT_TIMEOUT)
     if resp.status_code == 200:
         return resp.json()["key"]
     else:
-        #TODO what do
-        #I don't think this is likely to ever happen, at least
         logger.error("Error getting project key from server, status code: {}"
             .format(resp.status_code))
+        raise requests.exceptions.HTTPError(
+            "Error getting project key from server, status code: {}".format(resp.status_code), response=resp)
+
+
+class ProjectKeyCache(object):
+    """
+    Caches the project key used by all upload paths, so sending a backlog of files takes a
+    single lookup. The key expires after ttl seconds, and is dropped right away when the
+    server rejects an upload with 401 or 404 (e.g. the hub was moved to another project)
+    """
+
+    def __init__(self, ttl=PROJECT_KEY_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._key = None
+        self._expires_at = 0
+
+    def get(self, logger):
+        """
+        Returns the project key, looking it up if needed
+        Raises:
+            RequestException: if the key could not be read
+        """
+        with self._lock:
+            if self._key is None or monotonic() >= self._expires_at:
+                self._key = _get_project_id(logger)
+                self._expires_at = monotonic() + self.ttl
+            return self._key
+
+    def invalidate(self):
+        with self._lock:
+            self._key = None
+
+
+_project_key_cache = ProjectKeyCache()
 
 
 def send_data_to_server(logger, data_type, data):
@@ -136,15 +182,67 @@ def send_data_to_server(logger, data_type, data):
     Raises:
         RequestException: raises if the status code indicates an http error
     """
-    project_id = _get_project_id(logger)
+    return send_serialized_data_to_server(logger, data_type, [json.dumps(chunk) for chunk in data])
+
+
+def compress_body(body, compression=settings.UPLOAD_COMPRESSION, level=settings.UPLOAD_COMPRESSION_LEVEL):
+    """
+    Compresses a request body
+    Args:
+        body: the encoded body
+        compression: none, gzip or zstd
+        level: compression level
+    Returns:
+        the (possibly compressed) body, and the value for the Content-Encoding header (None if not compressed)
+    """
+    if compression == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16+ for a gzip header
+        return compressor.compress(body) + compressor.flush(), "gzip"
+    elif compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor(level=level).compress(body), "zstd"
+    else:
+        return body, None
+
+
+def serialized_data_body(data_type, lines):
+    """
+    Builds the body of a data upload from chunks that are already JSON encoded
+    Args:
+        data_type: audio or proximity
+        lines: list of JSON encoded chunks
+    Returns:
+        the (uncompressed) body
+    """
+    return '{{"data_type": {}, "chunks": [{}]}}'.format(
+        json.dumps(data_type), ",".join(line.rstrip("\n") for line in lines))
+
+
+def send_serialized_data_to_server(logger, data_type, lines):
+    """
+    Send data that is already JSON encoded (e.g. lines of a pending file) to the server.
+    The request body is built from the lines as they are, without decoding them
+    Args:
+        logger: for logging events/errors
+        data_type: audio or proximity
+        lines: list of JSON encoded chunks
+    Returns:
+         the number of chunks written on the server
+    Raises:
+        RequestException: raises if the status code indicates an http error
+    """
+    project_id = _project_key_cache.get(logger)
     headers = request_headers()
     headers["content-type"] = "application/json"
-    payload = {
-        "data_type": data_type,
-        "chunks": data
-    }
+    body, content_encoding = compress_body(serialized_data_body(data_type, lines))
+    if content_encoding is not None:
+        headers["content-encoding"] = content_encoding
     url = DATA_ENDPOINT(project_id) 
-    response = requests.request("POST", url, data=json.dumps(payload), headers=headers, timeout=LONG_TIMEOUT)
+    response = session().request("POST", url, data=body, headers=headers, timeout=LONG_TIMEOUT)
+    if response.status_code in (401, 404):
+        # the cached key may be stale, look it up again next time
+        _project_key_cache.invalidate()
     response.raise_for_status() 
     return response.json()["chunks_written"]
 
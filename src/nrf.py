@@ -73,9 +73,10 @@ class SimpleDelegate(DefaultDelegate):
         print(repr(data))
 
 class Nrf(Peripheral):
-    def __init__(self,addr):
+    def __init__(self,addr=None,iface=None):
         # address type must be random for RFD
-        Peripheral.__init__(self,addr,btle.ADDR_TYPE_RANDOM)
+        # iface is the index of the HCI adapter (None for the default one)
+        Peripheral.__init__(self,addr,btle.ADDR_TYPE_RANDOM,iface)
         # self.discoverServices()
         self.NrfReadWrite = NrfReadWrite(self)
         self.NrfNotifications = NrfNotifications(self)
@@ -0,0 +1,288 @@
+from __future__ import absolute_import, division, print_function
+
+import glob
+import os
+import threading
+import time
+from datetime import datetime as dt
+
+import serializers
+
+# durability policies of SegmentWriter
+FLUSH_CHUNK = "chunk"
+FLUSH_BADGE = "badge"
+FLUSH_BYTES = "bytes"
+FLUSH_SEGMENT = "segment"
+DURABILITY_POLICIES = (FLUSH_CHUNK, FLUSH_BADGE, FLUSH_BYTES, FLUSH_SEGMENT)
+
+FLUSH_BYTES_SIZE = 64 * 1024  # flush size of the "bytes" policy
+SEGMENT_BUFFER_SIZE = 1024 * 1024  # flush size of the "segment" policy
+
+
+class PendingSegments(object):
+    """
+    Keeps track of the pending files (segments) data is written to before it is uploaded.
+    The active segment of every data type is kept in memory, so getting it only costs a
+    single stat of the active file. Segments rotate once they reach a maximal size or age.
+
+    Segments are named <prefix><date/time>_<data type>.txt (<prefix><date/time>_<n>_<data type>.txt
+    when several are created in the same second)
+    """
+
+    def __init__(self, prefix, max_bytes, max_age=None, logger=None):
+        """
+        :param prefix: path prefix of the pending files (e.g. /data/pending_)
+        :param max_bytes: segments reaching this size are rotated
+        :param max_age: segments older than this many seconds are rotated. None disables rotation by age
+        :param logger:
+        """
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.logger = logger
+        self._active = {}  # data type -> (file name, creation time)
+        self._issued = {}  # data type -> last created file name
+        self._lock = threading.Lock()
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        Starts over without active segments, e.g. after a restart. The segments found on disk are sealed:
+        data is never appended to them, since a crash may have left an incomplete record at their end
+        """
+        with self._lock:
+            self._active = {}
+
+    def create_name(self, data_type):
+        """
+        Create a pending file name for the given data_type
+
+        Uses the current date/time to create a unique filename
+        """
+        now = dt.now().strftime("%Y%m%d%H%M%S")
+        filename = "{}{}_{}.txt".format(self.prefix, now, data_type)
+        count = 1
+        # a file may have been created in the same second, or created and claimed by the uploader already
+        taken = set([self._issued.get(data_type)] + [name for name, created in self._active.values()])
+        while os.path.exists(filename) or filename in taken:
+            count += 1
+            filename = "{}{}_{}_{}.txt".format(self.prefix, now, count, data_type)
+
+        self._issued[data_type] = filename
+        return filename
+
+    def _expired(self, file_name, created):
+        try:
+            size = os.path.getsize(file_name)
+        except OSError:
+            # nothing written to it yet
+            return False
+        if self.max_age is not None and time.time() - created >= self.max_age:
+            return True
+        return size >= self.max_bytes
+
+    def active(self, data_type):
+        """
+        Return the name of the segment data of the passed type should be written to.
+        The current segment is rotated if it is full or too old
+        """
+        with self._lock:
+            entry = self._active.get(data_type)
+            if entry is None or self._expired(*entry):
+                if entry is not None and self.logger:
+                    self.logger.debug("Rotating pending file {}".format(entry[0]))
+                entry = (self.create_name(data_type), time.time())
+                self._active[data_type] = entry
+            return entry[0]
+
+    def is_active(self, file_name):
+        """
+        Return True if data is still written to the passed segment
+        """
+        with self._lock:
+            return any(active_file_name == file_name for active_file_name, created in self._active.values())
+
+    def seal_expired(self):
+        """
+        Seals the active segments that are full or too old, even if nothing was written to them
+        since. New data goes to new segments
+        :return: names of the sealed segments
+        """
+        sealed = []
+        with self._lock:
+            for data_type, entry in self._active.items():
+                if self._expired(*entry):
+                    del self._active[data_type]
+                    sealed.append(entry[0])
+
+        if sealed and self.logger:
+            self.logger.debug("Sealed pending files {}".format(", ".join(sealed)))
+        return sealed
+
+    def sealed(self):
+        """
+        Return the names of the pending files no data is written to anymore, oldest first
+        """
+        with self._lock:
+            active = set(active_file_name for active_file_name, created in self._active.values())
+        return [file_name for file_name in self.segments() if file_name not in active]
+
+    def release(self, file_name):
+        """
+        Stops writing to the passed segment, e.g. because the uploader claimed it
+        """
+        with self._lock:
+            for data_type, (active_file_name, created) in self._active.items():
+                if active_file_name == file_name:
+                    del self._active[data_type]
+
+    def _creation_order(self, file_name):
+        # <date/time>_<data type> sorts before <date/time>_2_<data type>
+        parts = os.path.basename(file_name)[len(os.path.basename(self.prefix)):].split("_")
+        count = int(parts[1]) if len(parts) > 2 and parts[1].isdigit() else 1
+        return parts[0], count, file_name
+
+    def segments(self):
+        """
+        Return the names of all the pending files on disk, oldest first
+        """
+        return sorted(glob.glob(self.prefix + "*"), key=self._creation_order)
+
+
+class SegmentWriter(object):
+    """
+    Long-lived writer of one data type. Lines are buffered in memory and written with a single
+    write call when flushed. The file is kept open for as long as it is the active segment.
+
+    Durability policies, from the most to the least flushes:
+    * chunk: flush after every write (dialogue writes every chunk and scan as it is received). Nothing is lost
+      when the hub process crashes, at the cost of a write call per chunk and scan
+    * badge (default): flush once the data of a badge was written (see end_of_badge), or when the buffer is
+      full (1MB). Less than the data of the badges being pulled is lost when the process crashes
+    * bytes: flush every flush_bytes (64KB). Less than that is lost when the process crashes
+    * segment: flush and fsync when the buffer is full (1MB). Less than that is lost when the process crashes,
+      or on power loss
+
+    With every policy, a segment is flushed and fsync-ed when it is closed (rotated, or sealed and claimed
+    by the uploader). With the chunk, badge and bytes policies, data of the open segment that was flushed but not
+    fsync-ed yet, and not written back by the OS, is lost on power loss
+
+    Callers that keep a checkpoint of what was stored pass on_flush to write, so the checkpoint is only
+    advanced once the data is in the file, whatever the policy
+    """
+
+    def __init__(self, name_source, policy=FLUSH_BADGE, flush_bytes=FLUSH_BYTES_SIZE, logger=None,
+                 serializer=None):
+        """
+        :param name_source: callable returning the name of the file to write to. The writer
+            switches files whenever it changes (e.g. PendingSegments.active)
+        :param policy: durability policy (chunk, badge, bytes or segment)
+        :param flush_bytes: flush size of the "bytes" policy
+        :param logger:
+        :param serializer: serializer of new files (see serializers). Files that already hold data keep
+            the format they were created with. None writes lines as they are passed
+        """
+        if policy not in DURABILITY_POLICIES:
+            raise ValueError("Unknown durability policy: {}".format(policy))
+
+        self.name_source = name_source
+        self.policy = policy
+        self.flush_bytes = flush_bytes
+        self.logger = logger
+        self.serializer = serializer
+        self._file = None
+        self._file_name = None
+        self._encoder = None
+        self._buffer = []
+        self._buffered = 0
+        self._on_flush = []  # callbacks of the buffered lines
+        self._lock = threading.RLock()
+
+    def _open(self):
+        file_name = self.name_source()
+        if file_name != self._file_name:
+            self.close()
+            self._file = open(file_name, "ab")
+            self._file_name = file_name
+
+            if self.serializer is not None:
+                serializer = self.serializer
+                if os.path.getsize(file_name) > 0:
+                    with open(file_name, "rb") as f:
+                        serializer = serializers.detect(f)
+                self._encoder = serializer.encoder()
+                if os.path.getsize(file_name) == 0:
+                    header = self._encoder.header()
+                    self._buffer.append(header)
+                    self._buffered += len(header)
+
+    def write(self, lines, on_flush=None):
+        """
+        Writes log lines, buffered according to the durability policy. The segment is only checked for
+        rotation once per call
+        :param lines: list of lines, or of log lines (dicts) when the writer has a serializer
+        :param on_flush: callable, called without arguments once the lines were written to the file (and
+            fsync-ed, with the segment policy). With the chunk policy, this happens before write returns
+        """
+        with self._lock:
+            self._open()
+            if self._encoder is not None:
+                lines = [self._encoder.encode(log_line) for log_line in lines]
+            self._buffer.extend(lines)
+            self._buffered += sum(len(line) for line in lines)
+            if on_flush is not None:
+                self._on_flush.append(on_flush)
+
+            if self.policy == FLUSH_CHUNK:
+                self.flush()
+            elif self.policy == FLUSH_BYTES and self._buffered >= self.flush_bytes:
+                self.flush()
+            elif self._buffered >= SEGMENT_BUFFER_SIZE:
+                # bounds the memory used for a badge with a large backlog, with the badge policy
+                self.flush(sync=self.policy == FLUSH_SEGMENT)
+
+    def end_of_badge(self):
+        """
+        Called once the data of a badge was written. Flushes with the badge policy
+        """
+        if self.policy == FLUSH_BADGE:
+            self.flush()
+
+    def flush(self, sync=False):
+        """
+        Writes the buffered lines to the current segment, then calls their on_flush callbacks
+        :param sync: fsync the segment before calling the callbacks
+        """
+        with self._lock:
+            if self._buffer:
+                self._file.write("".join(self._buffer))
+                self._file.flush()
+                self._buffer = []
+                self._buffered = 0
+            if sync and self._file is not None:
+                os.fsync(self._file.fileno())
+
+            callbacks, self._on_flush = self._on_flush, []
+            for callback in callbacks:
+                callback()
+
+    def close(self, sync=True):
+        """
+        Flushes and closes the current segment. It is reopened on the next write
+        :param sync: fsync the segment before closing it
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            self.flush(sync)
+            self._file.close()
+            self._file = None
+            self._file_name = None
+            self._encoder = None
+
+    @property
+    def file_name(self):
+        """
+        Name of the file currently open, None if there is none
+        """
+        return self._file_name
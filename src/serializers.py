@@ -0,0 +1,176 @@
+"""
+Serializers of the data written to pending files
+
+* json (default): one JSON object per line. Files have no header, and are sent to the server as they are
+* msgpack: "OBMP" header, then length-prefixed msgpack records (requires the msgpack package)
+* binary: the binary audio format of audio_format (audio chunks as raw samples, other records as JSON)
+
+Files written in msgpack or binary start with a header, which detect() uses to find the serializer
+of a file. They are converted back to JSON-lines when they are uploaded. Records that cannot be read
+(e.g. truncated by a crash) raise audio_format.FormatError
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import struct
+
+import audio_format
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+BINARY = "binary"
+SERIALIZERS = (JSON, MSGPACK, BINARY)
+
+HEADER_SIZE = 8
+
+
+def read_lines(f, offset=0):
+    """
+    Reads the non-empty lines of a JSON-lines file, without decoding them
+    :param f: iterable of lines
+    :param offset: position in the file of the first line
+    :return: generator of (line, offset) tuples, where offset is the position in the file
+        right after the line
+    """
+    for line in f:
+        offset += len(line)
+        if line.strip():
+            yield line, offset
+
+
+class JsonSerializer(object):
+    name = JSON
+
+    def encoder(self):
+        """
+        Return an encoder for a new segment
+        """
+        return self
+
+    def header(self):
+        return b""
+
+    def encode(self, log_line):
+        return json.dumps(log_line) + "\n"
+
+    def records(self, f, offset=0, state=None):
+        """
+        Reads the lines of a segment, without decoding them
+        :param f: open file, at the start of the segment
+        :param offset: records ending at or before this position are skipped
+        :param state: dict the serializer keeps what it needs to resume reading in (e.g. along with
+            an upload cursor). Must be JSON serializable. Pass the same state with the offset of a
+            record to resume after it
+        :return: generator of (JSON line, offset) tuples, where offset is the position in the file
+            right after the record
+        """
+        f.seek(offset)
+        return read_lines(f, offset)
+
+
+class MsgpackSerializer(object):
+    name = MSGPACK
+    MAGIC = b"OBMP"
+    VERSION = 1
+
+    _HEADER = struct.Struct("<4sB3x")
+    _LENGTH = struct.Struct("<I")
+
+    def encoder(self):
+        if msgpack is None:
+            raise RuntimeError("The msgpack serializer requires the msgpack package")
+        return self
+
+    def header(self):
+        return self._HEADER.pack(self.MAGIC, self.VERSION)
+
+    def encode(self, log_line):
+        record = msgpack.packb(log_line, use_bin_type=True)
+        return self._LENGTH.pack(len(record)) + record
+
+    def records(self, f, offset=0, state=None):
+        magic, version = self._HEADER.unpack(f.read(self._HEADER.size))
+        if version != self.VERSION:
+            raise audio_format.FormatError("Unsupported msgpack segment version: {}".format(version))
+
+        f.seek(max(offset, self._HEADER.size))
+        while True:
+            length = f.read(self._LENGTH.size)
+            if not length:
+                return
+            if len(length) != self._LENGTH.size:
+                raise audio_format.FormatError("Truncated record at {}".format(f.tell()))
+            record = f.read(self._LENGTH.unpack(length)[0])
+            if len(record) != self._LENGTH.unpack(length)[0]:
+                raise audio_format.FormatError("Truncated record at {}".format(f.tell()))
+            try:
+                log_line = msgpack.unpackb(record, raw=False)
+            except ValueError as e:
+                raise audio_format.FormatError("Invalid msgpack record at {}: {}".format(f.tell(), e))
+            yield json.dumps(log_line) + "\n", f.tell()
+
+
+class BinarySerializer(object):
+    name = BINARY
+
+    def encoder(self):
+        return _BinaryEncoder()
+
+    def records(self, f, offset=0, state=None):
+        # badge metadata is defined along the way. Resuming at offset needs the metadata defined
+        # before it, which is kept in the state. Without it, the segment is decoded from the start
+        if state is None:
+            state = {}
+        if offset and 'badges' in state:
+            # JSON object keys are strings
+            badges = dict((int(index), metadata) for index, metadata in state['badges'].items())
+            start = offset
+        else:
+            badges = {}
+            start = 0
+        state['badges'] = badges
+
+        for log_line, end in audio_format.decode_records(f, start, badges):
+            if end > offset:
+                yield json.dumps(log_line) + "\n", end
+
+
+class _BinaryEncoder(audio_format.Encoder):
+
+    def header(self):
+        return audio_format.file_header()
+
+
+_serializers = {
+    JSON: JsonSerializer(),
+    MSGPACK: MsgpackSerializer(),
+    BINARY: BinarySerializer(),
+}
+
+
+def get(name):
+    """
+    Return the serializer with the passed name
+    """
+    if name == MSGPACK and msgpack is None:
+        raise RuntimeError("The msgpack serializer requires the msgpack package")
+    return _serializers[name]
+
+
+def detect(f):
+    """
+    Return the serializer of the passed segment, based on its header
+    :param f: open file, at the start of the segment. It is rewound
+    """
+    header = f.read(HEADER_SIZE)
+    f.seek(0)
+    if header.startswith(MsgpackSerializer.MAGIC):
+        return get(MSGPACK)
+    if audio_format.is_binary(header):
+        return _serializers[BINARY]
+    return _serializers[JSON]
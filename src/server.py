@@ -1,9 +1,14 @@
 # Defining end points for backend-server
 from __future__ import absolute_import, division, print_function
 import settings
+import threading
 import time
 import netifaces
 import json
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from deadline import monotonic
 
 SERVER = 'http://'+settings.BADGE_SERVER_ADDR+':'+settings.BADGE_SERVER_PORT+'/'
 PROJECTS_ENDPOINT = '{}projects'.format(SERVER)
@@ -12,6 +17,19 @@ HUBS_ENDPOINT = '{}hubs/'.format(SERVER)
 BEACONS_ENDPOINT = '{}beacons/'.format(SERVER)
 DATAFILES_ENDPOINT = "{}{}".format(SERVER, "{}/datafiles")
 
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (9.05, 15)
+LIST_TIMEOUT = (9.05, 30)      # full badges / beacons / hubs lists
+UPLOAD_TIMEOUT = (9.05, 900)   # data files
+
+# Connection pooling and retries shared by all server clients. Retries only apply to
+# idempotent methods (e.g. GET), so PATCH and POST are never sent twice
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+RETRIES = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504))
+
+IPS_TTL = 300  # seconds before the list of IPs sent to the server is refreshed
+
 
 def _badge(x):
     """
@@ -53,6 +71,27 @@ DATA_ENDPOINT = _data
 HUB_ENDPOINT = _hub
 
 
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """
+    Returns the HTTP session shared by all server clients. It keeps connections alive
+    between requests, so calls do not pay for a new TCP (and TLS) handshake each time
+    :return: requests.Session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            s = Session()
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=RETRIES)
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            _session = s
+        return _session
+
+
 def get_ips():
     """
     Generates a JSON string with the list of IPs used by the hub
@@ -72,15 +111,50 @@ def get_ips():
     return ips_json
 
 
+class IpsCache(object):
+    """
+    Caches the result of get_ips(). The list is refreshed when it is older than ttl seconds,
+    or right away when an interface is added or removed
+    """
+
+    def __init__(self, ttl=IPS_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._ips = None
+        self._interfaces = None
+        self._expires_at = 0
+
+    def get(self):
+        interfaces = netifaces.interfaces()
+        now = monotonic()
+        with self._lock:
+            if self._ips is None or now >= self._expires_at or interfaces != self._interfaces:
+                self._ips = get_ips()
+                self._interfaces = interfaces
+                self._expires_at = now + self.ttl
+            return self._ips
+
+    def invalidate(self):
+        with self._lock:
+            self._ips = None
+
+
+_ips_cache = IpsCache()
+
+# headers that never change while the hub is running
+_STATIC_HEADERS = {
+    "X-APPKEY": settings.APPKEY,
+    "X-HUB-UUID": settings.HUB_UUID,
+}
+
+
 def request_headers():
     """ 
     Generate the headers to be used for all requests to server
     Note - all items must be strings
+    Returns a new dict, so callers may add their own headers
     """
-    print(get_ips())
-    return {
-        "X-APPKEY": settings.APPKEY,
-        "X-HUB-UUID": settings.HUB_UUID,
-        "X-HUB-TIME": str(time.time()),
-        "X-ALL-IPS": get_ips()
-    }
+    headers = dict(_STATIC_HEADERS)
+    headers["X-HUB-TIME"] = str(time.time())
+    headers["X-ALL-IPS"] = _ips_cache.get()
+    return headers
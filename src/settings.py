@@ -58,3 +58,20 @@ if CONFIG_DIR is None:
     sys.exit(1)
 
 HUB_UUID = socket.gethostname()
+
+# Compression of data uploads: none, gzip or zstd (zstd requires the zstandard package).
+# The server must accept the matching Content-Encoding
+UPLOAD_COMPRESSION = os.environ.get("UPLOAD_COMPRESSION", "none").lower()
+if UPLOAD_COMPRESSION not in ("none", "gzip", "zstd"):
+    print("UPLOAD_COMPRESSION must be one of: none, gzip, zstd")
+    sys.exit(1)
+
+UPLOAD_COMPRESSION_LEVEL = int(os.environ.get("UPLOAD_COMPRESSION_LEVEL", "6"))
+
+# Pending files are sealed and handed to the uploader once they are this many seconds old, even if
+# not full. Bounds the upload latency, at the cost of one pending file (and archive part) per period
+PENDING_FILE_MAX_AGE = int(os.environ.get("PENDING_FILE_MAX_AGE", str(15 * 60)))
+
+# The oldest archived data is removed once the archive grows over this many (compressed) bytes,
+# 1GB by default. 0 keeps everything
+ARCHIVE_MAX_BYTES = int(os.environ.get("ARCHIVE_MAX_BYTES", str(1024 * 1024 * 1024)))
@@ -0,0 +1,72 @@
+from __future__ import absolute_import, division, print_function
+
+import threading
+import traceback
+from Queue import Queue, Empty
+
+
+class WorkerPool(object):
+    """
+    Processes items from a shared queue using one worker thread per resource
+    (e.g. one thread per HCI adapter). A resource is only ever used by its own
+    worker, so at most one item is handled per resource at any time
+    """
+
+    def __init__(self, logger, resources, name="worker"):
+        """
+        :param logger:
+        :param resources: list of resources. One worker is started per resource
+        :param name: prefix used for naming worker threads
+        """
+        if len(resources) == 0:
+            raise ValueError("WorkerPool requires at least one resource")
+
+        self.logger = logger
+        self.resources = list(resources)
+        self.name = name
+
+    def run(self, items, work):
+        """
+        Hands the given items to the workers and blocks until all of them were processed.
+        If there is a single resource, items are processed in the calling thread.
+        :param items: items to process
+        :param work: callable, work(item, resource). Exceptions are logged and do not stop the worker
+        :return: number of items processed without raising an exception
+        """
+        queue = Queue()
+        for item in items:
+            queue.put(item)
+
+        counter = {'done': 0}
+        counter_lock = threading.Lock()
+
+        def worker(resource):
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    return
+
+                try:
+                    work(item, resource)
+                    with counter_lock:
+                        counter['done'] += 1
+                except Exception as e:
+                    s = traceback.format_exc()
+                    self.logger.error("{} ({}) failed processing {}: {}, {}".format(self.name, resource, item, e, s))
+
+        if len(self.resources) == 1:
+            worker(self.resources[0])
+            return counter['done']
+
+        threads = []
+        for resource in self.resources:
+            t = threading.Thread(target=worker, args=(resource,), name="{}-{}".format(self.name, resource))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        return counter['done']
@@ -0,0 +1,178 @@
+"""
+Benchmarks pulling with several (simulated) HCI adapters in parallel
+
+Usage: PYTHONPATH=src python tests/bench_adapter_pool.py [--badges 20] [--chunks 60] [--scans 10]
+                                                          [--adapters 1 2 4] [--pipelined]
+
+Every badge is pulled through the real collect path, badge_hub.dialogue and Badge.pull_data, with
+received data stored in the pending files. Only the BLE link is simulated: BadgeConnection is
+replaced by a connection that answers the badge requests and streams --chunks audio chunks and
+--scans proximity scans, taking --connect_time seconds to connect and --packet_time seconds per
+notification. Each simulated adapter holds one connection at a time. The numbers reflect the
+scheduling of WorkerPool and the cost of the pull and storage code, not the speed of a real radio.
+
+The hub settings are read from the environment. DATA_DIR, LOG_DIR and CONFIG_DIR default to a
+temporary directory, so a run does not add data to a hub
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+_tmp_dir = tempfile.mkdtemp(prefix="bench_adapter_pool_")
+for _name in ("DATA_DIR", "LOG_DIR", "CONFIG_DIR"):
+    os.environ.setdefault(_name, _tmp_dir + "/")
+for _name, _value in (("BADGE_SERVER_ADDR", "localhost"), ("BADGE_SERVER_PORT", "8000"), ("APPKEY", "bench")):
+    os.environ.setdefault(_name, _value)
+
+import badge
+import badge_hub
+from badge import Badge, STATUS, TIMESTAMP, CHUNK_HEADER, SCAN_HEADER, SEEN_DEVICE
+from worker_pool import WorkerPool
+
+PACKET_SIZE = 20  # payload of a notification
+SAMPLES_PER_CHUNK = 114
+DEVICES_PER_SCAN = 10
+
+
+def _packets(data):
+    return [data[i:i + PACKET_SIZE] for i in range(0, len(data), PACKET_SIZE)]
+
+
+def audio_notifications(ts, num_chunks):
+    notifications = []
+    for i in range(num_chunks):
+        notifications.append(CHUNK_HEADER.pack(ts + i * 6, 0, 2.9, 50, SAMPLES_PER_CHUNK))
+        notifications.extend(_packets(bytes(bytearray(j % 60 for j in range(SAMPLES_PER_CHUNK)))))
+    notifications.append(CHUNK_HEADER.pack(0, 0, 0, 0, 0))
+    return notifications
+
+
+def scan_notifications(ts, num_scans):
+    devices = "".join(SEEN_DEVICE.pack(device_id, -60, 1) for device_id in range(1, DEVICES_PER_SCAN + 1))
+    notifications = []
+    for i in range(num_scans):
+        notifications.append(SCAN_HEADER.pack(ts + i * 15, 2.9, DEVICES_PER_SCAN))
+        notifications.extend(_packets(devices))
+    notifications.append(SCAN_HEADER.pack(0, 0, 0))
+    return notifications
+
+
+class SimulatedAdapter(object):
+    """
+    Stands in for an HCI adapter. Only one connection may be open at a time
+    """
+
+    def __init__(self, index, connect_time, packet_time, num_chunks, num_scans):
+        self.index = index
+        self.connect_time = connect_time
+        self.packet_time = packet_time
+        self.num_chunks = num_chunks
+        self.num_scans = num_scans
+        self.pulls = 0
+        self.radio = threading.Lock()
+
+
+class SimulatedConnection(object):
+    """
+    Stands in for BadgeConnection. Answers the requests of Badge like a badge with a backlog would
+    """
+    adapters = {}  # HCI index -> SimulatedAdapter
+
+    def __init__(self, dlg):
+        self.dlg = dlg
+        self.adapter = None
+        self.notifications = collections.deque()
+
+    def open(self, addr, iface=None):
+        adapter = self.adapters[iface]
+        if not adapter.radio.acquire(False):
+            raise RuntimeError("hci{} is already connected to another badge".format(iface))
+        self.adapter = adapter
+        time.sleep(adapter.connect_time)
+
+    def write(self, fmt, *arr):
+        command = arr[0]
+        now = int(time.time())
+        if command == "s":
+            self.notifications.append(STATUS.pack(1, 0, 0, now, 0, 2.9))
+        elif command in ("1", "p"):
+            self.notifications.append(TIMESTAMP.pack(now, 0))
+        elif command == "r":
+            self.notifications.extend(audio_notifications(arr[1] + 1, self.adapter.num_chunks))
+        elif command == "b":
+            self.notifications.extend(scan_notifications(arr[1], self.adapter.num_scans))
+
+    def waitForNotifications(self, timeout):
+        if not self.notifications:
+            time.sleep(timeout)
+            return False
+        time.sleep(self.adapter.packet_time)
+        self.dlg.handleNotification(None, self.notifications.popleft())
+        return True
+
+    def abort(self):
+        pass
+
+    def disconnect(self):
+        if self.adapter is not None:
+            self.adapter.pulls += 1
+            self.adapter.radio.release()
+            self.adapter = None
+
+
+def run(num_badges, adapters, sleep_between, pipelined):
+    SimulatedConnection.adapters = {adapter.index: adapter for adapter in adapters}
+    logger = logging.getLogger('bench')
+    badges = [Badge("AA:BB:CC:DD:EE:{:02X}".format(i), logger, "key{}".format(i), badge_id=i, project_id=1,
+                    init_audio_ts_int=1500000000, init_audio_ts_fract=0, init_proximity_ts=1500000000)
+              for i in range(num_badges)]
+
+    def collect(bdg, iface):
+        badge_hub.dialogue(bdg, True, True, "server", iface, pipelined=pipelined)
+        time.sleep(sleep_between)
+
+    pool = WorkerPool(logger, sorted(SimulatedConnection.adapters), name="hci")
+    start = time.time()
+    pool.run(badges, collect)
+    elapsed = time.time() - start
+    badge_hub.close_writers()
+
+    # every badge was pulled completely
+    pulled = sum(1 for bdg in badges if bdg.last_proximity_ts > 1500000000)
+    return pulled, elapsed, [adapter.pulls for adapter in adapters]
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+
+    parser = argparse.ArgumentParser(description="Benchmark parallel pulls over simulated adapters")
+    parser.add_argument('--badges', type=int, default=20)
+    parser.add_argument('--chunks', type=int, default=60, help="audio chunks pulled from every badge")
+    parser.add_argument('--scans', type=int, default=10, help="proximity scans pulled from every badge")
+    parser.add_argument('--connect_time', type=float, default=0.5, help="seconds to connect to a badge")
+    parser.add_argument('--packet_time', type=float, default=0.0075, help="seconds per notification")
+    parser.add_argument('--sleep', type=float, default=0.2, help="sleep between devices, per adapter")
+    parser.add_argument('--adapters', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--pipelined', action='store_true', default=False, help="pipelined handshake")
+    args = parser.parse_args()
+
+    # the pull logs every request
+    badge_hub.logger.setLevel(logging.WARNING)
+    badge.BadgeConnection = SimulatedConnection
+
+    print("{:>8} {:>8} {:>10} {:>14}  {}".format("adapters", "badges", "seconds", "badges/minute", "pulls per adapter"))
+    try:
+        for n in args.adapters:
+            adapters = [SimulatedAdapter(i, args.connect_time, args.packet_time, args.chunks, args.scans)
+                        for i in range(n)]
+            pulled, elapsed, per_adapter = run(args.badges, adapters, args.sleep, args.pipelined)
+            print("{:>8} {:>8} {:>10.2f} {:>14.1f}  {}".format(n, pulled, elapsed, pulled * 60 / elapsed, per_adapter))
+    finally:
+        shutil.rmtree(_tmp_dir)
@@ -0,0 +1,94 @@
+"""
+Benchmarks the binary audio format against JSON-lines
+
+Usage: PYTHONPATH=src python tests/bench_audio_format.py [pending audio files...] [--chunks 5000]
+
+Reports bytes on disk (raw and gzip-ed, as in the archive) and encode/decode throughput.
+Without files, synthetic audio chunks are used
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import gzip
+import json
+import random
+import time
+from StringIO import StringIO
+
+from audio_format import Encoder, decode, file_header
+
+
+def synthetic_log_lines(num_chunks, num_badges=20):
+    log_lines = []
+    for i in range(num_chunks):
+        badge = i % num_badges
+        log_lines.append({
+            'type': "audio received",
+            'log_timestamp': round(1500000000.0 + i * 0.3, 3),
+            'log_index': -1,
+            'data': {
+                'voltage': round(random.uniform(2.6, 3.0), 3),
+                'timestamp': round(1500000000.0 + i * 5.7, 3),
+                'sample_period': 50,
+                'num_samples': 114,
+                'samples': [max(0, min(255, int(random.gauss(20, 8)))) for _ in range(114)],
+                'badge_address': "E8:E3:D9:72:A1:{:02X}".format(badge),
+                'member': "MEMBER{:04d}".format(badge),
+                'member_id': badge,
+            }
+        })
+    return log_lines
+
+
+def gzip_size(data):
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6)
+    gz.write(data)
+    gz.close()
+    return len(buf.getvalue())
+
+
+def timed(f, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the binary audio format")
+    parser.add_argument('files', nargs='*', help="pending audio files (JSON-lines)")
+    parser.add_argument('--chunks', type=int, default=5000, help="number of synthetic chunks")
+    args = parser.parse_args()
+
+    if args.files:
+        log_lines = []
+        for filename in args.files:
+            with open(filename) as f:
+                log_lines.extend(json.loads(line) for line in f if line.strip())
+    else:
+        log_lines = synthetic_log_lines(args.chunks)
+
+    def encode_json():
+        return "".join(json.dumps(log_line) + "\n" for log_line in log_lines)
+
+    def encode_binary():
+        encoder = Encoder()
+        return file_header() + "".join(encoder.encode(log_line) for log_line in log_lines)
+
+    json_time, json_data = timed(encode_json)
+    binary_time, binary_data = timed(encode_binary)
+    json_decode_time, _ = timed(lambda: [json.loads(line) for line in json_data.splitlines()])
+    binary_decode_time, decoded = timed(lambda: list(decode(StringIO(binary_data))))
+    assert decoded == log_lines
+
+    n = len(log_lines)
+    print("{} chunks".format(n))
+    print("{:<8} {:>12} {:>12} {:>16} {:>16}".format("format", "bytes", "gzip bytes", "encode chunks/s", "decode chunks/s"))
+    for name, data, encode_time, decode_time in (("json", json_data, json_time, json_decode_time),
+                                                 ("binary", binary_data, binary_time, binary_decode_time)):
+        print("{:<8} {:>12} {:>12} {:>16.0f} {:>16.0f}".format(
+            name, len(data), gzip_size(data), n / encode_time, n / decode_time))
@@ -0,0 +1,146 @@
+"""
+Benchmarks compressed uploads of pending files
+
+Usage: PYTHONPATH=src python tests/bench_compression.py [pending files...] [--kbps 1000]
+
+For each compression mode, reports the compression ratio, the time spent compressing,
+the time it takes to upload the batches to a local stand-in server, and the estimated
+transfer time over a link of the given bandwidth (e.g. cellular). Without files, a
+synthetic pending file with audio chunks is generated
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+# settings.py requires these, even though nothing is sent to a real server
+_tmp = tempfile.mkdtemp()
+for _name in ("DATA_DIR", "LOG_DIR", "CONFIG_DIR"):
+    os.environ.setdefault(_name, _tmp)
+os.environ.setdefault("APPKEY", "bench")
+os.environ.setdefault("BADGE_SERVER_ADDR", "127.0.0.1")
+os.environ.setdefault("BADGE_SERVER_PORT", "8000")
+
+import badge_hub
+import hub_manager
+import serializers
+import server
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('content-length', 0)))
+        body = '{"chunks_written": 0}'
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+def generate_pending_file(filename, num_chunks=2000):
+    """
+    Writes audio chunks in the same format as badge_hub.dialogue
+    """
+    ts = 1500000000.0
+    with open(filename, "w") as f:
+        for i in range(num_chunks):
+            samples = [max(0, min(255, int(random.gauss(20, 8)))) for _ in range(114)]
+            json.dump({
+                'type': "audio received",
+                'log_timestamp': round(time.time(), 3),
+                'log_index': -1,
+                'data': {
+                    'voltage': 2.871,
+                    'timestamp': round(ts + i * 5.7, 3),
+                    'sample_period': 50,
+                    'num_samples': len(samples),
+                    'samples': samples,
+                    'badge_address': "E8:E3:D9:72:A1:13",
+                    'member': "X8W1Q7GL1X",
+                    'member_id': 12,
+                }
+            }, f)
+            f.write('\n')
+
+
+def read_bodies(filename, max_bytes):
+    """
+    Reads a pending file into request bodies, the way badge_hub.offload_file does
+    """
+    data_type = badge_hub.get_data_type(filename)
+    with open(filename, "rb") as f:
+        serializer = serializers.detect(f)
+        return [hub_manager.serialized_data_body(data_type, batch)
+                for batch, batch_end in badge_hub.read_batches(f, max_bytes, 0, serializer)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark compressed uploads")
+    parser.add_argument('files', nargs='*', help="recorded pending files")
+    parser.add_argument('--kbps', type=float, default=1000, help="link bandwidth used for the transfer estimate")
+    parser.add_argument('--batch', type=int, default=badge_hub.UPLOAD_BATCH_SIZE, help="upload batch size in bytes")
+    args = parser.parse_args()
+
+    files = args.files
+    if not files:
+        files = [os.path.join(_tmp, "pending_synthetic_audio.txt")]
+        generate_pending_file(files[0])
+
+    httpd = ThreadedHTTPServer(("127.0.0.1", 0), StandInHandler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    url = "http://127.0.0.1:{}/datafiles".format(httpd.server_address[1])
+
+    modes = [("none", 0), ("gzip", 1), ("gzip", 6), ("gzip", 9)]
+    if hub_manager.zstandard is not None:
+        modes += [("zstd", 3), ("zstd", 10)]
+
+    bodies = []
+    for filename in files:
+        bodies.extend(read_bodies(filename, args.batch))
+    raw_size = sum(len(b) for b in bodies)
+    print("{} batches, {} bytes".format(len(bodies), raw_size))
+
+    print("{:<10} {:>12} {:>7} {:>14} {:>12} {:>14}".format(
+        "mode", "bytes", "ratio", "compress (s)", "upload (s)", "@{:g}kbps (s)".format(args.kbps)))
+    for compression, level in modes:
+        start = time.time()
+        encoded = [hub_manager.compress_body(b, compression, level) for b in bodies]
+        compress_time = time.time() - start
+        size = sum(len(body) for body, encoding in encoded)
+
+        start = time.time()
+        for body, encoding in encoded:
+            headers = {"content-type": "application/json"}
+            if encoding is not None:
+                headers["content-encoding"] = encoding
+            server.session().post(url, data=body, headers=headers, timeout=server.UPLOAD_TIMEOUT)
+        upload_time = time.time() - start
+
+        print("{:<10} {:>12} {:>7.2f} {:>14.3f} {:>12.3f} {:>14.1f}".format(
+            "{}-{}".format(compression, level), size, raw_size / size, compress_time, upload_time,
+            compress_time + size * 8 / (args.kbps * 1000)))
+
+    httpd.shutdown()
+    httpd.server_close()
@@ -0,0 +1,95 @@
+"""
+Benchmarks the shared keep-alive session against one-off requests calls
+
+Usage: PYTHONPATH=src python tests/bench_http_session.py [--requests 500]
+
+Starts a local HTTP/1.1 stand-in server (so no openbadge-server is needed) and
+reports requests/second for module-level requests.get/patch (a new connection per
+call) and for server.session() (pooled, keep-alive connections)
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+# settings.py requires these, even though nothing is sent to a real server
+_tmp = tempfile.mkdtemp()
+for _name in ("DATA_DIR", "LOG_DIR", "CONFIG_DIR"):
+    os.environ.setdefault(_name, _tmp)
+os.environ.setdefault("APPKEY", "bench")
+os.environ["BADGE_SERVER_ADDR"] = "127.0.0.1"
+os.environ["BADGE_SERVER_PORT"] = "18765"
+
+import requests
+import server
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # allows keep-alive
+    disable_nagle_algorithm = True  # headers and body are separate writes
+    body = '{"ok": true}'
+
+    def _reply(self):
+        length = int(self.headers.get('content-length', 0))
+        if length:
+            self.rfile.read(length)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    do_GET = _reply
+    do_PATCH = _reply
+    do_POST = _reply
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # keep-alive connections are cut when the server shuts down
+        pass
+
+
+def measure(label, call, n):
+    start = time.time()
+    for i in range(n):
+        call(i)
+    elapsed = time.time() - start
+    print("{:<28} {:>6} requests {:>8.2f} s {:>10.1f} req/s".format(label, n, elapsed, n / elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pooled vs one-off HTTP requests")
+    parser.add_argument('--requests', type=int, default=500, dest='n')
+    args = parser.parse_args()
+
+    httpd = ThreadedHTTPServer(("127.0.0.1", int(os.environ["BADGE_SERVER_PORT"])), StandInHandler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+
+    headers = server.request_headers()
+    url = lambda i: server.BADGE_ENDPOINT("badge{}".format(i % 80))
+    data = {'last_voltage': 2.9, 'last_seen_ts': 1500000000.0}
+
+    measure("requests.get (before)",
+            lambda i: requests.get(url(i), headers=headers, timeout=server.DEFAULT_TIMEOUT), args.n)
+    measure("session().get (after)",
+            lambda i: server.session().get(url(i), headers=headers, timeout=server.DEFAULT_TIMEOUT), args.n)
+    measure("requests.patch (before)",
+            lambda i: requests.patch(url(i), data=data, headers=headers, timeout=server.DEFAULT_TIMEOUT), args.n)
+    measure("session().patch (after)",
+            lambda i: server.session().patch(url(i), data=data, headers=headers, timeout=server.DEFAULT_TIMEOUT), args.n)
+
+    httpd.shutdown()
+    httpd.server_close()
@@ -0,0 +1,96 @@
+"""
+Measures the memory held by the data of a long backlog pull
+
+Usage: PYTHONPATH=src python tests/bench_memory.py [--hours 24] [--devices 10] [--sink]
+
+Simulates pulling the backlog of a badge that was offline for --hours: every audio chunk and
+proximity scan it recorded is sent through BadgeDelegate, which holds all of them until the pull
+ends. Reports the peak RSS of the process and how much of the memory of a 512 MB Pi it takes.
+Notifications are generated on the fly, so they do not add to the peak. With --sink, chunks and
+scans are passed to a DataSink that drops them, as a sink storing them right away would.
+
+Only the notification layouts are defined here, so the benchmark runs against any version of badge.py
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import random
+import resource
+import struct
+import time
+
+from badge import BadgeDelegate, Expect
+
+PI_MEMORY = 512 * 1024 * 1024
+PACKET_SIZE = 20  # payload of a notification
+SAMPLES_PER_CHUNK = 114
+SAMPLE_PERIOD = 50  # ms
+SCAN_PERIOD = 15  # s
+
+_CHUNK_HEADER = struct.Struct('<LHfHB')
+_SCAN_HEADER = struct.Struct('<LfB')
+_SEEN_DEVICE = struct.Struct('<Hbb')
+
+
+def peak_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def audio_notifications(num_chunks):
+    samples = bytearray(SAMPLES_PER_CHUNK)
+    start = int(time.time())
+    for i in range(num_chunks):
+        yield _CHUNK_HEADER.pack(start + i * SAMPLES_PER_CHUNK * SAMPLE_PERIOD // 1000, 0, 2.9, SAMPLE_PERIOD,
+                                 SAMPLES_PER_CHUNK)
+        for j in range(SAMPLES_PER_CHUNK):
+            samples[j] = random.randint(0, 60)
+        data = bytes(samples)
+        for offset in range(0, len(data), PACKET_SIZE):
+            yield data[offset:offset + PACKET_SIZE]
+    yield _CHUNK_HEADER.pack(0, 0, 0, 0, 0)
+
+
+def scan_notifications(num_scans, num_devices):
+    start = int(time.time())
+    for i in range(num_scans):
+        yield _SCAN_HEADER.pack(start + i * SCAN_PERIOD, 2.9, num_devices)
+        devices = b"".join(_SEEN_DEVICE.pack(random.randint(1, 60000), random.randint(-100, -40), 1)
+                           for _ in range(num_devices))
+        for offset in range(0, len(devices), PACKET_SIZE):
+            yield devices[offset:offset + PACKET_SIZE]
+    yield _SCAN_HEADER.pack(0, 0, 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the memory held by the data of a backlog pull")
+    parser.add_argument('--hours', type=float, default=24, help="hours of backlog")
+    parser.add_argument('--devices', type=int, default=10, help="devices seen in each scan")
+    parser.add_argument('--sink', action='store_true', default=False, help="push data to a sink")
+    args = parser.parse_args()
+
+    num_chunks = int(args.hours * 3600 * 1000 / (SAMPLES_PER_CHUNK * SAMPLE_PERIOD))
+    num_scans = int(args.hours * 3600 / SCAN_PERIOD)
+
+    if args.sink:
+        from badge import DataSink
+        delegate = BadgeDelegate(None, sink=DataSink())
+    else:
+        delegate = BadgeDelegate(None)
+    before = peak_rss()
+
+    delegate.expected = Expect.header
+    for notification in audio_notifications(num_chunks):
+        delegate.handleNotification(None, notification)
+    delegate.expected = Expect.scanHeader
+    for notification in scan_notifications(num_scans, args.devices):
+        delegate.handleNotification(None, notification)
+    after = peak_rss()
+
+    assert args.sink or (len(delegate.chunks) == num_chunks and len(delegate.scans) == num_scans)
+    print("{:g} hours of backlog: {} chunks, {} scans of {} devices".format(
+        args.hours, num_chunks, num_scans, args.devices))
+    print("peak RSS: {:.1f} MB before the pull, {:.1f} MB after ({:.1f}% of a 512 MB Pi)".format(
+        before / 2 ** 20, after / 2 ** 20, after * 100 / PI_MEMORY))
+    print("held by the pulled data: {:.1f} MB, {:.0f} bytes per chunk or scan".format(
+        (after - before) / 2 ** 20, (after - before) / (num_chunks + num_scans)))
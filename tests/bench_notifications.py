@@ -0,0 +1,123 @@
+"""
+Benchmarks the decoding of badge notifications by BadgeDelegate
+
+Usage: PYTHONPATH=src python tests/bench_notifications.py [stream file] [--chunks 2000] [--scans 500]
+                                                           [--save stream file]
+
+Replays a stream of notifications through the delegate, the way a badge sends them during a pull
+(chunk headers and sample packets, then scan headers and device packets), and reports the
+notifications decoded per second and the memory held by the decoded samples. Proximity scans
+are decoded and turned into rssi_distances with and without NumPy (when it is installed).
+
+A stream file has one notification per line: "audio" or "proximity", then the packet in hex.
+Without one, a synthetic stream is used. --save writes the stream that was replayed, so the
+same stream can be replayed against other versions of the delegate
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import binascii
+import random
+import struct
+import sys
+import time
+
+import badge
+from badge import BadgeDelegate, Expect, CHUNK_HEADER, SCAN_HEADER, SEEN_DEVICE
+
+PACKET_SIZE = 20  # payload of a notification
+SAMPLES_PER_CHUNK = 114
+AUDIO = "audio"
+PROXIMITY = "proximity"
+
+
+def _packets(data):
+    return [data[i:i + PACKET_SIZE] for i in range(0, len(data), PACKET_SIZE)]
+
+
+def synthetic_stream(num_chunks, num_scans):
+    """
+    :return: list of (data type, notification) tuples
+    """
+    stream = []
+    for i in range(num_chunks):
+        stream.append((AUDIO, CHUNK_HEADER.pack(1500000000 + i * 6, i % 1000, 2.9, 50, SAMPLES_PER_CHUNK)))
+        samples = struct.pack("<%dB" % SAMPLES_PER_CHUNK,
+                              *[max(0, min(255, int(random.gauss(20, 8)))) for _ in range(SAMPLES_PER_CHUNK)])
+        stream.extend((AUDIO, packet) for packet in _packets(samples))
+    stream.append((AUDIO, CHUNK_HEADER.pack(0, 0, 0, 0, 0)))
+
+    for i in range(num_scans):
+        num_devices = random.randint(0, 15)
+        stream.append((PROXIMITY, SCAN_HEADER.pack(1500000000 + i * 15, 2.9, num_devices)))
+        devices = "".join(SEEN_DEVICE.pack(random.randint(1, 60000), random.randint(-100, -40), random.randint(1, 5))
+                          for _ in range(num_devices))
+        stream.extend((PROXIMITY, packet) for packet in _packets(devices))
+    stream.append((PROXIMITY, SCAN_HEADER.pack(0, 0, 0)))
+    return stream
+
+
+def load_stream(file_name):
+    with open(file_name) as f:
+        return [(data_type, binascii.unhexlify(packet)) for data_type, packet in (line.split() for line in f)]
+
+
+def save_stream(stream, file_name):
+    with open(file_name, "w") as f:
+        for data_type, packet in stream:
+            f.write("{} {}\n".format(data_type, binascii.hexlify(packet)))
+
+
+def replay(stream):
+    """
+    Replays the stream through a new delegate
+    :return: the delegate
+    """
+    delegate = BadgeDelegate(None)
+    data_type = None
+    for packet_type, packet in stream:
+        if packet_type != data_type:
+            # the dialogue sets what is expected when it requests data
+            data_type = packet_type
+            delegate.expected = Expect.header if data_type == AUDIO else Expect.scanHeader
+        delegate.handleNotification(None, packet)
+    return delegate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the decoding of badge notifications")
+    parser.add_argument('stream', nargs='?', help="recorded stream of notifications")
+    parser.add_argument('--chunks', type=int, default=2000, help="number of synthetic audio chunks")
+    parser.add_argument('--scans', type=int, default=500, help="number of synthetic scans")
+    parser.add_argument('--save', help="write the replayed stream to this file")
+    args = parser.parse_args()
+
+    stream = load_stream(args.stream) if args.stream else synthetic_stream(args.chunks, args.scans)
+    if args.save:
+        save_stream(stream, args.save)
+
+    def timed(f, repeat=5):
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            result = f()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    best, delegate = timed(lambda: replay(stream))
+
+    num_samples = sum(chunk.received for chunk in delegate.chunks)
+    samples_size = sum(sys.getsizeof(chunk.samples) for chunk in delegate.chunks)
+    print("{} notifications, {} chunks, {} scans".format(len(stream), len(delegate.chunks), len(delegate.scans)))
+    print("{:.0f} notifications/s, {:.2f} us per notification".format(len(stream) / best, best / len(stream) * 1e6))
+    print("samples: {} bytes for {} samples ({:.2f} bytes/sample)".format(
+        samples_size, num_samples, samples_size / max(num_samples, 1)))
+
+    proximity = [(data_type, packet) for data_type, packet in stream if data_type == PROXIMITY]
+    modes = [False, True] if badge.numpy is not None else [False]
+    for use_numpy in modes:
+        badge.USE_NUMPY = use_numpy
+        elapsed, scans = timed(lambda: [scan.rssiDistances() for scan in replay(proximity).scans])
+        print("proximity ({}): {:.0f} scans/s".format("numpy" if use_numpy else "SeenDevice",
+                                                      len(scans) / elapsed))
@@ -0,0 +1,74 @@
+"""
+Benchmarks the serializers of dialogue output
+
+Usage: PYTHONPATH=src python tests/bench_serializers.py [--chunks 5000]
+
+Reports the CPU time spent building and serializing audio log lines, the way dialogue does,
+for each serializer, and for the former string based rounding of floats
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import random
+import time
+
+import serializers
+
+
+def round_with_format(x):
+    return float("{0:.3f}".format(x))
+
+
+def round_with_round(x):
+    return round(x, 3)
+
+
+def log_lines(chunks, round_float):
+    for i, (ts, voltage, samples) in enumerate(chunks):
+        yield {
+            'type': "audio received",
+            'log_timestamp': round_float(time.time()),
+            'log_index': -1,
+            'data': {
+                'voltage': round_float(voltage),
+                'timestamp': round_float(ts),
+                'sample_period': 50,
+                'num_samples': len(samples),
+                'samples': samples,
+                'badge_address': "E8:E3:D9:72:A1:{:02X}".format(i % 20),
+                'member': "MEMBER{:04d}".format(i % 20),
+                'member_id': i % 20,
+            }
+        }
+
+
+def bench(chunks, serializer, round_float):
+    start = time.clock()
+    encoder = serializer.encoder()
+    size = len(encoder.header())
+    for log_line in log_lines(chunks, round_float):
+        size += len(encoder.encode(log_line))
+    return time.clock() - start, size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the serializers of dialogue output")
+    parser.add_argument('--chunks', type=int, default=5000, help="number of audio chunks")
+    args = parser.parse_args()
+
+    chunks = [(1500000000.0 + i * 5.7123456, random.uniform(2.6, 3.0),
+               [max(0, min(255, int(random.gauss(20, 8)))) for _ in range(114)])
+              for i in range(args.chunks)]
+
+    cases = [("json, str.format rounding", serializers.JSON, round_with_format),
+             ("json", serializers.JSON, round_with_round),
+             ("binary", serializers.BINARY, round_with_round)]
+    if serializers.msgpack is not None:
+        cases.insert(2, ("msgpack", serializers.MSGPACK, round_with_round))
+
+    print("{} chunks".format(args.chunks))
+    print("{:<28} {:>10} {:>14} {:>12}".format("serializer", "cpu (s)", "chunks/s", "bytes"))
+    for label, name, round_float in cases:
+        cpu, size = min(bench(chunks, serializers.get(name), round_float) for _ in range(3))
+        print("{:<28} {:>10.3f} {:>14.0f} {:>12}".format(label, cpu, args.chunks / cpu, size))
@@ -0,0 +1,178 @@
+import unittest
+import glob
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+import serializers
+from archive import Archive, MANIFEST_SUFFIX, SEGMENT_SUFFIX
+
+
+def _write_file(directory, name, badges, timestamps):
+    filename = os.path.join(directory, name)
+    with open(filename, "w") as f:
+        for badge, ts in zip(badges, timestamps):
+            json.dump({'type': "audio received", 'data': {'badge_address': badge, 'timestamp': ts}}, f)
+            f.write('\n')
+    return filename
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.archive = Archive(os.path.join(self.tmp, "archive"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_seal_writes_segment_and_manifest(self):
+        filename = _write_file(self.tmp, "uploading_20170712103000_audio.txt",
+                               ["AA:01", "AA:00", "AA:01"], [1499855402.5, 1499855400.0, 1499855410.0])
+        with open(filename) as f:
+            raw = f.read()
+
+        manifest = self.archive.seal(filename, "audio")
+
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(manifest['segment'], "2017-07-12/2017071210_audio" + SEGMENT_SUFFIX)
+        self.assertEqual(manifest['badges'], ["AA:00", "AA:01"])
+        self.assertEqual((manifest['start_ts'], manifest['end_ts']), (1499855400.0, 1499855410.0))
+        self.assertEqual(manifest['chunks'], 3)
+        self.assertEqual(manifest['raw_bytes'], len(raw))
+        self.assertEqual(manifest['compressed_bytes'],
+                         os.path.getsize(self.archive.archive_dir + manifest['segment']))
+        self.assertEqual([part['source'] for part in manifest['parts']], ["uploading_20170712103000_audio.txt"])
+        self.assertEqual(self.archive.segments(), [manifest])
+        self.assertEqual("".join(self.archive.read_segment(manifest)), raw)
+
+    def test_files_of_an_hour_share_a_segment(self):
+        first = _write_file(self.tmp, "uploading_20170712103000_audio.txt", ["AA:00"], [20.0])
+        second = _write_file(self.tmp, "uploading_20170712105900_audio.txt", ["AA:01"], [10.0])
+        with open(first) as f1, open(second) as f2:
+            raw = f1.read() + f2.read()
+        self.archive.seal(first, "audio")
+        manifest = self.archive.seal(second, "audio")
+        # another data type, and another hour
+        self.archive.seal(_write_file(self.tmp, "uploading_20170712103000_proximity.txt", ["AA:00"], [1.0]),
+                          "proximity")
+        self.archive.seal(_write_file(self.tmp, "uploading_20170712110000_audio.txt", ["AA:00"], [1.0]), "audio")
+
+        self.assertEqual([m['segment'] for m in self.archive.segments()],
+                         ["2017-07-12/2017071210_audio" + SEGMENT_SUFFIX,
+                          "2017-07-12/2017071210_proximity" + SEGMENT_SUFFIX,
+                          "2017-07-12/2017071211_audio" + SEGMENT_SUFFIX])
+        self.assertEqual(manifest['badges'], ["AA:00", "AA:01"])
+        self.assertEqual((manifest['start_ts'], manifest['end_ts'], manifest['chunks']), (10.0, 20.0, 2))
+        self.assertEqual([part['offset'] for part in manifest['parts']], [0, manifest['parts'][0]['compressed_bytes']])
+        self.assertEqual("".join(self.archive.read_segment(manifest)), raw)
+        # a plain gzip reader sees the concatenated files
+        with gzip.open(self.archive.archive_dir + manifest['segment'], "rb") as f:
+            self.assertEqual(f.read(), raw)
+
+    def test_binary_segment_keeps_raw_bytes(self):
+        filename = os.path.join(self.tmp, "uploading_20170712103000_audio.txt")
+        encoder = serializers.get(serializers.BINARY).encoder()
+        with open(filename, "wb") as f:
+            f.write(encoder.header())
+            for i in range(3):
+                f.write(encoder.encode({'type': "audio received", 'log_timestamp': 1.5, 'log_index': -1,
+                                        'data': {'voltage': 2.9, 'timestamp': 100.0 + i, 'sample_period': 50,
+                                                 'num_samples': 1, 'samples': [i], 'badge_address': "AA:00",
+                                                 'member': "M", 'member_id': 1}}))
+        with open(filename, "rb") as f:
+            raw = f.read()
+
+        manifest = self.archive.seal(filename, "audio")
+        # followed by a file of another format
+        self.archive.seal(_write_file(self.tmp, "uploading_20170712104000_audio.txt", ["AA:01"], [103.0]), "audio")
+        manifest = self.archive.segments()[0]
+
+        self.assertEqual([part['format'] for part in manifest['parts']], ["binary", "json"])
+        self.assertEqual((manifest['chunks'], manifest['badges']), (4, ["AA:00", "AA:01"]))
+        self.assertEqual((manifest['start_ts'], manifest['end_ts']), (100.0, 103.0))
+        with gzip.open(self.archive.archive_dir + manifest['segment'], "rb") as f:
+            self.assertEqual(f.read(len(raw)), raw)
+        self.assertEqual([json.loads(line)['data']['timestamp'] for line in self.archive.read_segment(manifest)],
+                         [100.0, 101.0, 102.0, 103.0])
+
+    def test_seal_again_after_crash(self):
+        filename = _write_file(self.tmp, "uploading_20170712103000_audio.txt", ["AA:00"], [1.0])
+        with open(filename) as f:
+            raw = f.read()
+        manifest = self.archive.seal(filename, "audio")
+
+        # the file was sealed, but not removed
+        with open(filename, "w") as f:
+            f.write(raw)
+        self.assertEqual(self.archive.seal(filename, "audio"), manifest)
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(self.archive.segments(), [manifest])
+
+        # another file with the same name is appended
+        _write_file(self.tmp, "uploading_20170712103000_audio.txt", ["AA:00"], [2.0])
+        self.assertEqual(self.archive.seal(filename, "audio")['chunks'], 2)
+        self.assertEqual(len(self.archive.segments()), 1)
+
+    def test_incomplete_append_is_dropped(self):
+        manifest = self.archive.seal(_write_file(self.tmp, "uploading_20170712103000_audio.txt", ["AA:00"], [1.0]),
+                                     "audio")
+        # left behind by a seal that crashed before updating the manifest
+        with open(self.archive.archive_dir + manifest['segment'], "ab") as f:
+            f.write("partial")
+
+        manifest = self.archive.seal(_write_file(self.tmp, "uploading_20170712104000_audio.txt", ["AA:00"], [2.0]),
+                                     "audio")
+
+        self.assertEqual(manifest['compressed_bytes'], os.path.getsize(self.archive.archive_dir + manifest['segment']))
+        self.assertEqual(len(list(self.archive.read_segment(manifest))), 2)
+
+    def test_segment_without_manifest_is_replaced(self):
+        filename = _write_file(self.tmp, "uploading_20170712103000_audio.txt", ["AA:00"], [1.0])
+        # left behind by a seal that crashed before writing the manifest
+        os.makedirs(self.archive.archive_dir + "2017-07-12")
+        with open(self.archive.archive_dir + "2017-07-12/2017071210_audio" + SEGMENT_SUFFIX, "w") as f:
+            f.write("partial")
+
+        manifest = self.archive.seal(filename, "audio")
+
+        self.assertEqual(manifest['segment'], "2017-07-12/2017071210_audio" + SEGMENT_SUFFIX)
+        self.assertEqual(len(list(self.archive.read_segment(manifest))), 1)
+
+    def test_index_is_read_from_disk(self):
+        for hour in ("10", "11"):
+            self.archive.seal(_write_file(self.tmp, "20170712{}3000_audio.txt".format(hour), ["AA:00"], [1.0]),
+                              "audio")
+        # left behind by a seal that did not complete
+        with open(self.archive.archive_dir + "2017-07-12/20170712123000_audio.txt.tmp", "w") as f:
+            f.write("partial")
+
+        restarted = Archive(self.archive.archive_dir)
+
+        self.assertEqual(restarted.segments(), self.archive.segments())
+        self.assertEqual(restarted.size(), self.archive.size())
+        self.assertEqual(restarted.size(), sum(m['compressed_bytes'] for m in self.archive.segments()))
+        self.assertEqual(glob.glob(self.archive.archive_dir + "*/*.tmp"), [])
+
+    def test_segments_sealed_after(self):
+        first = self.archive.seal(_write_file(self.tmp, "20170712103000_audio.txt", ["AA:00"], [1.0]), "audio")
+        second = self.archive.seal(_write_file(self.tmp, "20170713103000_audio.txt", ["AA:00"], [2.0]), "audio")
+
+        self.assertEqual(self.archive.segments(sealed_after=first['sealed_ts'] - 1), [first, second])
+        self.assertEqual(self.archive.segments(sealed_after=second['sealed_ts']), [])
+
+    def test_retention_removes_oldest(self):
+        for day in ("10", "11", "12"):
+            self.archive.seal(_write_file(self.tmp, "201707{}103000_audio.txt".format(day),
+                                          ["AA:00"] * 50, range(50)), "audio")
+        segments = self.archive.segments()
+        self.archive.max_bytes = sum(m['compressed_bytes'] for m in segments[1:])
+
+        self.assertEqual(self.archive.enforce_retention(), 1)
+
+        self.assertEqual(self.archive.segments(), segments[1:])
+        self.assertEqual(self.archive.size(), self.archive.max_bytes)
+        self.assertFalse(os.path.exists(self.archive.archive_dir + "2017-07-10"))
+        self.assertEqual(len(glob.glob(self.archive.archive_dir + "*/*" + MANIFEST_SUFFIX)), 2)
@@ -0,0 +1,72 @@
+import unittest
+import json
+import random
+from StringIO import StringIO
+
+import audio_format
+from audio_format import Encoder, decode, file_header, json_lines_to_binary, binary_to_json_lines
+
+
+def _chunk(badge="E8:E3:D9:72:A1:13", member="X8W1Q7GL1X", member_id=12, ts=1499855400.123):
+    return {
+        'type': "audio received",
+        'log_timestamp': 1499855410.457,
+        'log_index': -1,
+        'data': {
+            'voltage': 2.871,
+            'timestamp': ts,
+            'sample_period': 50,
+            'num_samples': 114,
+            'samples': [random.randint(0, 255) for _ in range(114)],
+            'badge_address': badge,
+            'member': member,
+            'member_id': member_id,
+        }
+    }
+
+
+def _encode(log_lines):
+    encoder = Encoder()
+    return file_header() + "".join(encoder.encode(log_line) for log_line in log_lines)
+
+
+class TestAudioFormat(unittest.TestCase):
+
+    def test_round_trip(self):
+        log_lines = [_chunk(ts=1499855400.123 + i * 5.7) for i in range(5)]
+        log_lines.append(_chunk(badge="E8:E3:D9:72:A1:14", member="AAAAAAAAAA", member_id=13))
+
+        self.assertEqual(list(decode(StringIO(_encode(log_lines)))), log_lines)
+
+    def test_metadata_is_written_once_per_badge(self):
+        encoder = Encoder()
+        first = encoder.encode(_chunk())
+        second = encoder.encode(_chunk())
+
+        self.assertTrue(first.startswith(audio_format.RECORD_METADATA))
+        self.assertTrue(second.startswith(audio_format.RECORD_AUDIO))
+        self.assertEqual(len(second), 1 + audio_format._CHUNK.size + 114)
+
+    def test_other_records_are_kept_as_json(self):
+        odd = _chunk()
+        odd['data']['samples'][0] = 300
+        proximity = {'type': "proximity received", 'data': {'rssi_distances': {}}}
+        log_lines = [odd, proximity, _chunk()]
+
+        self.assertEqual(list(decode(StringIO(_encode(log_lines)))), log_lines)
+
+    def test_convert(self):
+        log_lines = [_chunk(ts=1499855400.1 + i) for i in range(3)]
+        text = "".join(json.dumps(log_line) + "\n" for log_line in log_lines)
+
+        binary = StringIO()
+        self.assertEqual(json_lines_to_binary(StringIO(text), binary), 3)
+        self.assertTrue(len(binary.getvalue()) < len(text) / 2)
+
+        converted = StringIO()
+        self.assertEqual(binary_to_json_lines(StringIO(binary.getvalue()), converted), 3)
+        self.assertEqual([json.loads(line) for line in converted.getvalue().splitlines()], log_lines)
+
+    def test_rejects_unknown_files(self):
+        self.assertRaises(audio_format.FormatError, list, decode(StringIO('{"type": "audio received"}\n')))
+        self.assertRaises(audio_format.FormatError, list, decode(StringIO(_encode([_chunk()])[:-10])))
@@ -0,0 +1,138 @@
+import unittest
+import filecmp
+import imp
+import os
+import shutil
+import tempfile
+
+backup = imp.load_source("backup", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                "..", "compose", "aws-backup", "backup.py"))
+
+
+def _write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(content)
+
+
+class TestBackup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.data = os.path.join(self.tmp, "data")
+        self.state_dir = os.path.join(self.tmp, "state")
+        self.store = backup.LocalStore(os.path.join(self.tmp, "store"))
+        _write(os.path.join(self.data, "archive", "2017-07-12", "20170712103000_audio.txt.gz"), "segment 1")
+        _write(os.path.join(self.data, "pending_20170712113000_audio.txt"), "pending")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _objects(self):
+        return self.store.list("objects/")
+
+    def test_only_new_files_are_uploaded(self):
+        backup.backup(self.store, backup.State(self.state_dir), [self.data], "hub", "1")
+        objects = sum((self.store.list(d + "/") for d in self._objects()), [])
+        self.assertEqual(len(objects), 2)
+
+        _write(os.path.join(self.data, "archive", "2017-07-12", "20170712113000_audio.txt.gz"), "segment 2")
+        state = backup.State(self.state_dir)
+        uploaded = []
+        put_many = self.store.put_many
+        self.store.put_many = lambda files: (uploaded.extend(files), put_many(files))[1]
+        backup.backup(self.store, state, [self.data], "hub", "2")
+
+        self.assertEqual([k for k in uploaded if k.startswith("objects/")],
+                         [backup.object_key(backup.sha256_file(
+                             os.path.join(self.data, "archive", "2017-07-12", "20170712113000_audio.txt.gz")))])
+        self.assertEqual(backup.list_snapshots(self.store, "hub"), ["1", "2"])
+
+    def test_identical_content_is_stored_once(self):
+        _write(os.path.join(self.data, "copy.txt"), "segment 1")
+
+        snapshot = backup.backup(self.store, backup.State(self.state_dir), [self.data], "hub", "1")
+
+        self.assertEqual(len(snapshot['files']), 3)
+        objects = sum((self.store.list(d + "/") for d in self._objects()), [])
+        self.assertEqual(len(objects), 2)
+
+    def test_restore(self):
+        backup.backup(self.store, backup.State(self.state_dir), [self.data], "hub", "1")
+        _write(os.path.join(self.data, "pending_20170712113000_audio.txt"), "pending, more data")
+        backup.backup(self.store, backup.State(self.state_dir), [self.data], "hub", "2")
+
+        restored = os.path.join(self.tmp, "restored")
+        backup.restore(self.store, restored, "hub", "2")
+        comparison = filecmp.dircmp(self.data, os.path.join(restored, "data"))
+        self.assertEqual(comparison.diff_files + comparison.left_only + comparison.right_only, [])
+        self.assertEqual(filecmp.dircmp(os.path.join(self.data, "archive", "2017-07-12"),
+                                        os.path.join(restored, "data", "archive", "2017-07-12")).diff_files, [])
+
+        backup.restore(self.store, restored, "hub", "1")
+        with open(os.path.join(restored, "data", "pending_20170712113000_audio.txt")) as f:
+            self.assertEqual(f.read(), "pending")
+
+    def test_snapshots_of_other_hosts_are_not_listed(self):
+        # one host name is a prefix of the other
+        backup.backup(self.store, backup.State(self.state_dir), [self.data], "hub", "1")
+        backup.backup(self.store, backup.State(self.state_dir), [self.data], "hub-2", "2")
+
+        self.assertEqual(backup.list_snapshots(self.store, "hub"), ["1"])
+        self.assertEqual(backup.list_snapshots(self.store, "hub-2"), ["2"])
+
+    def test_missing_aws_cli(self):
+        store = backup.S3Store("s3://bucket", aws_cli=os.path.join(self.tmp, "aws"))
+        self.assertEqual(store.keys("objects/"), set())
+        self.assertEqual(store.list("snapshots/hub/"), [])
+
+    def test_lost_state_does_not_upload_again(self):
+        backup.backup(self.store, backup.State(self.state_dir), [self.data], "hub", "1")
+        os.remove(os.path.join(self.state_dir, "backup_state.json"))
+
+        uploaded = []
+        put_many = self.store.put_many
+        self.store.put_many = lambda files: (uploaded.extend(files), put_many(files))[1]
+        backup.backup(self.store, backup.State(self.state_dir), [self.data], "hub", "2")
+
+        self.assertEqual(uploaded, [])
+
+    def test_s3_store_calls_cli_once_per_step(self):
+        # stands in for the aws CLI, over a local directory
+        aws = os.path.join(self.tmp, "aws")
+        calls = os.path.join(self.tmp, "calls")
+        bucket = os.path.join(self.tmp, "bucket")
+        _write(aws, """#!/bin/sh
+echo "$@" >> {calls}
+[ "$1" = s3 ] || exit 1
+shift
+case "$1 $2" in
+"ls --recursive")
+    cd {bucket} && find "hub1/${{3#s3://bucket/hub1/}}" -type f 2>/dev/null | sed 's/^/2017-07-12 10:30:00 1 /';;
+"cp --recursive")
+    mkdir -p {bucket}/hub1 && cp -rL "$4"/. {bucket}/hub1/;;
+"cp --only-show-errors")
+    case "$3" in
+    s3://*) cp {bucket}/hub1/"${{3#s3://bucket/hub1/}}" "$4";;
+    *) mkdir -p "$(dirname {bucket}/hub1/"${{4#s3://bucket/hub1/}}")" && cp "$3" {bucket}/hub1/"${{4#s3://bucket/hub1/}}";;
+    esac;;
+*)
+    exit 1;;
+esac
+""".format(calls=calls, bucket=bucket))
+        os.chmod(aws, 0o755)
+        store = backup.S3Store("s3://bucket/hub1", aws_cli=aws)
+        for i in range(5):
+            _write(os.path.join(self.data, "archive", "2017-07-12", "{}_audio.txt.gz".format(i)), str(i))
+
+        backup.backup(store, backup.State(self.state_dir), [self.data], "hub", "1")
+
+        with open(calls) as f:
+            commands = [line.split()[:2] for line in f]
+        self.assertEqual(commands, [["s3", "ls"], ["s3", "cp"], ["s3", "cp"]])
+        self.assertEqual(len(store.keys("objects/")), 7)
+
+        restored = os.path.join(self.tmp, "restored")
+        backup.restore(store, restored, "hub", "1")
+        self.assertEqual(filecmp.dircmp(self.data, os.path.join(restored, "data")).diff_files, [])
@@ -0,0 +1,105 @@
+import unittest
+import logging
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import badge_manager_server
+from badge_manager_server import BadgeManagerServer
+from badge import Badge
+
+
+class MockBadgeEndpoint(BaseHTTPRequestHandler):
+    """
+    Records PATCH requests. Badges whose key starts with 'bad' get a 500
+    """
+    protocol_version = "HTTP/1.1"
+    received = []
+
+    def do_PATCH(self):
+        length = int(self.headers.get('content-length', 0))
+        body = urlparse.parse_qs(self.rfile.read(length))
+        key = self.path.strip('/').split('/')[-1]
+        self.received.append((key, body))
+
+        status = 500 if key.startswith('bad') else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # keep-alive connections are cut when the server shuts down
+        pass
+
+
+class TestBatchedUpdates(unittest.TestCase):
+
+    def setUp(self):
+        MockBadgeEndpoint.received = []
+        self.httpd = ThreadedHTTPServer(("127.0.0.1", 0), MockBadgeEndpoint)
+        t = threading.Thread(target=self.httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+        port = self.httpd.server_address[1]
+        self._endpoint = badge_manager_server.BADGE_ENDPOINT
+        badge_manager_server.BADGE_ENDPOINT = lambda key: "http://127.0.0.1:{}/badges/{}/".format(port, key)
+
+        logger = logging.getLogger('test_batched_updates')
+        self.mgr = BadgeManagerServer(logger=logger)
+        self.mgr._badges = {}
+        for i, key in enumerate(["key1", "key2", "key3", "bad1"]):
+            mac = "AA:BB:CC:DD:EE:0{}".format(i)
+            self.mgr._badges[mac] = Badge(mac, logger, key, badge_id=i, project_id=1,
+                                          init_audio_ts_int=100, init_audio_ts_fract=0, init_proximity_ts=100)
+
+    def tearDown(self):
+        badge_manager_server.BADGE_ENDPOINT = self._endpoint
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_flush_sends_each_badge_once(self):
+        for mac in self.mgr.badges:
+            self.mgr.queue_badge(mac)
+        # queuing again only updates the data that will be sent
+        mac = "AA:BB:CC:DD:EE:00"
+        self.mgr.badges[mac].last_voltage = 2.5
+        self.mgr.queue_badge(mac)
+
+        sent = self.mgr.flush_badges()
+
+        self.assertEqual(sent, 3)
+        keys = sorted(key for key, body in MockBadgeEndpoint.received)
+        self.assertEqual(keys, ["bad1", "key1", "key2", "key3"])
+        body = dict(MockBadgeEndpoint.received)["key1"]
+        self.assertEqual(body["last_voltage"], ["2.5"])
+
+    def test_failed_updates_are_queued_again(self):
+        for mac in self.mgr.badges:
+            self.mgr.queue_badge(mac)
+        self.mgr.flush_badges()
+
+        MockBadgeEndpoint.received = []
+        self.mgr.flush_badges()
+        self.assertEqual([key for key, body in MockBadgeEndpoint.received], ["bad1"])
+
+    def test_empty_flush(self):
+        self.assertEqual(self.mgr.flush_badges(), 0)
+        self.assertEqual(MockBadgeEndpoint.received, [])
+
+    def test_queue_does_not_send(self):
+        for mac in self.mgr.badges:
+            self.mgr.queue_badge(mac)
+            self.mgr.queue_badge(mac)
+        self.assertEqual(MockBadgeEndpoint.received, [])
+
+        self.assertEqual(self.mgr.flush_badges(), 3)
+        self.assertEqual(len(MockBadgeEndpoint.received), 4)
@@ -0,0 +1,49 @@
+import unittest
+import threading
+import time
+
+from deadline import Deadline, TimeoutError
+
+
+class TestDeadline(unittest.TestCase):
+
+    def test_error_after_on_expire_is_a_timeout(self):
+        aborted = threading.Event()
+        with self.assertRaises(TimeoutError) as cm:
+            with Deadline(0.01, "Status timeout", on_expire=aborted.set):
+                aborted.wait(1)
+                raise IOError("helper died")
+
+        self.assertIn("helper died", str(cm.exception))
+        self.assertIsInstance(cm.exception.cause, IOError)
+
+    def test_other_errors_after_expiry_are_kept(self):
+        # without on_expire, nothing was cancelled
+        with self.assertRaises(ValueError):
+            with Deadline(0.001, "Status timeout"):
+                time.sleep(0.01)
+                raise ValueError()
+
+    def test_on_expire_not_invoked_after_exit(self):
+        calls = []
+        with Deadline(0.01, on_expire=lambda: calls.append(1)) as deadline:
+            pass
+        time.sleep(0.05)
+
+        self.assertEqual(calls, [])
+        self.assertFalse(deadline.fired)
+
+    def test_exit_waits_for_running_on_expire(self):
+        started = threading.Event()
+        finished = []
+
+        def on_expire():
+            started.set()
+            time.sleep(0.05)
+            finished.append(1)
+
+        with self.assertRaises(TimeoutError):
+            with Deadline(0.001, on_expire=on_expire):
+                started.wait(1)
+                raise IOError()
+        self.assertEqual(finished, [1])
@@ -1,6 +1,6 @@
 import unittest
 
-from badge_hub import get_archive_name, get_proximity_name, get_audio_name
+from badge_hub import get_proximity_name, get_audio_name
 from badge_hub import _create_pending_file_name
 from badge_hub import AUDIO, PROXIMITY
 from badge_hub import pending_file_prefix
@@ -11,11 +11,15 @@ from data_generator import generate_full_pending, generate_half_pending
 
 import glob
 import os
+import shutil
 class TestFileHandling(unittest.TestCase):
     
     def cleanup(self):
         for filename in glob.glob(DATA_DIR + "*"):
-            os.remove(filename)
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            else:
+                os.remove(filename)
 
     def test_name_creation(self):
         self.cleanup()
@@ -0,0 +1,137 @@
+import unittest
+import json
+import logging
+import threading
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import hub_manager
+from hub_manager import ProjectKeyCache, compress_body
+
+
+class MockProjectEndpoint(BaseHTTPRequestHandler):
+    """
+    Answers project key lookups with the current key, and data uploads with data_status
+    """
+    protocol_version = "HTTP/1.1"
+    key = "project1"
+    data_status = 200
+    lookups = 0
+    uploads = []
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        MockProjectEndpoint.lookups += 1
+        self._send(200, json.dumps({'key': self.key}))
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length', 0))
+        self.rfile.read(length)
+        self.uploads.append(self.path)
+        self._send(self.data_status, json.dumps({'chunks_written': 1}))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # keep-alive connections are cut when the server shuts down
+        pass
+
+
+class TestProjectKeyCache(unittest.TestCase):
+
+    def setUp(self):
+        MockProjectEndpoint.key = "project1"
+        MockProjectEndpoint.data_status = 200
+        MockProjectEndpoint.lookups = 0
+        MockProjectEndpoint.uploads = []
+        self.httpd = ThreadedHTTPServer(("127.0.0.1", 0), MockProjectEndpoint)
+        t = threading.Thread(target=self.httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+        server = "http://127.0.0.1:{}/".format(self.httpd.server_address[1])
+        self._endpoints = (hub_manager.PROJECTS_ENDPOINT, hub_manager.DATA_ENDPOINT, hub_manager._project_key_cache)
+        hub_manager.PROJECTS_ENDPOINT = server + "projects"
+        hub_manager.DATA_ENDPOINT = lambda key: "{}{}/datafiles".format(server, key)
+        hub_manager._project_key_cache = ProjectKeyCache()
+        self.logger = logging.getLogger('test_hub_manager')
+
+    def tearDown(self):
+        hub_manager.PROJECTS_ENDPOINT, hub_manager.DATA_ENDPOINT, hub_manager._project_key_cache = self._endpoints
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _send(self):
+        return hub_manager.send_serialized_data_to_server(self.logger, "audio", ['{"i": 0}\n'])
+
+    def test_key_is_looked_up_once(self):
+        for i in range(3):
+            self._send()
+
+        self.assertEqual(MockProjectEndpoint.lookups, 1)
+        self.assertEqual(MockProjectEndpoint.uploads, ["/project1/datafiles"] * 3)
+
+    def _check_rejected(self, status):
+        self._send()
+        # the hub was moved to another project
+        MockProjectEndpoint.key = "project2"
+        MockProjectEndpoint.data_status = status
+        with self.assertRaises(hub_manager.requests.exceptions.HTTPError):
+            self._send()
+
+        MockProjectEndpoint.data_status = 200
+        self._send()
+        self.assertEqual(MockProjectEndpoint.lookups, 2)
+        self.assertEqual(MockProjectEndpoint.uploads[-1], "/project2/datafiles")
+
+    def test_key_is_dropped_on_401(self):
+        self._check_rejected(401)
+
+    def test_key_is_dropped_on_404(self):
+        self._check_rejected(404)
+
+    def test_key_is_kept_on_other_errors(self):
+        self._send()
+        MockProjectEndpoint.data_status = 500
+        with self.assertRaises(hub_manager.requests.exceptions.HTTPError):
+            self._send()
+
+        self.assertEqual(MockProjectEndpoint.lookups, 1)
+
+
+class TestCompressBody(unittest.TestCase):
+    body = '{"data_type": "audio", "chunks": [' + ",".join(['{"samples": [1, 2, 3]}'] * 100) + ']}'
+
+    def test_none(self):
+        self.assertEqual(compress_body(self.body, "none"), (self.body, None))
+
+    def test_gzip(self):
+        compressed, content_encoding = compress_body(self.body, "gzip", 6)
+
+        self.assertEqual(content_encoding, "gzip")
+        self.assertLess(len(compressed), len(self.body))
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS), self.body)
+
+    @unittest.skipIf(hub_manager.zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        compressed, content_encoding = compress_body(self.body, "zstd", 3)
+
+        self.assertEqual(content_encoding, "zstd")
+        self.assertLess(len(compressed), len(self.body))
+        self.assertEqual(hub_manager.zstandard.ZstdDecompressor().decompress(compressed), self.body)
+
+    @unittest.skipIf(hub_manager.zstandard is not None, "zstandard is installed")
+    def test_zstd_requires_package(self):
+        self.assertRaises(RuntimeError, compress_body, self.body, "zstd", 3)
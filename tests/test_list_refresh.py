@@ -0,0 +1,158 @@
+import unittest
+import copy
+import json
+import logging
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import badge_manager_server
+import beacon_manager_server
+from badge_manager_server import BadgeManagerServer
+from beacon_manager_server import BeaconManagerServer
+
+
+def _record(key, mac, audio_ts=100):
+    return {'key': key, 'badge': mac, 'id': 1, 'advertisement_project_id': 1, 'active': True,
+            'last_audio_ts': audio_ts, 'last_audio_ts_fract': 0, 'last_proximity_ts': 100,
+            'last_voltage': 2.9, 'last_contacted_ts': None, 'last_unsync_ts': None}
+
+
+class MockBadgesList(BaseHTTPRequestHandler):
+    """
+    Serves MockBadgesList.records with an ETag, and answers 304 to a matching If-None-Match
+    """
+    protocol_version = "HTTP/1.1"
+    records = []
+    requests = []
+
+    def do_GET(self):
+        body = json.dumps(self.records)
+        etag = '"{}"'.format(hash(body))
+        self.requests.append(self.headers.get('If-None-Match'))
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # keep-alive connections are cut when the server shuts down
+        pass
+
+
+class TestListRefresh(unittest.TestCase):
+
+    def setUp(self):
+        MockBadgesList.records = [_record("key1", "AA:00"), _record("key2", "AA:01")]
+        MockBadgesList.requests = []
+        self.httpd = ThreadedHTTPServer(("127.0.0.1", 0), MockBadgesList)
+        t = threading.Thread(target=self.httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+        self._endpoints = badge_manager_server.BADGES_ENDPOINT, beacon_manager_server.BEACONS_ENDPOINT
+        badge_manager_server.BADGES_ENDPOINT = "http://127.0.0.1:{}/badges/".format(self.httpd.server_address[1])
+        beacon_manager_server.BEACONS_ENDPOINT = "http://127.0.0.1:{}/beacons/".format(self.httpd.server_address[1])
+        self.mgr = BadgeManagerServer(logger=logging.getLogger('test_list_refresh'))
+
+    def tearDown(self):
+        badge_manager_server.BADGES_ENDPOINT, beacon_manager_server.BEACONS_ENDPOINT = self._endpoints
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_unchanged_list_keeps_objects(self):
+        self.mgr.pull_badges_list()
+        first = dict(self.mgr.badges)
+
+        self.mgr.pull_badges_list()
+
+        self.assertEqual(MockBadgesList.requests[0], None)
+        self.assertIsNotNone(MockBadgesList.requests[1])
+        for mac, badge in first.items():
+            self.assertIs(self.mgr.badges[mac], badge)
+
+    def test_changed_badges_are_merged(self):
+        self.mgr.pull_badges_list()
+        first = dict(self.mgr.badges)
+
+        records = copy.deepcopy(MockBadgesList.records)
+        records[0]['last_audio_ts'] = 200           # same member, newer timestamp
+        records[1]['key'] = "key3"                  # mac reassigned to another member
+        records.append(_record("key4", "AA:02"))    # new badge
+        MockBadgesList.records = records
+
+        self.mgr.pull_badges_list()
+
+        self.assertIs(self.mgr.badges["AA:00"], first["AA:00"])
+        self.assertEqual(self.mgr.badges["AA:00"].last_audio_ts_int, 200)
+        self.assertIsNot(self.mgr.badges["AA:01"], first["AA:01"])
+        self.assertEqual(self.mgr.badges["AA:01"].key, "key3")
+        self.assertEqual(self.mgr.badges["AA:02"].key, "key4")
+
+    def test_timestamps_do_not_move_back(self):
+        self.mgr.pull_badges_list()
+        self.mgr.badges["AA:00"].set_audio_ts(300, 0)
+
+        records = copy.deepcopy(MockBadgesList.records)
+        records[0]['last_voltage'] = 2.5
+        MockBadgesList.records = records
+        self.mgr.pull_badges_list()
+
+        self.assertEqual(self.mgr.badges["AA:00"].last_audio_ts_int, 300)
+
+    def test_beacons_list_is_merged(self):
+        mgrb = BeaconManagerServer(logger=logging.getLogger('test_list_refresh'))
+        mgrb.pull_beacons_list()
+        first = dict(mgrb.beacons)
+
+        mgrb.pull_beacons_list()
+        self.assertIsNotNone(MockBadgesList.requests[1])
+
+        records = copy.deepcopy(MockBadgesList.records)
+        records[0]['id'] = 7
+        MockBadgesList.records = records
+        mgrb.pull_beacons_list()
+
+        self.assertIs(mgrb.beacons["AA:00"], first["AA:00"])
+        self.assertEqual(mgrb.beacons["AA:00"].badge_id, 7)
+
+    def test_pull_badge_after_revalidation(self):
+        self.mgr.pull_badges_list()
+        records = copy.deepcopy(MockBadgesList.records)
+        records[1]['badge'] = "AA:05"  # member of AA:01 got a new badge
+        MockBadgesList.records = records
+        self.mgr.pull_badges_list()
+
+        # the list that was just read is used, without another request
+        requests_before = len(MockBadgesList.requests)
+        self.assertTrue(self.mgr.revalidate_badges())
+        self.assertTrue(self.mgr.pull_badge("AA:00"))
+        self.assertFalse(self.mgr.pull_badge("AA:01"))
+        self.assertEqual(len(MockBadgesList.requests), requests_before)
+
+    def test_old_list_is_read_again(self):
+        self.mgr.pull_badges_list()
+        self.mgr.LIST_MAX_AGE = 0
+        records = copy.deepcopy(MockBadgesList.records)
+        records[1]['badge'] = "AA:05"
+        MockBadgesList.records = records
+
+        self.assertTrue(self.mgr.revalidate_badges())
+        self.assertEqual(len(MockBadgesList.requests), 2)
+        self.assertFalse(self.mgr.pull_badge("AA:01"))
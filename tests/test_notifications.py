@@ -0,0 +1,182 @@
+import unittest
+import logging
+import time
+
+import badge
+from deadline import TimeoutError
+from badge import Badge, BadgeDelegate, DataSink, Expect, STATUS, TIMESTAMP, CHUNK_HEADER, SCAN_HEADER, SEEN_DEVICE
+
+
+class TestNotifications(unittest.TestCase):
+
+    def setUp(self):
+        self.delegate = BadgeDelegate(None)
+
+    def _notify(self, *packets):
+        for packet in packets:
+            self.delegate.handleNotification(None, packet)
+
+    def test_chunks(self):
+        self.delegate.expected = Expect.header
+        self._notify(CHUNK_HEADER.pack(1000, 250, 2.5, 50, 25), "".join(chr(i) for i in range(20)), "\xff" * 5,
+                     CHUNK_HEADER.pack(1006, 0, 2.5, 50, 2), "\x01\x02",
+                     CHUNK_HEADER.pack(0, 0, 0, 0, 0))
+
+        self.assertTrue(self.delegate.gotEndOfData)
+        first, second = self.delegate.chunks
+        self.assertEqual(first.getHeader(), (1000, 250, 2.5, 50, 25))
+        self.assertEqual(list(first.samples), range(20) + [255] * 5)
+        self.assertEqual(list(second.samples), [1, 2])
+        self.assertIsNot(first.samples, second.samples)
+
+    def test_chunk_overflow(self):
+        self.delegate.expected = Expect.header
+        self._notify(CHUNK_HEADER.pack(1000, 0, 2.5, 50, 2))
+        with self.assertRaises(UserWarning):
+            self._notify("\x01\x02\x03")
+
+    def _check_scans(self):
+        devices = "".join(SEEN_DEVICE.pack(device_id, -60 - device_id, 2) for device_id in range(1, 7))
+        self.delegate.expected = Expect.scanHeader
+        self._notify(SCAN_HEADER.pack(1000, 2.5, 6), devices[:20], devices[20:],
+                     SCAN_HEADER.pack(1015, 2.5, 0),
+                     SCAN_HEADER.pack(1030, 2.5, 1), SEEN_DEVICE.pack(65535, -128, 127) + "\x00",
+                     SCAN_HEADER.pack(0, 0, 0))
+
+        self.assertTrue(self.delegate.gotEndOfScans)
+        first, empty, last = self.delegate.scans
+        self.assertEqual(first.getHeader(), (1000, 2.5, 6))
+        self.assertEqual(first.rssiDistances(),
+                         {device_id: {'rssi': -60 - device_id, 'count': 2} for device_id in range(1, 7)})
+        self.assertEqual(empty.rssiDistances(), {})
+        self.assertEqual(last.rssiDistances(), {65535: {'rssi': -128, 'count': 127}})
+        for rssi_distances in (scan.rssiDistances() for scan in self.delegate.scans):
+            self.assertTrue(all(type(value) is int for device_id, distance in rssi_distances.items()
+                                for value in [device_id] + distance.values()))
+        return first.devices
+
+    def test_scans(self):
+        devices = self._check_scans()
+        if badge.numpy is not None:
+            self.assertEqual(devices.dtype, badge.SEEN_DEVICE_DTYPE)
+
+    def test_scans_without_numpy(self):
+        use_numpy = badge.USE_NUMPY
+        badge.USE_NUMPY = False
+        try:
+            devices = self._check_scans()
+        finally:
+            badge.USE_NUMPY = use_numpy
+        self.assertEqual([(d.ID, d.rssi, d.count) for d in devices],
+                         [(device_id, -60 - device_id, 2) for device_id in range(1, 7)])
+
+    def test_sink(self):
+        class Sink(DataSink):
+            def __init__(self):
+                self.received = []
+
+            def addChunk(self, chunk):
+                self.received.append(chunk)
+
+            def addScan(self, scan):
+                self.received.append(scan)
+
+        sink = Sink()
+        self.delegate = BadgeDelegate(None, sink=sink)
+        self.delegate.expected = Expect.header
+        self._notify(CHUNK_HEADER.pack(1000, 0, 2.5, 50, 2), "\x01\x02")
+        self.assertEqual([list(chunk.samples) for chunk in sink.received], [[1, 2]])
+
+        self.delegate.expected = Expect.scanHeader
+        self._notify(SCAN_HEADER.pack(1000, 2.5, 1), SEEN_DEVICE.pack(5, -70, 1))
+        self.assertEqual(sink.received[-1].rssiDistances(), {5: {'rssi': -70, 'count': 1}})
+        self.assertEqual((self.delegate.chunks, self.delegate.scans), ([], []))
+
+
+class FakeConnection(object):
+    """
+    Answers badge requests with their acknowledgements. Requests in drop are not answered the first time
+    """
+
+    def __init__(self, delegate, drop=()):
+        self.delegate = delegate
+        self.drop = set(drop)
+        self.events = []
+        self.notifications = []
+
+    def write(self, fmt, *arr):
+        command = arr[0]
+        self.events.append(command)
+        if command in self.drop:
+            self.drop.remove(command)
+        elif command == "s":
+            self.notifications.append(STATUS.pack(1, 0, 0, 1000, 0, 2.5))
+        else:
+            self.notifications.append(TIMESTAMP.pack(1000, 0))
+
+    def waitForNotifications(self, timeout):
+        self.events.append("wait")
+        if not self.notifications:
+            return False
+        self.delegate.handleNotification(None, self.notifications.pop(0))
+        return True
+
+    def abort(self):
+        pass
+
+
+class TestPipelinedHandshake(unittest.TestCase):
+
+    def setUp(self):
+        self.badge = Badge("AA:BB:CC:DD:EE:00", logging.getLogger('test_notifications'), "key1", badge_id=1,
+                           project_id=1, init_audio_ts_int=100, init_audio_ts_fract=0, init_proximity_ts=100)
+        self.badge.dlg = BadgeDelegate(None)
+
+    def test_requests_are_sent_back_to_back(self):
+        self.badge.conn = FakeConnection(self.badge.dlg)
+        self.badge.pipelined_handshake(True, True)
+
+        self.assertEqual(self.badge.conn.events, ["s", "1", "p", "wait", "wait", "wait"])
+        self.assertTrue(self.badge.dlg.gotStatus)
+        self.assertEqual(self.badge.dlg.acked, set(["status", "start recording", "start scan"]))
+        self.assertEqual(self.badge.dlg.expected, Expect.none)
+
+    def test_unacknowledged_requests_are_sent_again(self):
+        self.badge.conn = FakeConnection(self.badge.dlg, drop=["1"])
+        self.badge.pipelined_handshake(True, True)
+
+        self.assertEqual(self.badge.conn.events, ["s", "1", "p", "wait", "wait", "wait", "1", "p", "wait", "wait"])
+        self.assertEqual(self.badge.dlg.acked, set(["status", "start recording", "start scan"]))
+
+    def test_status_only(self):
+        self.badge.conn = FakeConnection(self.badge.dlg)
+        self.badge.pipelined_handshake(False, False)
+
+        self.assertEqual(self.badge.conn.events, ["s", "wait"])
+
+    def test_data_after_acks(self):
+        self.badge.dlg.expectAck("status", Expect.status)
+        self.badge.dlg.expected = Expect.header
+        # a status and a chunk header have the same size, the outstanding acknowledgement comes first
+        self.badge.dlg.handleNotification(None, STATUS.pack(1, 1, 1, 1000, 0, 2.5))
+        self.badge.dlg.handleNotification(None, CHUNK_HEADER.pack(1000, 0, 2.5, 50, 1))
+        self.badge.dlg.handleNotification(None, "\x07")
+
+        self.assertTrue(self.badge.dlg.recording)
+        self.assertEqual([list(chunk.samples) for chunk in self.badge.dlg.chunks], [[7]])
+        self.assertIsNotNone(self.badge.dlg.firstDataTime)
+
+    def test_status_timeout_bounds_the_handshake(self):
+        class SilentConnection(FakeConnection):
+            def write(self, fmt, *arr):
+                self.events.append(arr[0])
+
+            def waitForNotifications(self, timeout):
+                time.sleep(timeout)
+                return False
+
+        self.badge.conn = SilentConnection(self.badge.dlg)
+        start = time.time()
+        with self.assertRaises(TimeoutError):
+            self.badge.pipelined_handshake(True, True, status_timeout=0.1)
+        self.assertLess(time.time() - start, badge.COMMAND_TIMEOUT)
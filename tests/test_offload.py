@@ -0,0 +1,254 @@
+import unittest
+import glob
+import json
+import os
+import shutil
+import time
+
+import badge_hub
+import hub_manager
+from badge_hub import offload_data, read_batches, _create_pending_file_name, archive
+from badge_hub import claim_pending_files, read_cursor, get_cursor_name, Uploader
+from badge_hub import AUDIO, PROXIMITY
+
+from settings import DATA_DIR
+
+
+def _write_pending(data_type, count):
+    filename = _create_pending_file_name(data_type)
+    with open(filename, "w") as f:
+        for i in range(count):
+            json.dump({'type': "{} received".format(data_type), 'data': {'timestamp': i}}, f)
+            f.write('\n')
+    return filename
+
+
+def _archived(data_type):
+    return [m for m in archive.segments() if m['data_type'] == data_type]
+
+
+class FakeServer(object):
+    """
+    Stands in for hub_manager.send_serialized_data_to_server
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.fail_after = None
+
+    def __call__(self, logger, data_type, lines):
+        if self.fail_after is not None and len(self.batches) >= self.fail_after:
+            raise hub_manager.requests.exceptions.ConnectionError("server is down")
+        self.batches.append((data_type, [json.loads(line) for line in lines]))
+        return len(lines)
+
+
+class TestOffload(unittest.TestCase):
+
+    def cleanup(self):
+        for filename in glob.glob(DATA_DIR + "*"):
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            else:
+                os.remove(filename)
+
+    def setUp(self):
+        self.cleanup()
+        badge_hub.pending.rebuild()
+        archive.rebuild()
+        self.server = FakeServer()
+        self._send = hub_manager.send_serialized_data_to_server
+        hub_manager.send_serialized_data_to_server = self.server
+        self._batch_size = badge_hub.UPLOAD_BATCH_SIZE
+
+    def tearDown(self):
+        badge_hub.close_writers()
+        hub_manager.send_serialized_data_to_server = self._send
+        badge_hub.UPLOAD_BATCH_SIZE = self._batch_size
+        self.cleanup()
+
+    def test_read_batches(self):
+        lines = ["{}\n".format(json.dumps({'i': i})) for i in range(10)]
+        batches = list(read_batches(iter(lines), max_bytes=len(lines[0]) * 3))
+
+        self.assertEqual([len(b) for b, end in batches], [3, 3, 3, 1])
+        self.assertEqual(sum((b for b, end in batches), []), lines)
+        self.assertEqual([end for b, end in batches], [len(lines[0]) * n for n in (3, 6, 9, 10)])
+
+    def test_read_batches_offsets_skip_blank_lines(self):
+        lines = ['{"i": 0}\n', '\n', '{"i": 1}\n']
+        batches = list(read_batches(iter(lines), max_bytes=len(lines[0]), offset=5))
+
+        self.assertEqual(batches, [([lines[0]], 5 + len(lines[0])),
+                                   ([lines[2]], 5 + len("".join(lines)))])
+
+    def test_offload_archives_sent_files(self):
+        audio = _write_pending(AUDIO, 5)
+        with open(audio) as f:
+            raw = f.read()
+
+        self.assertTrue(offload_data())
+
+        self.assertFalse(os.path.exists(audio))
+        self.assertEqual([t for t, chunks in self.server.batches], [AUDIO])
+        self.assertEqual([c['data']['timestamp'] for c in self.server.batches[0][1]], range(5))
+        self.assertEqual(len(_archived(AUDIO)), 1)
+        self.assertEqual("".join(archive.read_segment(_archived(AUDIO)[0])), raw)
+
+    def test_failed_offload_keeps_pending_file(self):
+        proximity = _write_pending(PROXIMITY, 5)
+        self.server.fail_after = 0
+
+        self.assertFalse(offload_data())
+
+        self.assertEqual(_archived(PROXIMITY), [])
+        claimed = claim_pending_files()
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(os.path.basename(claimed[0]),
+                         os.path.basename(proximity).replace("pending_", "uploading_"))
+
+        # retried on the next pass
+        self.server.fail_after = None
+        self.assertTrue(offload_data())
+        self.assertEqual(claim_pending_files(), [])
+        self.assertEqual(len(_archived(PROXIMITY)), 1)
+
+    def test_claimed_files_make_room_for_new_data(self):
+        audio = _write_pending(AUDIO, 5)
+
+        claimed = claim_pending_files()
+
+        self.assertFalse(os.path.exists(audio))
+        self.assertEqual(len(claimed), 1)
+        # new data goes to a new pending file, and does not mix with the claimed one
+        self.assertNotIn(badge_hub._get_pending_file_name(AUDIO), claimed)
+        with open(claimed[0]) as f:
+            self.assertEqual(len(f.readlines()), 5)
+
+    def test_uploader_thread(self):
+        _write_pending(AUDIO, 3)
+        _write_pending(PROXIMITY, 4)
+
+        uploader = Uploader(workers=2, interval=0.05)
+        uploader.start()
+        for _ in range(100):
+            if not glob.glob(DATA_DIR + "uploading_*") and not glob.glob(DATA_DIR + "pending_*"):
+                break
+            time.sleep(0.05)
+        uploader.stop()
+        uploader.join(5)
+
+        self.assertFalse(uploader.is_alive())
+        self.assertEqual(sorted(t for t, chunks in self.server.batches), [AUDIO, PROXIMITY])
+        self.assertEqual(len(_archived(AUDIO)), 1)
+        self.assertEqual(len(_archived(PROXIMITY)), 1)
+
+    def test_failed_offload_resumes_from_checkpoint(self):
+        audio = _write_pending(AUDIO, 10)
+        with open(audio) as f:
+            raw = f.read()
+        badge_hub.UPLOAD_BATCH_SIZE = len(raw) // 10 * 3  # 3 chunks per batch
+        self.server.fail_after = 2
+
+        self.assertFalse(offload_data())
+        claimed = claim_pending_files()
+        self.assertEqual(len(claimed), 1)
+        self.assertTrue(read_cursor(claimed[0]) > 0)
+
+        self.server.fail_after = None
+        self.assertTrue(offload_data())
+
+        # every chunk was sent exactly once
+        timestamps = [c['data']['timestamp'] for t, chunks in self.server.batches for c in chunks]
+        self.assertEqual(timestamps, range(10))
+        self.assertFalse(os.path.exists(get_cursor_name(claimed[0])))
+        self.assertEqual(len(_archived(AUDIO)), 1)
+        self.assertEqual("".join(archive.read_segment(_archived(AUDIO)[0])), raw)
+
+    def test_cursor_of_archived_file_is_removed(self):
+        audio = _write_pending(AUDIO, 3)
+        uploading = badge_hub.uploading_file_prefix + audio[len(badge_hub.pending_file_prefix):]
+        # left behind by a crash after the file was archived
+        badge_hub.write_cursor(uploading, 10)
+
+        self.assertEqual(claim_pending_files(), [uploading])
+        self.assertEqual(read_cursor(uploading), 0)
+        self.assertTrue(offload_data())
+        self.assertEqual(len(self.server.batches[0][1]), 3)
+
+    def test_corrupt_file_is_quarantined(self):
+        log_lines = [{'type': "audio received", 'log_timestamp': 1.5, 'log_index': -1,
+                      'data': {'voltage': 2.9, 'timestamp': float(i), 'sample_period': 50, 'num_samples': 2,
+                               'samples': [1, 2], 'badge_address': "AA:00", 'member': "M", 'member_id': 1}}
+                     for i in range(3)]
+        writer = badge_hub.SegmentWriter(lambda: badge_hub._get_pending_file_name(AUDIO),
+                                         serializer=badge_hub.serializers.get(badge_hub.serializers.BINARY))
+        writer.write(log_lines)
+        writer.close()
+        audio = badge_hub._get_pending_file_name(AUDIO)
+        with open(audio, "r+b") as f:
+            f.truncate(os.path.getsize(audio) - 1)  # cut off by a crash
+        badge_hub.pending.seal_expired()
+        badge_hub.pending.release(audio)
+
+        self.assertFalse(offload_data())
+
+        self.assertEqual(self.server.batches, [])
+        self.assertEqual(claim_pending_files(), [])
+        self.assertEqual(len(os.listdir(badge_hub.corrupt_dir)), 1)
+        self.assertEqual(_archived(AUDIO), [])
+
+    def test_bad_file_does_not_block_others(self):
+        audio = _write_pending(AUDIO, 3)
+        proximity = _write_pending(PROXIMITY, 3)
+        send = self.server
+
+        def reject_audio(logger, data_type, lines):
+            if data_type == AUDIO:
+                raise hub_manager.requests.exceptions.HTTPError("400 Client Error")
+            return send(logger, data_type, lines)
+        hub_manager.send_serialized_data_to_server = reject_audio
+
+        self.assertFalse(offload_data())
+
+        self.assertEqual([t for t, chunks in self.server.batches], [PROXIMITY])
+        self.assertEqual(len(_archived(PROXIMITY)), 1)
+        self.assertEqual(_archived(AUDIO), [])
+
+    def test_active_file_is_not_claimed(self):
+        with badge_hub._storage_lock:
+            badge_hub.get_writer(AUDIO).write([{"data": {"timestamp": 0}}])
+        active = badge_hub._get_pending_file_name(AUDIO)
+
+        self.assertEqual(claim_pending_files(), [])
+        self.assertTrue(os.path.exists(active))
+
+        max_age = badge_hub.pending.max_age
+        badge_hub.pending.max_age = 0
+        try:
+            claimed = claim_pending_files()
+        finally:
+            badge_hub.pending.max_age = max_age
+
+        self.assertEqual(len(claimed), 1)
+        self.assertFalse(os.path.exists(active))
+        with open(claimed[0]) as f:
+            self.assertEqual(f.read(), '{"data": {"timestamp": 0}}\n')
+        self.assertNotEqual(badge_hub._get_pending_file_name(AUDIO), active)
+
+    def test_binary_files_are_uploaded_as_json(self):
+        log_lines = [{'type': "audio received", 'log_timestamp': 1.5, 'log_index': -1,
+                      'data': {'voltage': 2.9, 'timestamp': float(i), 'sample_period': 50, 'num_samples': 2,
+                               'samples': [1, 2], 'badge_address': "AA:00", 'member': "M", 'member_id': 1}}
+                     for i in range(5)]
+        writer = badge_hub.SegmentWriter(lambda: badge_hub._get_pending_file_name(AUDIO),
+                                         serializer=badge_hub.serializers.get(badge_hub.serializers.BINARY))
+        writer.write(log_lines)
+        writer.close()
+        badge_hub.pending.seal_expired()
+        badge_hub.pending.release(badge_hub._get_pending_file_name(AUDIO))
+
+        self.assertTrue(offload_data())
+
+        self.assertEqual(self.server.batches, [(AUDIO, log_lines)])
+        self.assertEqual([json.loads(line) for line in archive.read_segment(_archived(AUDIO)[0])], log_lines)
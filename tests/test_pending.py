@@ -0,0 +1,207 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+
+import pending
+from pending import PendingSegments, SegmentWriter, FLUSH_CHUNK, FLUSH_BADGE, FLUSH_BYTES, FLUSH_SEGMENT
+
+
+def _fill(file_name, size):
+    with open(file_name, "ab") as f:
+        f.write("x" * size)
+
+
+class TestPendingSegments(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmp, "pending_")
+        self.pending = PendingSegments(self.prefix, max_bytes=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_active_segment_is_kept(self):
+        audio = self.pending.active("audio")
+        _fill(audio, 50)
+
+        self.assertEqual(self.pending.active("audio"), audio)
+        self.assertNotEqual(self.pending.active("proximity"), audio)
+
+    def test_rotation_by_size(self):
+        audio = self.pending.active("audio")
+        _fill(audio, 100)
+
+        rotated = self.pending.active("audio")
+
+        self.assertNotEqual(rotated, audio)
+        self.assertEqual(self.pending.segments(), sorted([audio]))
+
+    def test_rotation_by_age(self):
+        self.pending.max_age = 0.05
+        audio = self.pending.active("audio")
+        _fill(audio, 10)
+        time.sleep(0.1)
+
+        self.assertNotEqual(self.pending.active("audio"), audio)
+
+    def test_seal_expired(self):
+        self.pending.max_age = 0.05
+        audio = self.pending.active("audio")
+        _fill(audio, 10)
+        proximity = self.pending.active("proximity")  # nothing written yet
+        self.assertEqual(self.pending.sealed(), [])
+        time.sleep(0.1)
+
+        self.assertEqual(self.pending.seal_expired(), [audio])
+
+        self.assertEqual(self.pending.sealed(), [audio])
+        self.assertFalse(self.pending.is_active(audio))
+        self.assertTrue(self.pending.is_active(proximity))
+
+    def test_release(self):
+        audio = self.pending.active("audio")
+        _fill(audio, 10)
+        os.rename(audio, audio + ".claimed")
+        self.pending.release(audio)
+
+        self.assertNotEqual(self.pending.active("audio"), audio)
+
+    def test_rebuild_from_disk(self):
+        full = self.pending.create_name("audio")
+        _fill(full, 100)
+        audio = self.pending.create_name("audio")
+        _fill(audio, 10)
+        proximity = self.pending.create_name("proximity")
+        _fill(proximity, 10)
+
+        restarted = PendingSegments(self.prefix, max_bytes=100)
+
+        # segments written before the restart are left to the uploader
+        self.assertEqual(sorted(restarted.sealed()), sorted([full, audio, proximity]))
+        self.assertNotIn(restarted.active("audio"), [full, audio])
+        self.assertNotIn(restarted.active("proximity"), [proximity])
+        self.assertEqual([f for f in restarted.sealed() if "audio" in f], [full, audio])
+
+
+class TestSegmentWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.pending = PendingSegments(os.path.join(self.tmp, "pending_"), max_bytes=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _size(self, file_name):
+        return os.path.getsize(file_name) if os.path.exists(file_name) else 0
+
+    def test_flush_per_chunk(self):
+        writer = SegmentWriter(lambda: self.pending.active("audio"), FLUSH_CHUNK)
+        writer.write(["a\n", "b\n"])
+
+        self.assertEqual(self._size(self.pending.active("audio")), 4)
+        writer.close()
+
+    def test_flush_per_badge(self):
+        writer = SegmentWriter(lambda: self.pending.active("audio"), FLUSH_BADGE)
+        audio = self.pending.active("audio")
+        writer.write(["a\n"])
+        writer.write(["b\n"])
+        self.assertEqual(self._size(audio), 0)
+
+        writer.end_of_badge()
+        self.assertEqual(self._size(audio), 4)
+
+        # a badge with a large backlog
+        writer.write(["x" * pending.SEGMENT_BUFFER_SIZE + "\n"])
+        self.assertEqual(self._size(audio), pending.SEGMENT_BUFFER_SIZE + 5)
+        writer.close()
+
+    def test_end_of_badge_with_other_policies(self):
+        writer = SegmentWriter(lambda: self.pending.active("audio"), FLUSH_BYTES)
+        writer.write(["a\n"])
+        writer.end_of_badge()
+
+        self.assertEqual(self._size(self.pending.active("audio")), 0)
+        writer.close()
+
+    def test_flush_per_bytes(self):
+        writer = SegmentWriter(lambda: self.pending.active("audio"), FLUSH_BYTES, flush_bytes=10)
+        audio = self.pending.active("audio")
+        writer.write(["a\n", "b\n"])
+        self.assertEqual(self._size(audio), 0)
+
+        writer.write(["0123456789\n"])
+        self.assertEqual(self._size(audio), 15)
+
+    def test_close_flushes(self):
+        writer = SegmentWriter(lambda: self.pending.active("audio"), FLUSH_SEGMENT)
+        writer.write(["a\n"])
+        audio = self.pending.active("audio")
+        self.assertEqual(self._size(audio), 0)
+
+        writer.close()
+        with open(audio) as f:
+            self.assertEqual(f.read(), "a\n")
+
+        writer.write(["b\n"])
+        writer.close()
+        with open(audio) as f:
+            self.assertEqual(f.read(), "a\nb\n")
+
+    def test_segment_policy_syncs_full_buffer(self):
+        synced = []
+        fsync = os.fsync
+        os.fsync = lambda fd: synced.append(fd)
+        try:
+            writer = SegmentWriter(lambda: self.pending.active("audio"), FLUSH_SEGMENT)
+            writer.write(["a\n"])
+            audio = self.pending.active("audio")
+            self.assertEqual(synced, [])
+            writer.write(["x" * pending.SEGMENT_BUFFER_SIZE + "\n"])
+            self.assertEqual(len(synced), 1)
+        finally:
+            os.fsync = fsync
+        self.assertEqual(self._size(audio), pending.SEGMENT_BUFFER_SIZE + 3)
+        writer.close()
+
+    def test_on_flush_after_write(self):
+        flushed = []
+        writer = SegmentWriter(lambda: self.pending.active("audio"), FLUSH_BYTES, flush_bytes=10)
+        audio = self.pending.active("audio")
+        writer.write(["a\n"], on_flush=lambda: flushed.append(self._size(audio)))
+        writer.write(["b\n"], on_flush=lambda: flushed.append(self._size(audio)))
+        self.assertEqual(flushed, [])
+
+        writer.write(["0123456789\n"])
+        self.assertEqual(flushed, [15, 15])
+        writer.close()
+        self.assertEqual(flushed, [15, 15])
+
+    def test_close_calls_on_flush(self):
+        flushed = []
+        writer = SegmentWriter(lambda: self.pending.active("audio"), FLUSH_SEGMENT)
+        writer.write(["a\n"], on_flush=lambda: flushed.append(1))
+        self.assertEqual(flushed, [])
+
+        writer.close()
+        self.assertEqual(flushed, [1])
+
+    def test_rotation(self):
+        writer = SegmentWriter(lambda: self.pending.active("audio"), FLUSH_CHUNK)
+        writer.write(["x" * 99 + "\n"])
+        first = self.pending.segments()
+        writer.write(["a\n"])
+        writer.close()
+
+        segments = self.pending.segments()
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(segments[0], first[0])
+        with open(segments[1]) as f:
+            self.assertEqual(f.read(), "a\n")
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, SegmentWriter, lambda: None, "sometimes")
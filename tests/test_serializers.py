@@ -0,0 +1,119 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+
+import serializers
+from archive import Archive
+from audio_format import FormatError
+from pending import PendingSegments, SegmentWriter
+
+
+def _log_lines(count, data_type="audio"):
+    if data_type == "audio":
+        return [{'type': "audio received", 'log_timestamp': 1.5 + i, 'log_index': -1,
+                 'data': {'voltage': 2.9, 'timestamp': 100.25 + i, 'sample_period': 50, 'num_samples': 3,
+                          'samples': [i % 256, 1, 2], 'badge_address': "AA:0{}".format(i % 2),
+                          'member': "M{}".format(i % 2), 'member_id': i % 2}}
+                for i in range(count)]
+    return [{'type': "proximity received", 'log_timestamp': 1.5 + i, 'log_index': -1,
+             'data': {'voltage': 2.9, 'timestamp': 100.25 + i, 'badge_address': "AA:00",
+                      'rssi_distances': {"12": {'rssi': -60, 'count': 2}}, 'member': "M", 'member_id': 1}}
+            for i in range(count)]
+
+
+def _records(file_name, offset=0, state=None):
+    with open(file_name, "rb") as f:
+        return [(json.loads(line), end) for line, end in serializers.detect(f).records(f, offset, state)]
+
+
+class TestSerializers(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.pending = PendingSegments(os.path.join(self.tmp, "pending_"), max_bytes=10 ** 6)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, name, log_lines, data_type="audio"):
+        writer = SegmentWriter(lambda: self.pending.active(data_type), serializer=serializers.get(name))
+        for i in range(0, len(log_lines), 3):
+            writer.write(log_lines[i:i + 3])
+        writer.close()
+        return self.pending.active(data_type)
+
+    def _check_format(self, name):
+        for data_type in ("audio", "proximity"):
+            log_lines = _log_lines(10, data_type)
+            file_name = self._write(name, log_lines, data_type)
+
+            with open(file_name, "rb") as f:
+                self.assertEqual(serializers.detect(f).name, name)
+            records = _records(file_name)
+            self.assertEqual([log_line for log_line, end in records], log_lines)
+
+            # resuming after a record skips everything before it
+            self.assertEqual([log_line for log_line, end in _records(file_name, records[3][1])], log_lines[4:])
+            self.assertEqual(records[-1][1], os.path.getsize(file_name))
+
+    def test_json(self):
+        self._check_format(serializers.JSON)
+
+    def test_binary(self):
+        self._check_format(serializers.BINARY)
+
+    @unittest.skipIf(serializers.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        self._check_format(serializers.MSGPACK)
+
+    def test_binary_resumes_with_state(self):
+        log_lines = _log_lines(10)
+        file_name = self._write(serializers.BINARY, log_lines)
+        state = {}
+        records = _records(file_name, state=state)
+        # as kept in an upload cursor
+        state = json.loads(json.dumps(state))
+
+        # the records before the offset are not read again
+        with open(file_name, "r+b") as f:
+            f.seek(serializers.HEADER_SIZE)
+            f.write("X")
+        self.assertEqual([log_line for log_line, end in _records(file_name, records[3][1], state)], log_lines[4:])
+        with self.assertRaises(FormatError):
+            _records(file_name, records[3][1])
+
+    def _check_truncated(self, name):
+        file_name = self._write(name, _log_lines(3))
+        with open(file_name, "r+b") as f:
+            f.truncate(os.path.getsize(file_name) - 2)
+
+        with self.assertRaises(FormatError):
+            _records(file_name)
+
+    def test_truncated_binary(self):
+        self._check_truncated(serializers.BINARY)
+
+    @unittest.skipIf(serializers.msgpack is None, "msgpack is not installed")
+    def test_truncated_msgpack(self):
+        self._check_truncated(serializers.MSGPACK)
+
+    def test_existing_files_keep_their_format(self):
+        file_name = self._write(serializers.JSON, _log_lines(2))
+        self._write(serializers.BINARY, _log_lines(4)[2:])
+
+        with open(file_name, "rb") as f:
+            self.assertEqual(serializers.detect(f).name, serializers.JSON)
+        self.assertEqual([log_line for log_line, end in _records(file_name)], _log_lines(4))
+
+    def test_archive_of_binary_segment(self):
+        archive = Archive(os.path.join(self.tmp, "archive"))
+        log_lines = _log_lines(5)
+        manifest = archive.seal(self._write(serializers.BINARY, log_lines), "audio")
+
+        self.assertEqual(manifest['parts'][0]['format'], serializers.BINARY)
+        self.assertEqual(manifest['chunks'], 5)
+        self.assertEqual(manifest['badges'], ["AA:00", "AA:01"])
+        self.assertEqual((manifest['start_ts'], manifest['end_ts']), (100.25, 104.25))
+        self.assertEqual([json.loads(line) for line in archive.read_segment(manifest)], log_lines)
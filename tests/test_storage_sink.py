@@ -0,0 +1,120 @@
+import unittest
+import glob
+import json
+import logging
+import os
+import shutil
+
+import badge_hub
+from badge import Badge, BadgeDelegate, Expect, CHUNK_HEADER, SCAN_HEADER, SEEN_DEVICE
+from badge_hub import StorageSink, AUDIO, PROXIMITY
+from pending import FLUSH_BADGE, FLUSH_BYTES
+
+from settings import DATA_DIR
+
+
+def _lines(data_type):
+    badge_hub.get_writer(data_type, "server").flush()
+    with open(badge_hub._get_pending_file_name(data_type)) as f:
+        return [json.loads(line) for line in f]
+
+
+class TestStorageSink(unittest.TestCase):
+
+    def cleanup(self):
+        for filename in glob.glob(DATA_DIR + "*"):
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            else:
+                os.remove(filename)
+
+    def setUp(self):
+        self.cleanup()
+        badge_hub.pending.rebuild()
+        self.badge = Badge("AA:BB:CC:DD:EE:00", logging.getLogger('test_storage_sink'), "key1", badge_id=1,
+                           project_id=1, init_audio_ts_int=100, init_audio_ts_fract=0, init_proximity_ts=100)
+        self.delegate = BadgeDelegate(None, sink=StorageSink(self.badge, "server"))
+
+    def tearDown(self):
+        badge_hub.close_writers()
+        self.cleanup()
+
+    def test_chunks_are_stored_as_received(self):
+        self.delegate.expected = Expect.header
+        for i in range(3):
+            self.delegate.handleNotification(None, CHUNK_HEADER.pack(200 + i, 250, 2.5, 50, 2))
+            self.delegate.handleNotification(None, "\x01\x02")
+
+            # stored, and checkpointed, before the next chunk arrives
+            lines = _lines(AUDIO)
+            self.assertEqual(len(lines), i + 1)
+            self.assertEqual(lines[-1]['data']['samples'], [1, 2])
+            self.assertEqual(lines[-1]['data']['badge_address'], "AA:BB:CC:DD:EE:00")
+            self.assertEqual((self.badge.last_audio_ts_int, self.badge.last_audio_ts_fract), (200 + i, 250))
+
+        # an incomplete chunk is not stored, and the session breaks off
+        self.delegate.handleNotification(None, CHUNK_HEADER.pack(203, 0, 2.5, 50, 2))
+        self.delegate.handleNotification(None, "\x01")
+
+        self.assertEqual(len(_lines(AUDIO)), 3)
+        self.assertEqual(self.badge.last_audio_ts_int, 202)
+        self.assertEqual(self.delegate.chunks, [])
+        self.assertEqual(self.delegate.sink.chunks, 3)
+
+    def test_resent_chunk_keeps_timestamp(self):
+        self.delegate.expected = Expect.header
+        for ts in (200, 150):
+            self.delegate.handleNotification(None, CHUNK_HEADER.pack(ts, 0, 2.5, 50, 1))
+            self.delegate.handleNotification(None, "\x01")
+
+        self.assertEqual(len(_lines(AUDIO)), 2)
+        self.assertEqual(self.badge.last_audio_ts_int, 200)
+
+    def test_scans_are_stored_as_received(self):
+        self.delegate.expected = Expect.scanHeader
+        self.delegate.handleNotification(None, SCAN_HEADER.pack(300, 2.5, 1))
+        self.delegate.handleNotification(None, SEEN_DEVICE.pack(12, -60, 2))
+
+        lines = _lines(PROXIMITY)
+        self.assertEqual([line['data']['rssi_distances'] for line in lines], [{"12": {'rssi': -60, 'count': 2}}])
+        self.assertEqual(self.badge.last_proximity_ts, 300)
+
+        self.delegate.handleNotification(None, SCAN_HEADER.pack(315, 2.5, 0))
+        self.assertEqual(len(_lines(PROXIMITY)), 2)
+        self.assertEqual(self.badge.last_proximity_ts, 315)
+
+    def test_badge_is_written_at_its_end(self):
+        self.delegate.expected = Expect.header
+        for ts in (200, 201):
+            self.delegate.handleNotification(None, CHUNK_HEADER.pack(ts, 0, 2.5, 50, 1))
+            self.delegate.handleNotification(None, "\x01")
+        self.assertEqual(os.path.getsize(badge_hub._get_pending_file_name(AUDIO)), 0)
+        self.assertEqual(self.badge.last_audio_ts_int, 100)
+
+        self.delegate.sink.end_of_badge()
+
+        with open(badge_hub._get_pending_file_name(AUDIO)) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        self.assertEqual(self.badge.last_audio_ts_int, 201)
+
+    def test_timestamps_follow_buffered_data(self):
+        badge_hub.close_writers()
+        badge_hub._writers.clear()
+        badge_hub.durability = FLUSH_BYTES
+        try:
+            self.delegate.expected = Expect.header
+            for ts in (200, 201):
+                self.delegate.handleNotification(None, CHUNK_HEADER.pack(ts, 0, 2.5, 50, 1))
+                self.delegate.handleNotification(None, "\x01")
+
+            # a crash now loses the buffered chunks, so they must be pulled again
+            self.assertEqual(os.path.getsize(badge_hub._get_pending_file_name(AUDIO)), 0)
+            self.assertEqual(self.badge.last_audio_ts_int, 100)
+
+            badge_hub.flush_writers()
+            self.assertEqual(len(_lines(AUDIO)), 2)
+            self.assertEqual(self.badge.last_audio_ts_int, 201)
+        finally:
+            badge_hub.close_writers()
+            badge_hub._writers.clear()
+            badge_hub.durability = FLUSH_BADGE